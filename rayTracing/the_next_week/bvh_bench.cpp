@@ -0,0 +1,115 @@
+#include "rtweekend.h"
+#include "camera.h"
+#include "hittable_list.h"
+#include "material.h"
+#include "scenes.h"
+#include "bvh.h"
+#include "flat_bvh.h"
+
+#include <chrono>
+#include <iomanip>
+#include <iostream>
+#include <string>
+#include <vector>
+
+// bvh_node against flat_bvh (and the plain list) on random_scene: build time, closest hit rays per second over
+// camera rays and diffuse bounce rays, and a check that every ray finds the same hit as the list.
+//     thenextweek_bvh_bench [--rays 1000000] [--copies 1]
+// --copies k renders k x k copies of the scene side by side, for a larger tree.
+
+int main(int argc, char* argv[]) {
+    int num_rays = 1000000;
+    int copies = 1;
+    for (int k = 1; k + 1 < argc; k += 2) {
+        std::string option = argv[k];
+        if (option == "--rays") num_rays = std::stoi(argv[k + 1]);
+        else if (option == "--copies") copies = std::stoi(argv[k + 1]);
+    }
+
+    hittable_list scene;
+    for (int x = 0; x < copies; ++x)
+        for (int z = 0; z < copies; ++z) {
+            auto copy = random_scene();
+            for (auto& object : copy.objects) {
+                // the ground sphere only once, the copies stand next to each other on it
+                if ((x || z) && object == copy.objects.front())
+                    continue;
+                if (x || z) {
+                    if (auto s = std::dynamic_pointer_cast<sphere>(object))
+                        object = make_shared<sphere>(s->center + vec3(24 * x, 0, 24 * z), s->radius, s->mat_ptr);
+                    else if (auto m = std::dynamic_pointer_cast<moving_sphere>(object))
+                        object = make_shared<moving_sphere>(m->center0 + vec3(24 * x, 0, 24 * z), m->center1 + vec3(24 * x, 0, 24 * z),
+                                                            m->time0, m->time1, m->radius, m->mat_ptr);
+                }
+                scene.add(object);
+            }
+        }
+
+    // the rays of a render: camera rays of main.cpp, then a diffuse bounce from each of their hits
+    const auto aspect_ratio = 16.0 / 9.0;
+    camera cam(point3(13,2,3), point3(0,0,0), vec3(0,1,0), 20, aspect_ratio, 0.1, 10.0, 0.0, 1.0);
+    std::vector<ray> rays;
+    rays.reserve(num_rays);
+    seed_random(1);
+    while (static_cast<int>(rays.size()) < num_rays) {
+        ray r = cam.get_ray(random_double(), random_double());
+        rays.push_back(r);
+        hit_record rec;
+        if (static_cast<int>(rays.size()) < num_rays && scene.hit(r, 0.001, infinity, rec))
+            rays.push_back(ray(rec.p, rec.normal + random_unit_vector(), r.time()));
+    }
+
+    auto ms_since = [](std::chrono::steady_clock::time_point start) {
+        return std::chrono::duration<double, std::milli>(std::chrono::steady_clock::now() - start).count();
+    };
+
+    // the reference hits, the list is exact by construction
+    std::vector<double> reference_t(rays.size(), infinity);
+    std::vector<const material*> reference_material(rays.size(), nullptr);
+    for (size_t k = 0; k < rays.size(); ++k) {
+        hit_record rec;
+        if (scene.hit(rays[k], 0.001, infinity, rec)) {
+            reference_t[k] = rec.t;
+            reference_material[k] = rec.mat_ptr.get();
+        }
+    }
+
+    std::cout << scene.objects.size() << " objects, " << rays.size() << " rays (camera + diffuse bounce)\n";
+    std::cout << std::left << std::setw(10) << "accel" << std::right << std::setw(12) << "build ms" << std::setw(10) << "nodes"
+              << std::setw(12) << "Mrays/s" << std::setw(10) << "speedup" << std::setw(12) << "mismatches" << "\n";
+
+    double list_rate = 0;
+    for (std::string name : {"list", "bvh", "flat"}) {
+        auto start = std::chrono::steady_clock::now();
+        shared_ptr<hittable> world;
+        size_t nodes = 0;
+        if (name == "list") {
+            world = make_shared<hittable_list>(scene);
+        } else if (name == "bvh") {
+            world = make_shared<bvh_node>(scene, 0.0, 1.0);
+            nodes = 2 * scene.objects.size() - 1;
+        } else {
+            auto flat = make_shared<flat_bvh>(scene, 0.0, 1.0);
+            nodes = flat->nodes.size();
+            world = flat;
+        }
+        double build_ms = ms_since(start);
+
+        int mismatches = 0;
+        start = std::chrono::steady_clock::now();
+        for (size_t k = 0; k < rays.size(); ++k) {
+            hit_record rec;
+            bool hit = world->hit(rays[k], 0.001, infinity, rec);
+            // a tie between two objects at the same t may resolve either way, the distance has to agree
+            if (hit != (reference_material[k] != nullptr) || (hit && std::fabs(rec.t - reference_t[k]) > 1e-9 * (1 + reference_t[k])))
+                ++mismatches;
+        }
+        double rate = rays.size() / ms_since(start) / 1e3;
+        if (name == "list")
+            list_rate = rate;
+
+        std::cout << std::left << std::setw(10) << name << std::right << std::fixed << std::setprecision(2)
+                  << std::setw(12) << build_ms << std::setw(10) << nodes << std::setw(12) << rate
+                  << std::setw(9) << rate / list_rate << "x" << std::setw(12) << mismatches << "\n";
+    }
+}
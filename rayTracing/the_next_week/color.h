@@ -5,21 +5,18 @@
 
 #include <iostream>
 
-void write_color(std::ostream &out, color pixel_color, int samples_per_pixel) {
-    auto r = pixel_color.x();
-    auto g = pixel_color.y();
-    auto b = pixel_color.z();
+// Divide the color by the number of samples, gamma-correct for gamma=2.0 and map to [0,255].
+inline unsigned char to_byte(double component, double scale) {
+    return static_cast<unsigned char>(256 * clamp(sqrt(scale * component), 0.0, 0.999));
+}
 
-    // Divide the color by the number of samples and gamma-correct for gamma=2.0.
+void write_color(std::ostream &out, color pixel_color, int samples_per_pixel) {
     auto scale = 1.0 / samples_per_pixel;
-    r = sqrt(scale * r);
-    g = sqrt(scale * g);
-    b = sqrt(scale * b);
 
     // Write the translated [0,255] value of each color component.
-    out << static_cast<int>(256 * clamp(r, 0.0, 0.999)) << ' '
-        << static_cast<int>(256 * clamp(g, 0.0, 0.999)) << ' '
-        << static_cast<int>(256 * clamp(b, 0.0, 0.999)) << '\n';
+    out << static_cast<int>(to_byte(pixel_color.x(), scale)) << ' '
+        << static_cast<int>(to_byte(pixel_color.y(), scale)) << ' '
+        << static_cast<int>(to_byte(pixel_color.z(), scale)) << '\n';
 }
 
 #endif
@@ -0,0 +1,247 @@
+#ifndef FLAT_BVH_H
+#define FLAT_BVH_H
+
+#include <algorithm>
+#include <cmath>
+#include <cstdint>
+#include <vector>
+
+#include "rtweekend.h"
+#include "hittable.h"
+#include "hittable_list.h"
+
+// A BVH in one contiguous array: 32 byte nodes in depth-first order, no pointers between them.
+//   inner node : the left child is the next node, offset is the index of the right child, axis the split axis
+//   leaf       : count > 0 primitives, objects[offset, offset + count)
+// Built with binned SAH (surface area heuristic) over the primitive centroids, the boxes cover the primitives
+// over the whole shutter [time0, time1] like bvh_node does, so moving_sphere works unchanged.
+// Traversal is iterative with a small stack and visits the nearer child first (the child on the side the ray
+// comes from along the split axis), so the closest hit found there culls most of the far child.
+struct flat_bvh_node {
+    float box_min[3];
+    int32_t offset;
+    float box_max[3];
+    uint16_t count;
+    uint8_t axis;
+    uint8_t pad;
+};
+
+class flat_bvh : public hittable {
+    public:
+        static const int num_bins = 16;
+        static const int max_leaf_size = 4;
+        static const int max_depth = 64;
+
+        flat_bvh(const hittable_list& list, double time0, double time1) {
+            build(list.objects, time0, time1);
+        }
+
+        virtual bool hit(
+            const ray& r, double t_min, double t_max, hit_record& rec) const override;
+
+        virtual bool bounding_box(double time0, double time1, aabb& output_box) const override {
+            if (nodes.empty()) return false;
+            output_box = aabb(point3(nodes[0].box_min[0], nodes[0].box_min[1], nodes[0].box_min[2]),
+                              point3(nodes[0].box_max[0], nodes[0].box_max[1], nodes[0].box_max[2]));
+            return true;
+        }
+
+    public:
+        std::vector<flat_bvh_node> nodes;
+        std::vector<shared_ptr<hittable>> objects;  // in leaf order
+
+    private:
+        struct build_item {
+            aabb box;
+            point3 centroid;
+            shared_ptr<hittable> object;
+        };
+
+        void build(const std::vector<shared_ptr<hittable>>& src_objects, double time0, double time1);
+        int build_node(std::vector<build_item>& items, size_t start, size_t end, int depth);
+};
+
+// Tool Functions
+inline double surface_area(const aabb& box) {
+    auto d = box.max() - box.min();
+    return 2 * (d.x() * d.y() + d.y() * d.z() + d.z() * d.x());
+}
+
+// float bounds rounded outwards, the float box always contains the double one
+inline void store_box(const aabb& box, flat_bvh_node& node) {
+    for (int a = 0; a < 3; a++) {
+        node.box_min[a] = std::nextafter(static_cast<float>(box.min()[a]), -INFINITY);
+        node.box_max[a] = std::nextafter(static_cast<float>(box.max()[a]), INFINITY);
+    }
+}
+
+inline bool node_hit(const flat_bvh_node& node, const point3& origin, const vec3& inv_dir, double t_min, double t_max) {
+    for (int a = 0; a < 3; a++) {
+        auto t0 = (node.box_min[a] - origin[a]) * inv_dir[a];
+        auto t1 = (node.box_max[a] - origin[a]) * inv_dir[a];
+        if (inv_dir[a] < 0.0)
+            std::swap(t0, t1);
+        t_min = t0 > t_min ? t0 : t_min;
+        t_max = t1 < t_max ? t1 : t_max;
+        if (t_max < t_min)
+            return false;
+    }
+    return true;
+}
+
+void flat_bvh::build(const std::vector<shared_ptr<hittable>>& src_objects, double time0, double time1) {
+    std::vector<build_item> items;
+    items.reserve(src_objects.size());
+    for (const auto& object : src_objects) {
+        aabb box;
+        if (!object->bounding_box(time0, time1, box))
+            std::cerr << "No bounding box in flat_bvh constructor.\n";
+        items.push_back({box, 0.5 * (box.min() + box.max()), object});
+    }
+    if (items.empty())
+        return;
+    nodes.reserve(2 * items.size());
+    objects.reserve(items.size());
+    build_node(items, 0, items.size(), 0);
+}
+
+int flat_bvh::build_node(std::vector<build_item>& items, size_t start, size_t end, int depth) {
+    const int index = static_cast<int>(nodes.size());
+    nodes.emplace_back();
+
+    aabb box = items[start].box;
+    aabb centroids(items[start].centroid, items[start].centroid);
+    for (size_t k = start + 1; k < end; ++k) {
+        box = surrounding_box(box, items[k].box);
+        centroids = surrounding_box(centroids, aabb(items[k].centroid, items[k].centroid));
+    }
+    store_box(box, nodes[index]);
+
+    const size_t count = end - start;
+    int best_axis = -1;
+    int best_split = 0;
+    // SAH cost relative to one primitive intersection, a node traversal costs about as much
+    double best_cost = static_cast<double>(count);
+    if (count > max_leaf_size / 2 && depth < max_depth - 1) {
+        for (int a = 0; a < 3; a++) {
+            auto extent = centroids.max()[a] - centroids.min()[a];
+            if (extent <= 0)
+                continue;
+            aabb bin_box[num_bins];
+            int bin_count[num_bins] = {};
+            auto bin_of = [&](const build_item& item) {
+                int b = static_cast<int>(num_bins * (item.centroid[a] - centroids.min()[a]) / extent);
+                return std::min(b, num_bins - 1);
+            };
+            for (size_t k = start; k < end; ++k) {
+                int b = bin_of(items[k]);
+                bin_box[b] = bin_count[b]++ ? surrounding_box(bin_box[b], items[k].box) : items[k].box;
+            }
+            // sweep from the right for the right hand areas, then from the left evaluating every plane
+            double right_area[num_bins];
+            int right_count[num_bins];
+            aabb acc;
+            int n = 0;
+            for (int b = num_bins - 1; b > 0; --b) {
+                if (bin_count[b])
+                    acc = n ? surrounding_box(acc, bin_box[b]) : bin_box[b];
+                n += bin_count[b];
+                right_area[b] = n ? surface_area(acc) : 0.0;
+                right_count[b] = n;
+            }
+            n = 0;
+            for (int b = 0; b < num_bins - 1; ++b) {
+                if (bin_count[b])
+                    acc = n ? surrounding_box(acc, bin_box[b]) : bin_box[b];
+                n += bin_count[b];
+                if (n == 0 || right_count[b + 1] == 0)
+                    continue;
+                auto cost = 1.0 + (n * surface_area(acc) + right_count[b + 1] * right_area[b + 1]) / surface_area(box);
+                if (cost < best_cost) {
+                    best_cost = cost;
+                    best_axis = a;
+                    best_split = b;
+                }
+            }
+        }
+    }
+
+    if (best_axis < 0 && (count <= max_leaf_size || depth >= max_depth - 1)) {
+        nodes[index].offset = static_cast<int32_t>(objects.size());
+        nodes[index].count = static_cast<uint16_t>(count);
+        for (size_t k = start; k < end; ++k)
+            objects.push_back(items[k].object);
+        return index;
+    }
+
+    size_t mid;
+    if (best_axis >= 0) {
+        auto extent = centroids.max()[best_axis] - centroids.min()[best_axis];
+        auto middle = std::partition(items.begin() + start, items.begin() + end, [&](const build_item& item) {
+            int b = static_cast<int>(num_bins * (item.centroid[best_axis] - centroids.min()[best_axis]) / extent);
+            return std::min(b, num_bins - 1) <= best_split;
+        });
+        mid = middle - items.begin();
+    } else {
+        // too many primitives for a leaf but no plane beats one: median of the widest centroid axis
+        auto extent = centroids.max() - centroids.min();
+        best_axis = extent.x() > extent.y() ? (extent.x() > extent.z() ? 0 : 2) : (extent.y() > extent.z() ? 1 : 2);
+        mid = start + count / 2;
+        std::nth_element(items.begin() + start, items.begin() + mid, items.begin() + end,
+            [&](const build_item& a, const build_item& b) { return a.centroid[best_axis] < b.centroid[best_axis]; });
+    }
+
+    nodes[index].axis = static_cast<uint8_t>(best_axis);
+    nodes[index].count = 0;
+    build_node(items, start, mid, depth + 1);
+    nodes[index].offset = build_node(items, mid, end, depth + 1);
+    return index;
+}
+
+bool flat_bvh::hit(const ray& r, double t_min, double t_max, hit_record& rec) const {
+    if (nodes.empty())
+        return false;
+
+    const point3 origin = r.origin();
+    const vec3 inv_dir(1.0 / r.direction().x(), 1.0 / r.direction().y(), 1.0 / r.direction().z());
+    const bool negative[3] = {inv_dir.x() < 0, inv_dir.y() < 0, inv_dir.z() < 0};
+
+    hit_record temp_rec;
+    bool hit_anything = false;
+    auto closest_so_far = t_max;
+    int stack[max_depth];
+    int top = 0;
+    int current = 0;
+
+    while (true) {
+        const auto& node = nodes[current];
+        if (node_hit(node, origin, inv_dir, t_min, closest_so_far)) {
+            if (node.count > 0) {
+                for (int k = node.offset; k < node.offset + node.count; ++k) {
+                    if (objects[k]->hit(r, t_min, closest_so_far, temp_rec)) {
+                        hit_anything = true;
+                        closest_so_far = temp_rec.t;
+                        rec = temp_rec;
+                    }
+                }
+            } else {
+                // nearer child first, the other one waits on the stack
+                if (negative[node.axis]) {
+                    stack[top++] = current + 1;
+                    current = node.offset;
+                } else {
+                    stack[top++] = node.offset;
+                    current = current + 1;
+                }
+                continue;
+            }
+        }
+        if (top == 0)
+            break;
+        current = stack[--top];
+    }
+
+    return hit_anything;
+}
+
+#endif
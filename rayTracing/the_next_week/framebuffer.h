@@ -0,0 +1,140 @@
+#ifndef FRAMEBUFFER_H
+#define FRAMEBUFFER_H
+
+#include "rtweekend.h"
+#include "color.h"
+
+#include <algorithm>
+#include <cstdint>
+#include <fstream>
+#include <iostream>
+#include <string>
+#include <vector>
+
+// The summed samples of every pixel, written once at the end as binary PPM (P6) or PNG.
+// Pixel (i, j) is counted from the lower left corner like the camera's (u, v); the files start at the top row.
+class framebuffer {
+    public:
+        framebuffer(int w, int h) : width(w), height(h), pixels(static_cast<size_t>(w) * h) {}
+
+        color& at(int i, int j) { return pixels[static_cast<size_t>(height - 1 - j) * width + i]; }
+
+        // 8 bit RGB, top row first
+        std::vector<unsigned char> to_rgb8(int samples_per_pixel) const {
+            auto scale = 1.0 / samples_per_pixel;
+            std::vector<unsigned char> rgb(pixels.size() * 3);
+            for (size_t k = 0; k < pixels.size(); ++k)
+                for (int c = 0; c < 3; ++c)
+                    rgb[3*k + c] = to_byte(pixels[k][c], scale);
+            return rgb;
+        }
+
+        void write_ppm(std::ostream& out, int samples_per_pixel) const {
+            auto rgb = to_rgb8(samples_per_pixel);
+            out << "P6\n" << width << " " << height << "\n255\n";
+            out.write(reinterpret_cast<const char*>(rgb.data()), rgb.size());
+        }
+
+        void write_png(std::ostream& out, int samples_per_pixel) const {
+            auto rgb = to_rgb8(samples_per_pixel);
+            // every row starts with its filter type, 0: none
+            std::vector<unsigned char> raw;
+            raw.reserve(rgb.size() + height);
+            for (int row = 0; row < height; ++row) {
+                raw.push_back(0);
+                raw.insert(raw.end(), rgb.begin() + static_cast<size_t>(row) * width * 3,
+                           rgb.begin() + static_cast<size_t>(row + 1) * width * 3);
+            }
+
+            std::vector<unsigned char> header;
+            put_u32(header, width);
+            put_u32(header, height);
+            header.insert(header.end(), {8, 2, 0, 0, 0});  // 8 bit, RGB, deflate, no filter, no interlace
+
+            // zlib stream of stored (uncompressed) deflate blocks: no dependency, the file is written once
+            std::vector<unsigned char> data = {0x78, 0x01};
+            for (size_t offset = 0; offset < raw.size() || offset == 0; offset += 65535) {
+                auto length = static_cast<uint16_t>(std::min<size_t>(65535, raw.size() - offset));
+                data.push_back(offset + length >= raw.size() ? 1 : 0);
+                data.insert(data.end(), {static_cast<unsigned char>(length & 0xff), static_cast<unsigned char>(length >> 8),
+                                         static_cast<unsigned char>(~length & 0xff), static_cast<unsigned char>((~length >> 8) & 0xff)});
+                data.insert(data.end(), raw.begin() + offset, raw.begin() + offset + length);
+            }
+            put_u32(data, adler32(raw));
+
+            static const unsigned char signature[] = {0x89, 'P', 'N', 'G', '\r', '\n', 0x1a, '\n'};
+            out.write(reinterpret_cast<const char*>(signature), sizeof(signature));
+            write_chunk(out, "IHDR", header);
+            write_chunk(out, "IDAT", data);
+            write_chunk(out, "IEND", {});
+        }
+
+        // by extension: .png, else binary PPM; "-" is PPM on stdout
+        bool write(const std::string& path, int samples_per_pixel) const {
+            if (path == "-") {
+                write_ppm(std::cout, samples_per_pixel);
+                return bool(std::cout);
+            }
+            std::ofstream out(path, std::ios::binary);
+            if (!out)
+                return false;
+            if (path.size() >= 4 && path.compare(path.size() - 4, 4, ".png") == 0)
+                write_png(out, samples_per_pixel);
+            else
+                write_ppm(out, samples_per_pixel);
+            return bool(out);
+        }
+
+    public:
+        const int width;
+        const int height;
+
+    private:
+        static void put_u32(std::vector<unsigned char>& bytes, uint32_t value) {
+            for (int shift = 24; shift >= 0; shift -= 8)
+                bytes.push_back(static_cast<unsigned char>(value >> shift));
+        }
+
+        static uint32_t adler32(const std::vector<unsigned char>& bytes) {
+            uint32_t a = 1, b = 0;
+            for (auto byte : bytes) {
+                a = (a + byte) % 65521;
+                b = (b + a) % 65521;
+            }
+            return (b << 16) | a;
+        }
+
+        static uint32_t crc32(const std::vector<unsigned char>& bytes) {
+            static const std::vector<uint32_t> table = [] {
+                std::vector<uint32_t> t(256);
+                for (uint32_t n = 0; n < 256; ++n) {
+                    uint32_t c = n;
+                    for (int k = 0; k < 8; ++k)
+                        c = (c & 1) ? 0xedb88320u ^ (c >> 1) : c >> 1;
+                    t[n] = c;
+                }
+                return t;
+            }();
+            uint32_t c = 0xffffffffu;
+            for (auto byte : bytes)
+                c = table[(c ^ byte) & 0xff] ^ (c >> 8);
+            return c ^ 0xffffffffu;
+        }
+
+        static void write_chunk(std::ostream& out, const char* type, const std::vector<unsigned char>& payload) {
+            std::vector<unsigned char> length;
+            put_u32(length, static_cast<uint32_t>(payload.size()));
+            // the crc covers the type and the payload
+            std::vector<unsigned char> body(type, type + 4);
+            body.insert(body.end(), payload.begin(), payload.end());
+            std::vector<unsigned char> crc;
+            put_u32(crc, crc32(body));
+            out.write(reinterpret_cast<const char*>(length.data()), 4);
+            out.write(reinterpret_cast<const char*>(body.data()), body.size());
+            out.write(reinterpret_cast<const char*>(crc.data()), 4);
+        }
+
+        std::vector<color> pixels;
+};
+
+#endif
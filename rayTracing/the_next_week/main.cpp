@@ -6,20 +6,35 @@
 #include "hittable.h"
 #include "moving_sphere.h"
 #include "material.h"
-
+#include "scenes.h"
+#include "bvh.h"
+#include "flat_bvh.h"
+#include "framebuffer.h"
+#include "tile_scheduler.h"
+
+#include <atomic>
+#include <chrono>
+#include <cstring>
+#include <iomanip>
 #include <iostream>
-color ray_color(const ray& r, const hittable& world, int depth) {
+#include <string>
+#include <thread>
+#include <vector>
+
+// rays: the rays traced (world.hit calls) so far
+color ray_color(const ray& r, const hittable& world, int depth, long long& rays) {
     hit_record rec;
 
     // If we've exceeded the ray bounce limit, no more light is gathered.
     if (depth <= 0)
         return color(0,0,0);
 
+    ++rays;
     if (world.hit(r, 0.001, infinity, rec)) {
         ray scattered;
         color attenuation;
         if (rec.mat_ptr->scatter(r, rec, attenuation, scattered))
-            return attenuation * ray_color(scattered, world, depth-1);
+            return attenuation * ray_color(scattered, world, depth-1, rays);
         return color(0,0,0);
     }
     vec3 unit_direction = unit_vector(r.direction());
@@ -27,62 +42,51 @@ color ray_color(const ray& r, const hittable& world, int depth) {
     return (1.0-t)*color(1.0, 1.0, 1.0) + t*color(0.5, 0.7, 1.0);
 }
 
-hittable_list random_scene() {
-    hittable_list world;
-
-    auto ground_material = make_shared<lambertian>(color(0.5, 0.5, 0.5));
-    world.add(make_shared<sphere>(point3(0,-1000,0), 1000, ground_material));
-
-    for (int a = -11; a < 11; a++) {
-        for (int b = -11; b < 11; b++) {
-            auto choose_mat = random_double();
-            point3 center(a + 0.9*random_double(), 0.2, b + 0.9*random_double());
-
-            if ((center - point3(4, 0.2, 0)).length() > 0.9) {
-                shared_ptr<material> sphere_material;
-
-                if (choose_mat < 0.8) {
-                    // diffuse
-                    auto albedo = color::random() * color::random();
-                    sphere_material = make_shared<lambertian>(albedo);
-                    auto center2 = center + vec3(0, random_double(0,.5), 0);
-                    world.add(make_shared<moving_sphere>(
-                        center, center2, 0.0, 1.0, 0.2, sphere_material));
-                } else if (choose_mat < 0.95) {
-                    // metal
-                    auto albedo = color::random(0.5, 1);
-                    auto fuzz = random_double(0, 0.5);
-                    sphere_material = make_shared<metal>(albedo, fuzz);
-                    world.add(make_shared<sphere>(center, 0.2, sphere_material));
-                } else {
-                    // glass
-                    sphere_material = make_shared<dielectric>(1.5);
-                    world.add(make_shared<sphere>(center, 0.2, sphere_material));
-                }
-            }
-        }
-    }
-
-    auto material1 = make_shared<dielectric>(1.5);
-    world.add(make_shared<sphere>(point3(0, 1, 0), 1.0, material1));
-
-    auto material2 = make_shared<lambertian>(color(0.4, 0.2, 0.1));
-    world.add(make_shared<sphere>(point3(-4, 1, 0), 1.0, material2));
-
-    auto material3 = make_shared<metal>(color(0.7, 0.6, 0.5), 0.0);
-    world.add(make_shared<sphere>(point3(4, 1, 0), 1.0, material3));
-
-    return world;
+void usage(const char* program) {
+    std::cerr << "usage: " << program << " [--out image.png|image.ppm|-] [--width 1200] [--spp 4] [--threads N]"
+              << " [--tile 32] [--seed 0] [--accel flat|bvh|list]\n";
 }
 
-int main() {
+int main(int argc, char* argv[]) {
+
+    // Options
+
+    std::string out = "image.png";  // .png, anything else is binary PPM, "-" is PPM on stdout
+    int image_width = 1200;
+    int samples_per_pixel = 4;
+    int num_threads = std::max(1u, std::thread::hardware_concurrency());
+    int tile_size = 32;
+    unsigned long long seed = 0;
+    std::string accel = "flat";  // flat_bvh, bvh_node or the plain hittable_list
+    for (int k = 1; k < argc; ++k) {
+        std::string option = argv[k];
+        if (k + 1 >= argc || option.compare(0, 2, "--") != 0) {
+            usage(argv[0]);
+            return 1;
+        }
+        std::string value = argv[++k];
+        if (option == "--out") out = value;
+        else if (option == "--width") image_width = std::stoi(value);
+        else if (option == "--spp") samples_per_pixel = std::stoi(value);
+        else if (option == "--threads") num_threads = std::stoi(value);
+        else if (option == "--tile") tile_size = std::stoi(value);
+        else if (option == "--seed") seed = std::stoull(value);
+        else if (option == "--accel") accel = value;
+        else {
+            usage(argv[0]);
+            return 1;
+        }
+    }
+    // no workers would never finish, a 0 tile divides by zero, 0 spp scales the image by 1/0
+    if (image_width <= 0 || samples_per_pixel <= 0 || num_threads <= 0 || tile_size <= 0) {
+        usage(argv[0]);
+        return 1;
+    }
 
     // Image
 
     const auto aspect_ratio = 16.0 / 9.0;
-    const int image_width = 1200;
     // const int image_height = static_cast<int>(image_width / aspect_ratio);
-    const int samples_per_pixel = 4;
     const int max_depth = 50;
 
     // World
@@ -100,7 +104,19 @@ int main() {
     // world.add(make_shared<sphere>(point3(-1.0,    0.0, -1.0),  -0.4, material_left));
     // world.add(make_shared<sphere>(point3( 1.0,    0.0, -1.0),   0.5, material_right));
 
-    auto world = random_scene();
+    auto scene = random_scene();
+
+    const auto build_start = std::chrono::steady_clock::now();
+    shared_ptr<hittable> world;
+    if (accel == "flat") world = make_shared<flat_bvh>(scene, 0.0, 1.0);
+    else if (accel == "bvh") world = make_shared<bvh_node>(scene, 0.0, 1.0);
+    else if (accel == "list") world = make_shared<hittable_list>(scene);
+    else {
+        usage(argv[0]);
+        return 1;
+    }
+    std::cerr << accel << " over " << scene.objects.size() << " objects built in " << std::setprecision(3)
+              << std::chrono::duration<double, std::milli>(std::chrono::steady_clock::now() - build_start).count() << " ms\n";
 
     // Camera
     point3 lookfrom(13,2,3);
@@ -115,21 +131,71 @@ int main() {
 
     // Render
 
-    std::cout << "P3\n" << image_width << " " << image_height << "\n255\n";
-
-    for (int j = image_height-1; j >= 0; --j) {
-        std::cerr << "\rScanlines remaining: " << j << ' ' << std::flush;
-        for (int i = 0; i < image_width; ++i) {
-            color pixel_color(0, 0, 0);
-            for (int s = 0; s < samples_per_pixel; ++s) {
-                auto u = (i + random_double()) / (image_width-1);
-                auto v = (j + random_double()) / (image_height-1);
-                ray r = cam.get_ray(u, v);
-                pixel_color += ray_color(r, world, max_depth);
+    // tiles of tile_size x tile_size pixels over all the cores, into a framebuffer written once at the end
+    framebuffer image(image_width, image_height);
+    const int tiles_x = (image_width + tile_size - 1) / tile_size;
+    const int tiles_y = (image_height + tile_size - 1) / tile_size;
+    const int num_tiles = tiles_x * tiles_y;
+    tile_scheduler scheduler(num_tiles, num_threads);
+    std::atomic<int> tiles_done(0);
+    std::atomic<long long> rays_traced(0);
+
+    auto render_tiles = [&](int worker) {
+        int tile;
+        while (scheduler.next(worker, tile)) {
+            // the random numbers of a tile only depend on the seed and the tile
+            seed_random(seed * 0x9e3779b97f4a7c15ull + tile);
+            long long rays = 0;
+            const int i0 = (tile % tiles_x) * tile_size;
+            const int j0 = (tile / tiles_x) * tile_size;
+            for (int j = j0; j < std::min(j0 + tile_size, image_height); ++j) {
+                for (int i = i0; i < std::min(i0 + tile_size, image_width); ++i) {
+                    color pixel_color(0, 0, 0);
+                    for (int s = 0; s < samples_per_pixel; ++s) {
+                        auto u = (i + random_double()) / (image_width-1);
+                        auto v = (j + random_double()) / (image_height-1);
+                        ray r = cam.get_ray(u, v);
+                        pixel_color += ray_color(r, *world, max_depth, rays);
+                    }
+                    image.at(i, j) = pixel_color;
+                }
             }
-            write_color(std::cout, pixel_color, samples_per_pixel);
+            rays_traced += rays;
+            ++tiles_done;
         }
+    };
+
+    const auto start = std::chrono::steady_clock::now();
+    auto seconds = [&] {
+        return std::chrono::duration<double>(std::chrono::steady_clock::now() - start).count();
+    };
+    std::vector<std::thread> threads;
+    for (int worker = 0; worker < num_threads; ++worker)
+        threads.emplace_back(render_tiles, worker);
+
+    // progress on stderr, stdout may be the image
+    double last_report = 0;
+    while (tiles_done < num_tiles) {
+        std::this_thread::sleep_for(std::chrono::milliseconds(10));
+        if (seconds() - last_report < 0.25 && tiles_done < num_tiles)
+            continue;
+        last_report = seconds();
+        std::cerr << "\rTiles: " << tiles_done << "/" << num_tiles << " (" << 100 * tiles_done / num_tiles << "%), "
+                  << std::fixed << std::setprecision(2) << rays_traced / seconds() / 1e6 << " Mrays/s   " << std::flush;
     }
-
-    std::cerr << "\nDone.\n";
+    for (auto& thread : threads)
+        thread.join();
+
+    const double elapsed = seconds();
+    std::cerr << "\nDone: " << image_width << "x" << image_height << ", " << samples_per_pixel << " spp, "
+              << num_threads << " threads, " << num_tiles << " tiles in " << std::setprecision(2) << elapsed << " s, "
+              << rays_traced / elapsed / 1e6 << " Mrays/s, "
+              << static_cast<double>(image_width) * image_height * samples_per_pixel / elapsed / 1e6 << " Msamples/s\n";
+
+    if (!image.write(out, samples_per_pixel)) {
+        std::cerr << "failed to write " << out << "\n";
+        return 1;
+    }
+    if (out != "-")
+        std::cerr << "Wrote " << out << "\n";
 }
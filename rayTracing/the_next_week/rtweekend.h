@@ -5,6 +5,7 @@
 #include <limits>
 #include <memory>
 #include <cstdlib>
+#include <random>
 
 // Usings
 
@@ -23,9 +24,22 @@ inline double degrees_to_radians(double degrees) {
     return degrees * pi / 180.0;
 }
 
+// Every thread draws from its own generator: rand() is one shared state (locked in glibc) that the render
+// threads would fight over. The tile renderer reseeds it per tile, so the image does not depend on which
+// thread renders which tile.
+inline std::mt19937_64& random_generator() {
+    static thread_local std::mt19937_64 generator(5489u);
+    return generator;
+}
+
+inline void seed_random(unsigned long long seed) {
+    random_generator().seed(seed);
+}
+
 inline double random_double() {
     // Returns a random real in [0,1).
-    return rand() / (RAND_MAX + 1.0);
+    static thread_local std::uniform_real_distribution<double> distribution(0.0, 1.0);
+    return distribution(random_generator());
 }
 
 inline double random_double(double min, double max) {
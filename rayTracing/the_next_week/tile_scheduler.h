@@ -0,0 +1,67 @@
+#ifndef TILE_SCHEDULER_H
+#define TILE_SCHEDULER_H
+
+#include <deque>
+#include <memory>
+#include <mutex>
+#include <vector>
+
+// Work stealing over the tiles of an image: every worker starts with a contiguous run of tiles (neighbouring
+// tiles share the cache lines of the scene they see) and takes from the front of its own queue. A worker whose
+// queue is empty steals from the back of the fullest queue, so the cheap tiles (sky) and the expensive ones
+// (glass, the ground) even out between the threads without a central queue they all contend on.
+class tile_scheduler {
+    public:
+        tile_scheduler(int num_tiles, int num_workers) {
+            for (int w = 0; w < num_workers; ++w) {
+                queues.push_back(std::make_unique<tile_queue>());
+                auto begin = static_cast<long long>(num_tiles) * w / num_workers;
+                auto end = static_cast<long long>(num_tiles) * (w + 1) / num_workers;
+                for (auto tile = begin; tile < end; ++tile)
+                    queues.back()->tiles.push_back(static_cast<int>(tile));
+            }
+        }
+
+        // the next tile of worker, false once every tile has been handed out
+        bool next(int worker, int& tile) {
+            {
+                auto& own = *queues[worker];
+                std::lock_guard<std::mutex> guard(own.lock);
+                if (!own.tiles.empty()) {
+                    tile = own.tiles.front();
+                    own.tiles.pop_front();
+                    return true;
+                }
+            }
+            while (true) {
+                // the sizes are only a hint, the victim is checked again under its lock
+                tile_queue* victim = nullptr;
+                size_t most = 0;
+                for (auto& queue : queues) {
+                    std::lock_guard<std::mutex> guard(queue->lock);
+                    if (queue->tiles.size() > most) {
+                        most = queue->tiles.size();
+                        victim = queue.get();
+                    }
+                }
+                if (victim == nullptr)
+                    return false;
+                std::lock_guard<std::mutex> guard(victim->lock);
+                if (!victim->tiles.empty()) {
+                    tile = victim->tiles.back();
+                    victim->tiles.pop_back();
+                    return true;
+                }
+            }
+        }
+
+    private:
+        struct tile_queue {
+            std::mutex lock;
+            std::deque<int> tiles;
+        };
+
+        std::vector<std::unique_ptr<tile_queue>> queues;
+};
+
+#endif
@@ -1,6 +1,8 @@
 import taichi as ti
 import taichi.math as tm
 import math
+import random
+import numpy as np
 
 # yapf: disable
 """
@@ -16,10 +18,18 @@ T_MIN = 0.001
 T_MAX = tm.inf
 SPP = 16  # samples per pixel
 MAX_RAY_DEPTH = 8
+MOTION_BLUR_SCENE = False  # the random scene of the_next_week, its diffuse spheres move while the shutter is open
+NUM_VIEWS = 0  # > 0: render a turntable of NUM_VIEWS cameras in one launch, save them as view_*.png and exit
 
 image_resolution = (960, 540)
 aspect_ratio = image_resolution[0] / image_resolution[1]
-image_pixels = ti.Vector.field(3, float, image_resolution)
+FILM_TILE = 0  # > 0: image_pixels is stored in FILM_TILE x FILM_TILE blocks (see path_tracing_taichi/film.py)
+if FILM_TILE > 0:
+    assert image_resolution[0] % FILM_TILE == 0 and image_resolution[1] % FILM_TILE == 0
+    image_pixels = ti.Vector.field(3, float)
+    ti.root.dense(ti.ij, (image_resolution[0] // FILM_TILE, image_resolution[1] // FILM_TILE)).dense(ti.ij, FILM_TILE).place(image_pixels)
+else:
+    image_pixels = ti.Vector.field(3, float, image_resolution)
 
 
 @ti.func
@@ -104,6 +114,7 @@ def reflectance(cosine, ref_idx) -> ti.f32:
 class Ray:
     origin: tm.vec3
     direction: tm.vec3
+    time: ti.f32
 
     @ti.func
     def at(r, t: float) -> tm.vec3:
@@ -111,11 +122,20 @@ class Ray:
 
 
 @ti.dataclass
-class Material:
-    type: ti.u32
-    albedo: tm.vec3
-    fuzz: ti.f32     # 金属度
-    ior: ti.f32      # 折射率
+class AABB:
+    minimum: tm.vec3
+    maximum: tm.vec3
+
+    @ti.func
+    def hit(b, r, t_min, t_max) -> ti.i32:
+        inv_d = 1.0 / r.direction
+        t0 = (b.minimum - r.origin) * inv_d
+        t1 = (b.maximum - r.origin) * inv_d
+        t_near = tm.min(t0, t1)
+        t_far = tm.max(t0, t1)
+        t_min = tm.max(t_min, tm.max(t_near.x, tm.max(t_near.y, t_near.z)))
+        t_max = tm.min(t_max, tm.min(t_far.x, tm.min(t_far.y, t_far.z)))
+        return t_min <= t_max
 
 
 @ti.dataclass
@@ -140,66 +160,35 @@ class ScatterRet:
 
 
 @ti.dataclass
-class Sphere:
-    center: tm.vec3
-    radius: ti.f32
-    mtl: Material
-    obj_idx: ti.i32
-
-    @ti.func
-    def hit(s, r, t_min, t_max) -> HitRecord:
-        record = HitRecord(r.origin, tm.vec3(0, 0, 0), t_min, False, 0)
-
-        oc = r.origin - s.center
-        a = tm.dot(r.direction, r.direction)
-        half_b = tm.dot(oc, r.direction)
-        c = tm.dot(oc, oc) - s.radius * s.radius
-        discriminant = half_b * half_b - a * c
-
-        return_flag = False
-
-        if discriminant < 0:
-            record.is_hit = False
-        else:
-            sqrtd = tm.sqrt(discriminant)
-            root = (-half_b - sqrtd) / a
-            if root < t_min or t_max < root:
-                root = (-half_b + sqrtd) / a
-                if root < t_min or t_max < root:
-                    return_flag = True
-            if not return_flag:
-                record.t = root
-                record.pos = r.at(record.t)
-                record.is_hit = True
-                record.obj_idx = s.obj_idx
-                outward_normal = (record.pos - s.center) / s.radius
-                record.set_face_normal(r, outward_normal)
-        return record
-
+class Material:
+    type: ti.u32
+    albedo: tm.vec3
+    fuzz: ti.f32     # 金属度
+    ior: ti.f32      # 折射率
 
     # return Ray and attenuation(Color)
     @ti.func
-    def scatter(s, r_in, rec) -> ScatterRet:
-        scattered = Ray(tm.vec3(0, 0, 0), tm.vec3(0, 0, 0))
+    def scatter(m, r_in, rec) -> ScatterRet:
+        scattered = Ray(tm.vec3(0, 0, 0), tm.vec3(0, 0, 0), r_in.time)
         attenuation = tm.vec3(1, 1, 1)
         is_out = True
 
-        if s.mtl.type == 0:
+        if m.type == 0:
             scatter_dir = rec.normal + random_unit_vec()
             if near_zero(scatter_dir):
                 scatter_dir = rec.normal
 
-            scattered = Ray(rec.pos, tm.normalize(scatter_dir))
-            attenuation = s.mtl.albedo
-        elif s.mtl.type == 1:
+            scattered = Ray(rec.pos, tm.normalize(scatter_dir), r_in.time)
+            attenuation = m.albedo
+        elif m.type == 1:
             reflected = reflect(r_in.direction, rec.normal)
-            scattered = Ray(rec.pos, tm.normalize(reflected + s.mtl.fuzz * random_in_unit_sphere()))
-            attenuation = s.mtl.albedo
+            scattered = Ray(rec.pos, tm.normalize(reflected + m.fuzz * random_in_unit_sphere()), r_in.time)
+            attenuation = m.albedo
 
             is_out = tm.dot(scattered.direction, rec.normal) > 0
-        elif s.mtl.type == 2:
+        elif m.type == 2:
             attenuation = tm.vec3(1, 1, 1)
-            refraction_ratio = (1.0 / s.mtl.ior) if rec.is_front_face else s.mtl.ior
+            refraction_ratio = (1.0 / m.ior) if rec.is_front_face else m.ior
 
             cos_theta = tm.min(tm.dot(-r_in.direction, rec.normal), 1.0)
             sin_theta = tm.sqrt(1.0 - cos_theta * cos_theta)
@@ -212,7 +201,7 @@ class Sphere:
             else:
                 direction = refract(r_in.direction, rec.normal, refraction_ratio)
 
-            scattered = Ray(rec.pos, tm.normalize(direction))
+            scattered = Ray(rec.pos, tm.normalize(direction), r_in.time)
         else:
             pass
 
@@ -221,6 +210,58 @@ class Sphere:
         return ret
 
 
+@ti.dataclass
+class Sphere:
+    center: tm.vec3    # center at time 0
+    radius: ti.f32
+    mtl_idx: ti.i32    # index into the material table
+    obj_idx: ti.i32
+    velocity: tm.vec3  # the center moves by velocity per unit of time, zero for a static sphere
+
+    @ti.func
+    def center_at(s, time) -> tm.vec3:
+        return s.center + time * s.velocity
+
+    # bounds over the whole shutter interval, so the BVH never misses a moving sphere
+    @ti.func
+    def bounding_box(s, time0, time1) -> AABB:
+        r = tm.vec3(ti.abs(s.radius))
+        c0 = s.center_at(time0)
+        c1 = s.center_at(time1)
+        return AABB(tm.min(c0, c1) - r, tm.max(c0, c1) + r)
+
+    @ti.func
+    def hit(s, r, t_min, t_max) -> HitRecord:
+        record = HitRecord(r.origin, tm.vec3(0, 0, 0), t_min, False, 0)
+
+        center = s.center_at(r.time)
+        oc = r.origin - center
+        a = tm.dot(r.direction, r.direction)
+        half_b = tm.dot(oc, r.direction)
+        c = tm.dot(oc, oc) - s.radius * s.radius
+        discriminant = half_b * half_b - a * c
+
+        return_flag = False
+
+        if discriminant < 0:
+            record.is_hit = False
+        else:
+            sqrtd = tm.sqrt(discriminant)
+            root = (-half_b - sqrtd) / a
+            if root < t_min or t_max < root:
+                root = (-half_b + sqrtd) / a
+                if root < t_min or t_max < root:
+                    return_flag = True
+            if not return_flag:
+                record.t = root
+                record.pos = r.at(record.t)
+                record.is_hit = True
+                record.obj_idx = s.obj_idx
+                outward_normal = (record.pos - center) / s.radius
+                record.set_face_normal(r, outward_normal)
+        return record
+
+
 @ti.dataclass
 class Camera:
     origin: tm.vec3
@@ -229,6 +270,8 @@ class Camera:
     lookat: tm.vec3
     vup: tm.vec3
     lens_radius: ti.f32
+    time0: ti.f32    # shutter open
+    time1: ti.f32    # shutter close
 
     @ti.func
     def get_ray(c, u, v) -> Ray:
@@ -251,23 +294,138 @@ class Camera:
         offset = u_tmp * rd.x + v_tmp * rd.y
 
         return Ray(c.origin + offset, tm.normalize(
-            lower_left_corner + u * horizontal + v * vertical - c.origin - offset))
+            lower_left_corner + u * horizontal + v * vertical - c.origin - offset), randf_range(c.time0, c.time1))
 
 
 R = tm.cos(math.pi / 4)
 
-objects_num = 5
+
+def three_spheres():
+    materials = [
+        Material(0, tm.vec3(0.8, 0.8, 0.0)),        # ground
+        Material(0, tm.vec3(0.7, 0.3, 0.3)),        # center
+        Material(2, ior=1.5),                       # glass, shared by the hollow sphere
+        Material(1, tm.vec3(0.8, 0.6, 0.2), 1.0),   # fuzzy gold
+    ]
+    spheres = [
+        Sphere(tm.vec3(0, -100.5, -1), 100, mtl_idx=0),
+        Sphere(tm.vec3(0, 0, -1), 0.5, mtl_idx=1),
+        Sphere(tm.vec3(-1, 0, -1), 0.5, mtl_idx=2),
+        Sphere(tm.vec3(1, 0, -1), 0.5, mtl_idx=3),
+        Sphere(tm.vec3(-1, 0, -1), -0.4, mtl_idx=2),
+    ]
+    aperture = 0.0
+    camera = Camera(tm.vec3(-2, 2, 1), 45.0, tm.vec3(-2, 2, 1), tm.vec3(0, 0, -1), tm.vec3(0, 1, 0), aperture / 2)
+    return materials, spheres, camera
+
+
+# the_next_week/main.cpp random_scene()
+def random_scene():
+    def rand3(min=0.0, max=1.0):
+        return tm.vec3(random.uniform(min, max), random.uniform(min, max), random.uniform(min, max))
+
+    glass = Material(2, ior=1.5)
+    materials = [Material(0, tm.vec3(0.5, 0.5, 0.5)), glass]
+    spheres = [Sphere(tm.vec3(0, -1000, 0), 1000, mtl_idx=0)]
+
+    def add_sphere(center, radius, mtl, **kwargs):
+        if mtl is not glass:
+            materials.append(mtl)
+        spheres.append(Sphere(center, radius, mtl_idx=1 if mtl is glass else len(materials) - 1, **kwargs))
+
+    for a in range(-11, 11):
+        for b in range(-11, 11):
+            choose_mat = random.random()
+            center = tm.vec3(a + 0.9 * random.random(), 0.2, b + 0.9 * random.random())
+            if (center - tm.vec3(4, 0.2, 0)).norm() > 0.9:
+                if choose_mat < 0.8:
+                    # diffuse, moving up during the shutter
+                    albedo = rand3() * rand3()
+                    add_sphere(center, 0.2, Material(0, albedo), velocity=tm.vec3(0, random.uniform(0, 0.5), 0))
+                elif choose_mat < 0.95:
+                    # metal
+                    add_sphere(center, 0.2, Material(1, rand3(0.5, 1), random.uniform(0, 0.5)))
+                else:
+                    # glass
+                    add_sphere(center, 0.2, glass)
+    add_sphere(tm.vec3(0, 1, 0), 1.0, glass)
+    add_sphere(tm.vec3(-4, 1, 0), 1.0, Material(0, tm.vec3(0.4, 0.2, 0.1)))
+    add_sphere(tm.vec3(4, 1, 0), 1.0, Material(1, tm.vec3(0.7, 0.6, 0.5), 0.0))
+
+    aperture = 0.1
+    camera = Camera(tm.vec3(13, 2, 3), 20.0, tm.vec3(13, 2, 3), tm.vec3(0, 0, 0), tm.vec3(0, 1, 0), aperture / 2,
+                    time0=0.0, time1=1.0)
+    return materials, spheres, camera
+
+
+scene_materials, scene, camera = random_scene() if MOTION_BLUR_SCENE else three_spheres()
+
+# material table, spheres only keep an index into it
+materials = Material.field(shape=len(scene_materials))
+for i, mtl in enumerate(scene_materials):
+    materials[i] = mtl
+
+objects_num = len(scene)
 objects = Sphere.field(shape=objects_num)
+for i, sphere in enumerate(scene):
+    sphere.obj_idx = i
+    objects[i] = sphere
 
-objects[0] = Sphere(tm.vec3(0, -100.5, -1), 100, mtl=Material(0, tm.vec3(0.8, 0.8, 0.0)), obj_idx=0)
-objects[1] = Sphere(tm.vec3(0, 0, -1), 0.5, mtl=Material(0, tm.vec3(0.7, 0.3, 0.3)), obj_idx=1)
-objects[2] = Sphere(tm.vec3(-1, 0, -1), 0.5, mtl=Material(2, ior=1.5), obj_idx=2)
-objects[3] = Sphere(tm.vec3(1, 0, -1), 0.5, mtl=Material(1, tm.vec3(0.8, 0.6, 0.2), 1.0), obj_idx=3)
-objects[4] = Sphere(tm.vec3(-1, 0, -1), -0.4, mtl=Material(2, ior=1.5), obj_idx=4)
 
-aperture = 0.0
+"""
+BVH, flattened in depth-first order. Every node stores its "miss" link: the node to visit next
+when the ray misses its box (the first node after its subtree). A hit simply moves on to the next node,
+so the traversal needs no stack.
+"""
+@ti.dataclass
+class BVHNode:
+    box: AABB
+    obj_idx: ti.i32   # -1 for interior nodes
+    miss: ti.i32
+
+
+bounding_boxes = AABB.field(shape=objects_num)
 
-camera = Camera(tm.vec3(-2, 2, 1), 45.0, tm.vec3(-2, 2, 1), tm.vec3(0, 0, -1), tm.vec3(0, 1, 0), aperture / 2)
+
+@ti.kernel
+def compute_bounding_boxes():
+    for i in range(objects_num):
+        bounding_boxes[i] = objects[i].bounding_box(camera.time0, camera.time1)
+
+
+def build_bvh():
+    compute_bounding_boxes()
+    boxes = bounding_boxes.to_numpy()
+    box_min, box_max = boxes['minimum'], boxes['maximum']
+    centroid = (box_min + box_max) / 2
+    nodes = []  # [min, max, obj_idx, miss]
+
+    def build(indices):
+        node = len(nodes)
+        nodes.append([box_min[indices].min(axis=0), box_max[indices].max(axis=0), -1, 0])
+        if len(indices) == 1:
+            nodes[node][2] = indices[0]
+        else:
+            # median split along the axis where the centroids spread the most
+            axis = (centroid[indices].max(axis=0) - centroid[indices].min(axis=0)).argmax()
+            indices = sorted(indices, key=lambda k: centroid[k][axis])
+            mid = len(indices) // 2
+            build(indices[:mid])
+            build(indices[mid:])
+        nodes[node][3] = len(nodes)
+
+    build(list(range(objects_num)))
+    bvh = BVHNode.field(shape=len(nodes))
+    bvh.from_numpy({
+        'box': {'minimum': np.array([n[0] for n in nodes], dtype=np.float32),
+                'maximum': np.array([n[1] for n in nodes], dtype=np.float32)},
+        'obj_idx': np.array([n[2] for n in nodes], dtype=np.int32),
+        'miss': np.array([n[3] for n in nodes], dtype=np.int32),
+    })
+    return bvh, len(nodes)
+
+
+bvh, bvh_num_nodes = build_bvh()
 
 
 @ti.func
@@ -276,11 +434,18 @@ def hit(ray) -> HitRecord:
     record = HitRecord(ray.origin, tm.vec3(0, 0, 0), T_MIN, False, 0)
     closest_so_far = T_MAX
 
-    for i in range(objects_num):
-        record = objects[i].hit(ray, T_MIN, closest_so_far)
-        if record.is_hit:
-            closest_so_far = record.t
-            ret = record
+    i = 0
+    while i < bvh_num_nodes:
+        node = bvh[i]
+        if node.box.hit(ray, T_MIN, closest_so_far):
+            if node.obj_idx >= 0:
+                record = objects[node.obj_idx].hit(ray, T_MIN, closest_so_far)
+                if record.is_hit:
+                    closest_so_far = record.t
+                    ret = record
+            i += 1
+        else:
+            i = node.miss
     return ret
 
 
@@ -300,7 +465,7 @@ def ray_color(ray) -> tm.vec3:
         record = hit(ray)
 
         if record.is_hit:
-            scatter_ret = objects[record.obj_idx].scatter(ray, record)
+            scatter_ret = materials[objects[record.obj_idx].mtl_idx].scatter(ray, record)
             ray = scatter_ret.ray
             attenuation = scatter_ret.attenuation
             is_out = scatter_ret.is_out
@@ -333,6 +498,43 @@ def render():
         image_pixels[i, j] = tm.sqrt(image_pixels[i, j])
 
 
+def turntable(camera, num_views):
+    # the camera turned around the y axis through lookat, k / num_views of a full circle for camera k
+    cameras = Camera.field(shape=num_views)
+    for k in range(num_views):
+        angle = 2 * math.pi * k / num_views
+        d = camera.lookfrom - camera.lookat
+        lookfrom = camera.lookat + tm.vec3(d.x * math.cos(angle) + d.z * math.sin(angle), d.y,
+                                           -d.x * math.sin(angle) + d.z * math.cos(angle))
+        cameras[k] = Camera(lookfrom, camera.vfov, lookfrom, camera.lookat, camera.vup, camera.lens_radius,
+                            camera.time0, camera.time1)
+    return cameras
+
+
+if NUM_VIEWS > 0:
+    cameras = turntable(camera, NUM_VIEWS)
+    view_pixels = ti.Vector.field(3, float, (NUM_VIEWS, *image_resolution))
+
+    @ti.kernel
+    def render_views():
+        # every camera into its own slice of the (view, x, y) film, one launch for all of them
+        for k, i, j in view_pixels:
+            u = (i + ti.random()) / (image_resolution[0] - 1)
+            v = (j + ti.random()) / (image_resolution[1] - 1)
+
+            for _ in range(SPP):
+                ray = cameras[k].get_ray(u, v)
+                view_pixels[k, i, j] += ray_color(ray)
+
+            view_pixels[k, i, j] /= SPP
+            view_pixels[k, i, j] = tm.sqrt(view_pixels[k, i, j])
+
+    render_views()
+    for k, img in enumerate(view_pixels.to_numpy()):
+        ti.tools.imwrite(np.clip(img, 0.0, 1.0), f'view_{k:03d}.png')
+    raise SystemExit
+
+
 window = ti.ui.Window("InOneWeekend", image_resolution)
 canvas = window.get_canvas()
 
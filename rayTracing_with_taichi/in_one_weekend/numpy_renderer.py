@@ -0,0 +1,406 @@
+import argparse
+import math
+import random
+import struct
+import time
+import zlib
+
+import numpy as np
+
+"""
+Taichi-free reference renderer of 03.py: the same scenes, camera and materials, as a wavefront pipeline in NumPy.
+
+A chunk of paths (pixel, sample) lives in arrays. Every bounce intersects all live rays with the spheres, shades
+each material with a mask, and compacts the rays that are still alive. Paths are processed CHUNK at a time.
+The spheres are sorted in Morton order and grouped in blocks of SPHERE_BLOCK (a very large sphere alone) with a bounding box: a block is only
+tested against the rays that enter its box before their closest hit so far, and GROUP_SIZE blocks share a box
+that culls the rays for all of them (memory stays at chunk x SPHERE_BLOCK).
+
+It reproduces ray_color of 03.py bounce for bounce, quirks included: near_zero() has no abs, and a path that
+is still alive after MAX_RAY_DEPTH bounces keeps its throughput instead of going black. Unlike render() of
+03.py every sample gets its own subpixel jitter, the result is the mean of the samples (linear, see to_image).
+
+Material:
+        0 : lambertian
+        1 : metal
+        2 : dielectric
+"""
+
+LAMBERTIAN, METAL, DIELECTRIC = 0, 1, 2
+T_MIN = 0.001
+MAX_RAY_DEPTH = 8
+CHUNK = 1 << 16
+SPHERE_BLOCK = 16
+GROUP_SIZE = 8
+
+
+class Scene:
+    # a material table and sphere arrays, built like three_spheres() / random_scene() of 03.py
+    def __init__(self):
+        self.materials = []  # (type, albedo, fuzz, ior)
+        self.spheres = []    # (center, radius, mtl_idx, velocity)
+        self.camera = None
+
+    def material(self, type, albedo=(0.0, 0.0, 0.0), fuzz=0.0, ior=0.0):
+        self.materials.append((type, albedo, fuzz, ior))
+        return len(self.materials) - 1
+
+    def sphere(self, center, radius, mtl_idx, velocity=(0.0, 0.0, 0.0)):
+        self.spheres.append((center, radius, mtl_idx, velocity))
+
+    def arrays(self):
+        self.mtl_type = np.array([m[0] for m in self.materials], dtype=np.int32)
+        self.mtl_albedo = np.array([m[1] for m in self.materials], dtype=np.float32).reshape(-1, 3)
+        self.mtl_fuzz = np.array([m[2] for m in self.materials], dtype=np.float32)
+        self.mtl_ior = np.array([m[3] for m in self.materials], dtype=np.float32)
+        self.center = np.array([s[0] for s in self.spheres], dtype=np.float32).reshape(-1, 3)
+        self.radius = np.array([s[1] for s in self.spheres], dtype=np.float32)
+        self.sphere_mtl = np.array([s[2] for s in self.spheres], dtype=np.int32)
+        self.velocity = np.array([s[3] for s in self.spheres], dtype=np.float32).reshape(-1, 3)
+        self.moving = bool(np.any(self.velocity != 0))
+        # spheres in Morton order of their centers, so that the blocks of SPHERE_BLOCK spheres are compact;
+        # a sphere much larger than the others (a ground) gets a block of its own, its box would cover everything
+        r = np.abs(self.radius)
+        large = r > 10 * np.median(r)
+        order = np.concatenate([np.nonzero(large)[0], np.nonzero(~large)[0][np.argsort(morton3(self.center[~large]), kind='stable')]])
+        self.center, self.radius, self.sphere_mtl, self.velocity = \
+            self.center[order], self.radius[order], self.sphere_mtl[order], self.velocity[order]
+        num_large = int(large.sum())
+        self.blocks = [(k, k + 1) for k in range(num_large)] + \
+            [(k, min(k + SPHERE_BLOCK, len(r))) for k in range(num_large, len(r), SPHERE_BLOCK)]
+        # block bounds over the shutter interval
+        r = np.abs(self.radius)[:, None]
+        c0 = self.center + self.camera.time0 * self.velocity
+        c1 = self.center + self.camera.time1 * self.velocity
+        lo, hi = np.minimum(c0, c1) - r, np.maximum(c0, c1) + r
+        self.block_min = np.array([lo[start:end].min(axis=0) for start, end in self.blocks], dtype=np.float32)
+        self.block_max = np.array([hi[start:end].max(axis=0) for start, end in self.blocks], dtype=np.float32)
+        # and GROUP_SIZE consecutive blocks share a box that is tested first
+        self.groups = [(k, min(k + GROUP_SIZE, len(self.blocks))) for k in range(0, len(self.blocks), GROUP_SIZE)]
+        self.group_min = np.array([self.block_min[first:last].min(axis=0) for first, last in self.groups])
+        self.group_max = np.array([self.block_max[first:last].max(axis=0) for first, last in self.groups])
+        return self
+
+
+class Camera:
+    def __init__(self, lookfrom, lookat, vup, vfov, aspect_ratio, lens_radius=0.0, time0=0.0, time1=0.0):
+        lookfrom, lookat, vup = (np.array(x, dtype=np.float32) for x in (lookfrom, lookat, vup))
+        h = math.tan(math.radians(vfov) / 2)
+        viewport_height = 2.0 * h
+        viewport_width = aspect_ratio * viewport_height
+        w = lookfrom - lookat
+        dist_to_focus = np.linalg.norm(w)
+        w /= dist_to_focus
+        self.u = np.cross(vup, w)
+        self.u /= np.linalg.norm(self.u)
+        self.v = np.cross(w, self.u)
+        self.origin = lookfrom
+        self.horizontal = dist_to_focus * viewport_width * self.u
+        self.vertical = dist_to_focus * viewport_height * self.v
+        self.lower_left_corner = lookfrom - self.horizontal / 2 - self.vertical / 2 - dist_to_focus * w
+        self.lens_radius = lens_radius
+        self.time0, self.time1 = time0, time1
+
+    def get_rays(self, s, t, rng):
+        n = len(s)
+        rd = self.lens_radius * random_in_unit_disk(n, rng)
+        offset = self.u * rd[:, :1] + self.v * rd[:, 1:]
+        origins = self.origin + offset
+        directions = normalize(self.lower_left_corner + s[:, None] * self.horizontal + t[:, None] * self.vertical - origins)
+        times = rng.uniform(self.time0, self.time1, n).astype(np.float32) if self.time1 > self.time0 else np.full(n, self.time0, np.float32)
+        return origins.astype(np.float32), directions.astype(np.float32), times
+
+
+def three_spheres(aspect_ratio):
+    scene = Scene()
+    ground = scene.material(LAMBERTIAN, (0.8, 0.8, 0.0))
+    center = scene.material(LAMBERTIAN, (0.7, 0.3, 0.3))
+    glass = scene.material(DIELECTRIC, ior=1.5)
+    gold = scene.material(METAL, (0.8, 0.6, 0.2), 1.0)
+    scene.sphere((0, -100.5, -1), 100, ground)
+    scene.sphere((0, 0, -1), 0.5, center)
+    scene.sphere((-1, 0, -1), 0.5, glass)
+    scene.sphere((1, 0, -1), 0.5, gold)
+    scene.sphere((-1, 0, -1), -0.4, glass)
+    scene.camera = Camera((-2, 2, 1), (0, 0, -1), (0, 1, 0), 45.0, aspect_ratio)
+    return scene.arrays()
+
+
+def random_scene(aspect_ratio, seed=0):
+    # the_next_week/main.cpp random_scene(), the diffuse spheres move up while the shutter is open
+    rnd = random.Random(seed)
+
+    def rand3(min=0.0, max=1.0):
+        return tuple(rnd.uniform(min, max) for _ in range(3))
+
+    scene = Scene()
+    scene.sphere((0, -1000, 0), 1000, scene.material(LAMBERTIAN, (0.5, 0.5, 0.5)))
+    glass = scene.material(DIELECTRIC, ior=1.5)
+    for a in range(-11, 11):
+        for b in range(-11, 11):
+            choose_mat = rnd.random()
+            center = (a + 0.9 * rnd.random(), 0.2, b + 0.9 * rnd.random())
+            if math.dist(center, (4, 0.2, 0)) > 0.9:
+                if choose_mat < 0.8:
+                    albedo = tuple(x * y for x, y in zip(rand3(), rand3()))
+                    scene.sphere(center, 0.2, scene.material(LAMBERTIAN, albedo), velocity=(0, rnd.uniform(0, 0.5), 0))
+                elif choose_mat < 0.95:
+                    scene.sphere(center, 0.2, scene.material(METAL, rand3(0.5, 1), rnd.uniform(0, 0.5)))
+                else:
+                    scene.sphere(center, 0.2, glass)
+    scene.sphere((0, 1, 0), 1.0, glass)
+    scene.sphere((-4, 1, 0), 1.0, scene.material(LAMBERTIAN, (0.4, 0.2, 0.1)))
+    scene.sphere((4, 1, 0), 1.0, scene.material(METAL, (0.7, 0.6, 0.5), 0.0))
+    aperture = 0.1
+    scene.camera = Camera((13, 2, 3), (0, 0, 0), (0, 1, 0), 20.0, aspect_ratio, aperture / 2, 0.0, 1.0)
+    return scene.arrays()
+
+
+SCENES = {"three_spheres": three_spheres, "random": random_scene}
+
+
+def morton3(points, bits=10):
+    # Morton code of points quantized to 2^bits cells per axis of their bounds
+    lo, hi = points.min(axis=0), points.max(axis=0)
+    q = ((points - lo) / np.maximum(hi - lo, 1e-6) * ((1 << bits) - 1)).astype(np.int64)
+    code = np.zeros(len(points), dtype=np.int64)
+    for bit in range(bits):
+        for axis in range(3):
+            code |= ((q[:, axis] >> bit) & 1) << (3 * bit + axis)
+    return code
+
+
+def normalize(v):
+    return v / np.linalg.norm(v, axis=-1, keepdims=True)
+
+
+def dot(a, b):
+    return np.einsum('ij,ij->i', a, b)
+
+
+def random_unit_vec(n, rng):
+    return normalize(rng.standard_normal((n, 3)).astype(np.float32))
+
+
+def random_in_unit_sphere(n, rng):
+    # the same distribution as the rejection sampling of 03.py
+    return random_unit_vec(n, rng) * np.cbrt(rng.random(n, dtype=np.float32))[:, None]
+
+
+def random_in_unit_disk(n, rng):
+    r = np.sqrt(rng.random(n, dtype=np.float32))
+    phi = rng.random(n, dtype=np.float32) * np.float32(2 * math.pi)
+    return np.stack([r * np.cos(phi), r * np.sin(phi)], axis=-1)
+
+
+def hit_spheres(scene, origins, directions, times):
+    # closest hit of every ray, t = inf / sphere -1 for a miss
+    n = len(origins)
+    closest = np.full(n, np.inf, dtype=np.float32)
+    index = np.full(n, -1, dtype=np.int32)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inv_d = 1.0 / directions
+    for g, (first, last) in enumerate(scene.groups):
+        group_rays = np.nonzero(enters(origins, inv_d, scene.group_min[g], scene.group_max[g], closest))[0]
+        if len(group_rays) == 0:
+            continue
+        group_origins, group_inv_d = origins[group_rays], inv_d[group_rays]
+        for b in range(first, last):
+            start, end = scene.blocks[b]
+            rays = group_rays[enters(group_origins, group_inv_d, scene.block_min[b], scene.block_max[b], closest[group_rays])]
+            if len(rays) == 0:
+                continue
+            hit_block(scene, start, end, rays, origins, directions, times, closest, index)
+    return closest, index
+
+
+def enters(origins, inv_d, box_min, box_max, closest):
+    # the rays that enter the box before their closest hit so far
+    t0 = (box_min - origins) * inv_d
+    t1 = (box_max - origins) * inv_d
+    with np.errstate(invalid='ignore'):
+        near, far = np.minimum(t0, t1), np.maximum(t0, t1)
+        # per column, a reduction over an axis of length 3 is slow in numpy
+        t_near = np.maximum(np.maximum(near[:, 0], near[:, 1]), near[:, 2])
+        t_far = np.minimum(np.minimum(far[:, 0], far[:, 1]), far[:, 2])
+    return (t_near <= t_far) & (t_far >= T_MIN) & (t_near < closest)
+
+
+def hit_block(scene, start, end, rays, origins, directions, times, closest, index):
+    # spheres start:end against the rays, updates closest / index
+    block = slice(start, end)
+    if scene.moving:
+        center = scene.center[None, block] + times[rays, None, None] * scene.velocity[None, block]
+    else:
+        center = scene.center[None, block]
+    d = directions[rays]
+    oc = origins[rays, None] - center
+    a = dot(d, d)[:, None]
+    half_b = np.einsum('rsk,rk->rs', oc, d)
+    c = np.einsum('rsk,rsk->rs', oc, oc) - scene.radius[block] ** 2
+    discriminant = half_b * half_b - a * c
+    sqrtd = np.sqrt(np.maximum(discriminant, 0))
+    root = (-half_b - sqrtd) / a
+    far = (-half_b + sqrtd) / a
+    root = np.where(root < T_MIN, far, root)
+    root = np.where((discriminant >= 0) & (root >= T_MIN), root, np.inf)
+    k = root.argmin(axis=1)
+    t = root[np.arange(len(rays)), k]
+    closer = t < closest[rays]
+    closest[rays[closer]] = t[closer]
+    index[rays[closer]] = start + k[closer]
+
+
+def reflect(v, n):
+    return v - 2 * dot(v, n)[:, None] * n
+
+
+def refract(uv, n, etai_over_etat):
+    cos_theta = np.minimum(dot(-uv, n), 1.0)
+    r_out_perp = etai_over_etat[:, None] * (uv + cos_theta[:, None] * n)
+    r_out_parallel = -np.sqrt(np.abs(1.0 - dot(r_out_perp, r_out_perp)))[:, None] * n
+    return r_out_perp + r_out_parallel
+
+
+def reflectance(cosine, ref_idx):
+    r0 = ((1 - ref_idx) / (1 + ref_idx)) ** 2
+    return r0 + (1 - r0) * (1 - cosine) ** 5
+
+
+def scatter(scene, mtl, directions, pos, normal, front_face, rng):
+    # returns the new directions, the attenuation and which rays go on (Material.scatter of 03.py, per mask)
+    n = len(mtl)
+    kind = scene.mtl_type[mtl]
+    new_dir = np.empty_like(directions)
+    attenuation = np.ones((n, 3), dtype=np.float32)
+    alive = np.ones(n, dtype=bool)
+
+    m = kind == LAMBERTIAN
+    if m.any():
+        scatter_dir = normal[m] + random_unit_vec(m.sum(), rng)
+        near_zero = np.all(scatter_dir < 1e-8, axis=1)  # as in 03.py, without abs
+        scatter_dir[near_zero] = normal[m][near_zero]
+        new_dir[m] = normalize(scatter_dir)
+        attenuation[m] = scene.mtl_albedo[mtl[m]]
+
+    m = kind == METAL
+    if m.any():
+        reflected = reflect(directions[m], normal[m])
+        d = normalize(reflected + scene.mtl_fuzz[mtl[m]][:, None] * random_in_unit_sphere(m.sum(), rng))
+        new_dir[m] = d
+        attenuation[m] = scene.mtl_albedo[mtl[m]]
+        alive[m] = dot(d, normal[m]) > 0
+
+    m = kind == DIELECTRIC
+    if m.any():
+        ior = scene.mtl_ior[mtl[m]]
+        ratio = np.where(front_face[m], 1.0 / ior, ior).astype(np.float32)
+        d_in, nm = directions[m], normal[m]
+        cos_theta = np.minimum(dot(-d_in, nm), 1.0)
+        sin_theta = np.sqrt(np.maximum(1.0 - cos_theta * cos_theta, 0.0))
+        reflects = (ratio * sin_theta > 1.0) | (reflectance(cos_theta, ratio) > rng.random(m.sum(), dtype=np.float32))
+        new_dir[m] = normalize(np.where(reflects[:, None], reflect(d_in, nm), refract(d_in, nm, ratio)))
+    return new_dir, attenuation, alive
+
+
+def trace(scene, origins, directions, times, rng, max_depth=MAX_RAY_DEPTH):
+    # ray_color of 03.py for a batch of camera rays
+    color = np.zeros((len(origins), 3), dtype=np.float32)
+    throughput = np.ones((len(origins), 3), dtype=np.float32)
+    path = np.arange(len(origins))  # the path each live ray belongs to
+    for _ in range(max_depth):
+        if len(path) == 0:
+            break
+        t, sphere = hit_spheres(scene, origins, directions, times)
+        missed = sphere < 0
+        # sky
+        sky_t = 0.5 * (directions[missed, 1] + 1.0)
+        color[path[missed]] = throughput[missed] * ((1.0 - sky_t)[:, None] + sky_t[:, None] * np.array([0.5, 0.7, 1.0], np.float32))
+        hit = ~missed
+        path, origins, directions, times, throughput, t, sphere = \
+            path[hit], origins[hit], directions[hit], times[hit], throughput[hit], t[hit], sphere[hit]
+        pos = origins + t[:, None] * directions
+        if scene.moving:
+            center = scene.center[sphere] + times[:, None] * scene.velocity[sphere]
+        else:
+            center = scene.center[sphere]
+        outward = (pos - center) / scene.radius[sphere][:, None]
+        front_face = dot(directions, outward) < 0
+        normal = np.where(front_face[:, None], outward, -outward)
+        directions, attenuation, alive = scatter(scene, scene.sphere_mtl[sphere], directions, pos, normal, front_face, rng)
+        throughput = throughput * attenuation
+        # compaction: absorbed rays (metal below the surface) leave black
+        path, origins, directions, times, throughput = path[alive], pos[alive], directions[alive], times[alive], throughput[alive]
+    # 03.py returns the throughput of a path that is still bouncing after max_depth
+    color[path] = throughput
+    return color
+
+
+def render(scene, width, height, spp, max_depth=MAX_RAY_DEPTH, seed=0, chunk=CHUNK):
+    # the linear mean of spp samples per pixel, (width, height, 3) like the taichi films
+    rng = np.random.default_rng(seed)
+    total = width * height * spp
+    image = np.zeros((width * height, 3), dtype=np.float64)
+    for start in range(0, total, chunk):
+        sample = np.arange(start, min(start + chunk, total))
+        pixel = sample // spp
+        i, j = pixel // height, pixel % height
+        s = (i + rng.random(len(sample), dtype=np.float32)) / (width - 1)
+        t = (j + rng.random(len(sample), dtype=np.float32)) / (height - 1)
+        origins, directions, times = scene.camera.get_rays(s, t, rng)
+        color = trace(scene, origins, directions, times, rng, max_depth)
+        for c in range(3):
+            image[pixel[0]:pixel[-1] + 1, c] += np.bincount(pixel - pixel[0], weights=color[:, c])
+    return (image / spp).reshape(width, height, 3).astype(np.float32)
+
+
+def to_image(linear):
+    # the gamma of 03.py
+    return np.sqrt(np.clip(linear, 0.0, 1.0))
+
+
+def write_png(path, img):
+    # img: (width, height, 3) in [0, 1], taichi layout (x to the right, y up)
+    rgb = (np.clip(img, 0.0, 1.0) * 255).astype(np.uint8).transpose(1, 0, 2)[::-1]
+    height, width = rgb.shape[:2]
+    raw = b''.join(b'\x00' + row.tobytes() for row in rgb)
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+                chunk(b'IDAT', zlib.compress(raw, 6)) + chunk(b'IEND', b''))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='NumPy reference renderer of 03.py')
+    parser.add_argument(
+        '--scene', type=str, default='three_spheres', choices=list(SCENES), help='(default: three_spheres)')
+    parser.add_argument(
+        '--width', type=int, default=960, help='(default: 960)')
+    parser.add_argument(
+        '--height', type=int, default=540, help='(default: 540)')
+    parser.add_argument(
+        '--spp', type=int, default=16, help='samples per pixel (default: 16)')
+    parser.add_argument(
+        '--max_depth', type=int, default=MAX_RAY_DEPTH, help=f'(default: {MAX_RAY_DEPTH})')
+    parser.add_argument(
+        '--chunk', type=int, default=CHUNK, help=f'paths traced together, bounds the memory (default: {CHUNK})')
+    parser.add_argument(
+        '--seed', type=int, default=0, help='random seed (default: 0)')
+    parser.add_argument(
+        '--out', type=str, default='ret_numpy.png', help='output image (default: ret_numpy.png)')
+    parser.add_argument(
+        '--npy', type=str, default=None, help='also save the linear image (width, height, 3) to this .npy')
+    args = parser.parse_args()
+
+    scene = SCENES[args.scene](args.width / args.height)
+    start = time.perf_counter()
+    linear = render(scene, args.width, args.height, args.spp, args.max_depth, args.seed, args.chunk)
+    elapsed = time.perf_counter() - start
+    print(f'{args.width}x{args.height}, {args.spp} spp: {elapsed:.1f} s, '
+          f'{args.width * args.height * args.spp / elapsed / 1e6:.2f} Msamples/s')
+    write_png(args.out, to_image(linear))
+    if args.npy is not None:
+        np.save(args.npy, linear)
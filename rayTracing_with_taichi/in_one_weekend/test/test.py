@@ -1,65 +1,384 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
 import taichi as ti
 import taichi.math as tm
-from typing import Tuple
 
-ti.init(arch=ti.gpu)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'path_tracing_taichi'))
+
+from ray_tracing_tools import Ray, random_in_unit_sphere, random_unit_vector
+from object import Material, Sphere, Plane, Cube, DIFFUSE, METAL, GLASS, FUZZ_METAL
+from path_tracing import PathTracer
+
+'''
+    Micro-benchmark and correctness harness of the hot functions of path_tracing_taichi:
+        hit      : Sphere.hit, Plane.hit, Cube.hit
+        scatter  : the diffuse, metal, fuzz metal and glass branches of PathTracer.scatter
+        sampler  : random_in_unit_sphere, random_unit_vector
+    Every routine runs over millions of random rays (samples) in one kernel launch, its results are checked
+    against the analytic answer (an f64 NumPy reference of the intersection, the moments of the distribution
+    a sampler / scatter branch has to follow) and it is timed in ns per ray.
+
+    The timing kernels only reduce the results to a sum, "load" is what just reading the rays costs, the rest of
+    a routine's time is its own. CPU backend by default, so that an optimization of a function is measured
+    without the noise of a full render:
+        python test.py --rays 4194304 --only sphere,glass
+'''
+
+T_MIN = 0.001
+T_MAX = 10e8
+
+
+# PathTracer.scatter only reads sample_on_unit_sphere_surface, a PathTracer without a scene is enough for it
+@ti.data_oriented
+class Scatterer(PathTracer):
+    def __init__(self, sample_on_unit_sphere_surface=True):
+        self.sample_on_unit_sphere_surface = sample_on_unit_sphere_surface
+
+
+def reference_sphere(o, d, center, radius):
+    oc = o - center
+    a = np.sum(d * d, axis=1)
+    b = 2.0 * np.sum(oc * d, axis=1)
+    c = np.sum(oc * oc, axis=1) - radius * radius
+    disc = b * b - 4 * a * c
+    sqrtd = np.sqrt(np.maximum(disc, 0.0))
+    near = (-b - sqrtd) / (2 * a)
+    far = (-b + sqrtd) / (2 * a)
+    near_ok = (near >= T_MIN) & (near <= T_MAX)
+    far_ok = (far >= T_MIN) & (far <= T_MAX)
+    hit = (disc > 0) & (near_ok | far_ok)
+    t = np.where(near_ok, near, far)
+    p = o + t[:, None] * d
+    outward = (p - center) / radius
+    front = np.sum(d * outward, axis=1) < 0
+    normal = np.where(front[:, None], outward, -outward)
+    return hit, t, p, normal, front
+
+
+def reference_plane(o, d, center, normal, width):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.sum((center - o) * normal, axis=1) / np.sum(d * normal, axis=1)
+    p = o + t[:, None] * d
+    inside = np.all(np.abs(p - center) < width / 2, axis=1)
+    hit = (t > T_MIN) & (t < T_MAX) & inside
+    front = np.sum(d * normal, axis=1) < 0
+    return hit, t, p, np.broadcast_to(normal, p.shape), front
+
+
+def reference_cube(o, d, center, width):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inv = 1.0 / d
+        t0 = (center - width / 2 - o) * inv
+        t1 = (center + width / 2 - o) * inv
+    near = np.minimum(t0, t1)
+    far = np.maximum(t0, t1)
+    t_enter, t_exit = near.max(axis=1), far.min(axis=1)
+    enter_axis, exit_axis = near.argmax(axis=1), far.argmin(axis=1)
+    enter_ok = (t_enter > T_MIN) & (t_enter < T_MAX)
+    exit_ok = (t_exit > T_MIN) & (t_exit < T_MAX)
+    hit = (t_enter <= t_exit) & (enter_ok | exit_ok)
+    t = np.where(enter_ok, t_enter, t_exit)
+    axis = np.where(enter_ok, enter_axis, exit_axis)
+    p = o + t[:, None] * d
+    normal = np.zeros_like(p)
+    rows = np.arange(len(p))
+    normal[rows, axis] = np.sign(p[rows, axis] - center[axis])
+    return hit, t, p, normal, enter_ok
+
+
+class Report:
+    def __init__(self):
+        self.failures = []
+
+    def check(self, routine, name, ok, detail=''):
+        if not ok:
+            self.failures.append(f'{routine}: {name} {detail}')
+        return ok
+
+
+def within(value, expected, sigma, report, routine, name, k=5.0):
+    # a Monte Carlo estimate has to land within k standard errors of the analytic value
+    return report.check(routine, name, abs(value - expected) <= k * sigma + 1e-6,
+                        f'{value:.6f}, expected {expected:.6f} +- {k * sigma:.6f}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='primitive, material and sampler micro-benchmarks')
+    parser.add_argument(
+        '--rays', type=int, default=1 << 22, help='rays (samples) per routine (default: 4M)')
+    parser.add_argument(
+        '--repeats', type=int, default=10, help='timed launches per routine (default: 10)')
+    parser.add_argument(
+        '--only', type=str, default='', help='comma separated routines to run (default: all)')
+    parser.add_argument(
+        '--arch', type=str, default='cpu', help='taichi arch: cpu, gpu, cuda, vulkan (default: cpu)')
+    parser.add_argument(
+        '--seed', type=int, default=0, help='random seed (default: 0)')
+    args = parser.parse_args()
+
+    ti.init(arch=getattr(ti, args.arch), random_seed=args.seed)
+    n = args.rays
+
+    origin = ti.Vector.field(3, dtype=ti.f32, shape=n)
+    direction = ti.Vector.field(3, dtype=ti.f32, shape=n)
+    out_flag = ti.field(dtype=ti.i32, shape=n)    # is_hit / is_scattered
+    out_front = ti.field(dtype=ti.i32, shape=n)
+    out_t = ti.field(dtype=ti.f32, shape=n)
+    out_vec = ti.Vector.field(3, dtype=ti.f32, shape=n)  # hit point / scattered direction / sample
+    out_normal = ti.Vector.field(3, dtype=ti.f32, shape=n)
+
+    spheres = Sphere.field(shape=1)
+    planes = Plane.field(shape=1)
+    cubes = Cube.field(shape=1)
+    scatterers = {True: Scatterer(True), False: Scatterer(False)}
+
+    @ti.kernel
+    def make_rays(origin_extent: tm.vec3, target_extent: tm.vec3):
+        # origins all around the primitive (some inside it), aimed at a box a little larger than it:
+        # hits, misses, grazing rays and rays starting inside; the directions are not normalized on purpose
+        for i in range(n):
+            o = (2.0 * tm.vec3(ti.random(), ti.random(), ti.random()) - 1.0) * origin_extent
+            target = (2.0 * tm.vec3(ti.random(), ti.random(), ti.random()) - 1.0) * target_extent
+            origin[i] = o
+            direction[i] = (target - o) * (0.5 + ti.random())
+
+    @ti.kernel
+    def make_incident(both_sides: ti.i32):
+        # unit directions coming in against the normal (0, 0, 1), for glass half of them leave the inside
+        for i in range(n):
+            d = random_unit_vector()
+            d.z = -ti.abs(d.z)
+            origin[i] = tm.vec3(0.0, 0.0, 0.0)
+            direction[i] = d
+            out_front[i] = 1
+            if both_sides and i % 2 == 1:
+                out_front[i] = 0
+
+    @ti.kernel
+    def record_hits(prims: ti.template()):
+        for i in range(n):
+            is_hit, t, p, normal, front_face, _ = prims[0].hit(Ray(origin[i], direction[i]), T_MIN, T_MAX)
+            out_flag[i] = ti.cast(is_hit, ti.i32)
+            out_t[i] = t
+            out_vec[i] = p
+            out_normal[i] = normal
+            out_front[i] = ti.cast(front_face, ti.i32)
+
+    @ti.kernel
+    def time_hits(prims: ti.template()) -> ti.f32:
+        total = 0.0
+        for i in range(n):
+            is_hit, t, _, _, _, _ = prims[0].hit(Ray(origin[i], direction[i]), T_MIN, T_MAX)
+            if is_hit:
+                total += t
+        return total
 
+    @ti.kernel
+    def time_load() -> ti.f32:
+        total = 0.0
+        for i in range(n):
+            total += origin[i].x + direction[i].y
+        return total
 
-@ti.dataclass
-class Base:
-    pos: tm.vec3
-    dir: tm.vec3
+    @ti.kernel
+    def record_scatter(scatterer: ti.template(), kind: ti.i32, color: tm.vec3, fuzz: ti.f32, ior: ti.f32):
+        normal = tm.vec3(0.0, 0.0, 1.0)
+        for i in range(n):
+            mtl = Material(type=kind, color=color, fuzz=fuzz, ior=ior, light=-1, texture=-1)
+            is_scattered, _, scattered, attenuation = scatterer.scatter(mtl, direction[i], origin[i], normal, out_front[i] == 1)
+            out_flag[i] = ti.cast(is_scattered, ti.i32)
+            out_vec[i] = scattered
+            out_normal[i] = attenuation
 
+    @ti.kernel
+    def time_scatter(scatterer: ti.template(), kind: ti.i32, color: tm.vec3, fuzz: ti.f32, ior: ti.f32) -> ti.f32:
+        normal = tm.vec3(0.0, 0.0, 1.0)
+        total = 0.0
+        for i in range(n):
+            mtl = Material(type=kind, color=color, fuzz=fuzz, ior=ior, light=-1, texture=-1)
+            is_scattered, _, scattered, _ = scatterer.scatter(mtl, direction[i], origin[i], normal, out_front[i] == 1)
+            if is_scattered:
+                total += scattered.z
+        return total
 
-base = Base(tm.vec3(2.0, 0.0, 0.0))
-# print(base.pos)
-# print(base.dir)
+    @ti.kernel
+    def record_sampler(which: ti.template()):
+        for i in range(n):
+            out_vec[i] = which()
 
+    @ti.kernel
+    def time_sampler(which: ti.template()) -> ti.f32:
+        total = 0.0
+        for i in range(n):
+            total += which().z
+        return total
 
-@ti.func
-def randf_range(min, max) -> ti.f32:
-    return min + (max - min) * ti.random()
+    def timed(kernel, *kernel_args):
+        kernel(*kernel_args)  # compile
+        ti.sync()
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            kernel(*kernel_args)
+        ti.sync()
+        return (time.perf_counter() - start) / args.repeats / n * 1e9
 
+    report = Report()
+    rows = []
 
-@ti.func
-def randvec3_range(min, max) -> tm.vec3:
-    return tm.vec3(randf_range(min, max), randf_range(min, max), randf_range(min, max))
+    def compare_hits(routine, got, expected):
+        hit, t, p, normal, front = got
+        ref_hit, ref_t, ref_p, ref_normal, ref_front = expected
+        # f32 against f64: rays grazing a silhouette or an edge may flip, nothing else
+        mismatch = np.count_nonzero(hit != ref_hit)
+        report.check(routine, 'hit / miss', mismatch <= max(10, n * 1e-4), f'{mismatch} of {n} rays disagree')
+        both = hit & ref_hit
+        scale = np.maximum(1.0, np.abs(ref_t[both]))
+        t_err = np.max(np.abs(t[both] - ref_t[both]) / scale, initial=0.0)
+        p_err = np.max(np.linalg.norm(p[both] - ref_p[both], axis=1) / scale, initial=0.0)
+        n_err = np.max(np.linalg.norm(normal[both] - ref_normal[both], axis=1), initial=0.0)
+        report.check(routine, 't', t_err < 1e-3, f'relative error {t_err:.2e}')
+        report.check(routine, 'hit point', p_err < 1e-3, f'relative error {p_err:.2e}')
+        # the axis of an edge hit of the cube is a tie, compare the normals away from the edges
+        bad_normals = np.count_nonzero(np.linalg.norm(normal[both] - ref_normal[both], axis=1) > 1e-3)
+        report.check(routine, 'normal', bad_normals <= max(10, n * 1e-4), f'{bad_normals} normals off, max {n_err:.2e}')
+        bad_front = np.count_nonzero(front[both] != ref_front[both])
+        report.check(routine, 'front_face', bad_front <= max(10, n * 1e-4), f'{bad_front} disagree')
+        return f'{np.count_nonzero(hit) / n:.1%} hit, t err {t_err:.1e}'
 
+    def run_hit(routine, prims, origin_extent, target_extent, reference):
+        make_rays(tm.vec3(origin_extent), tm.vec3(target_extent))
+        record_hits(prims)
+        o = origin.to_numpy().astype(np.float64)
+        d = direction.to_numpy().astype(np.float64)
+        got = (out_flag.to_numpy() == 1, out_t.to_numpy().astype(np.float64), out_vec.to_numpy().astype(np.float64),
+               out_normal.to_numpy().astype(np.float64), out_front.to_numpy() == 1)
+        note = compare_hits(routine, got, reference(o, d))
+        rows.append((routine, timed(time_hits, prims), timed(time_load), note))
 
-@ti.func
-def random_in_unit_sphere() -> tm.vec3:
-    p = tm.vec3(0, 0, 0)
-    while True:
-        p = randvec3_range(-1.0, 1.0)
-        if tm.length(p) >= 1:
-            continue
-        break
-    return p
+    def scattered_rays(routine, scatterer, kind, color, fuzz, ior):
+        record_scatter(scatterer, kind, tm.vec3(color), fuzz, ior)
+        d = direction.to_numpy().astype(np.float64)
+        s = out_vec.to_numpy().astype(np.float64)
+        report.check(routine, 'attenuation', np.allclose(out_normal.to_numpy(), color), 'is not the albedo')
+        return d, s, out_flag.to_numpy() == 1, out_front.to_numpy() == 1
 
+    def reflect_np(d):
+        r = d.copy()
+        r[:, 2] = -r[:, 2]  # the normal is (0, 0, 1)
+        return r
 
-@ti.func
-def test_base() -> Base:
-    base = Base(tm.vec3(1, 0, 0), tm.vec3(0, 1, 0))
-    # base.pos = tm.vec3(2, 2, 2)
-    return base
+    def run_diffuse(routine, on_surface):
+        make_incident(0)
+        d, s, scattered, _ = scattered_rays(routine, scatterers[on_surface], DIFFUSE, (0.5, 0.6, 0.7), 0.0, 1.0)
+        report.check(routine, 'scattered', scattered.all(), 'a diffuse bounce was absorbed')
+        if on_surface:
+            # normal + a point on the unit sphere is cosine distributed: E[cos] = 2/3, E[cos^2] = 1/2
+            length = np.linalg.norm(s, axis=1)
+            cos = s[length > 1e-6, 2] / length[length > 1e-6]
+            report.check(routine, 'hemisphere', cos.min() >= -1e-4, f'min cos {cos.min():.2e}')
+            within(cos.mean(), 2 / 3, np.sqrt(1 / 18 / len(cos)), report, routine, 'E[cos]')
+            within((cos ** 2).mean(), 1 / 2, np.sqrt(1 / 12 / len(cos)), report, routine, 'E[cos^2]')
+            note = f'E[cos] {cos.mean():.4f} (2/3)'
+        else:
+            # normal + a point in the unit ball: above the surface, E[direction] = normal
+            report.check(routine, 'hemisphere', s[:, 2].min() > 0, f'min z {s[:, 2].min():.2e}')
+            for axis, expected in enumerate((0.0, 0.0, 1.0)):
+                within(s[:, axis].mean(), expected, np.sqrt(1 / 5 / n), report, routine, f'E[direction {"xyz"[axis]}]')
+            note = f'E[z] {s[:, 2].mean():.4f} (1)'
+        rows.append((routine, timed(time_scatter, scatterers[on_surface], DIFFUSE, tm.vec3(0.5, 0.6, 0.7), 0.0, 1.0),
+                     timed(time_load), note))
 
+    def run_metal(routine, kind, fuzz):
+        make_incident(0)
+        d, s, scattered, _ = scattered_rays(routine, scatterers[True], kind, (0.8, 0.8, 0.8), fuzz, 1.0)
+        r = reflect_np(d)
+        # the fuzz moves the mirror direction onto a sphere of radius fuzz around it
+        offset = np.abs(np.linalg.norm(s - r, axis=1) - fuzz).max()
+        report.check(routine, 'mirror + fuzz', offset < 1e-4, f'|scattered - reflected| off by {offset:.2e}')
+        above = s[:, 2] >= 0
+        report.check(routine, 'absorbed below the surface', np.array_equal(scattered, above),
+                     f'{np.count_nonzero(scattered != above)} disagree')
+        rows.append((routine, timed(time_scatter, scatterers[True], kind, tm.vec3(0.8, 0.8, 0.8), fuzz, 1.0),
+                     timed(time_load), f'{np.count_nonzero(~scattered) / n:.1%} absorbed'))
 
-@ti.func
-def test_00() -> Tuple[Base, tm.vec3]:
-    base = Base(tm.vec3(1, 0, 0), tm.vec3(0, 1, 0))
-    # base.pos = tm.vec3(2, 2, 2)
-    return base, tm.vec3(1, 2, 3)
+    def run_glass(routine, ior):
+        make_incident(1)
+        d, s, scattered, front = scattered_rays(routine, scatterers[True], GLASS, (1.0, 1.0, 1.0), 0.0, ior)
+        ratio = np.where(front, 1 / ior, ior)
+        cos = np.minimum(-d[:, 2], 1.0)
+        sin = np.sqrt(1 - cos * cos)
+        r0 = ((1 - ratio) / (1 + ratio)) ** 2
+        p_reflect = np.where(ratio * sin > 1.0, 1.0, r0 + (1 - r0) * (1 - cos) ** 5)
+        reflected = np.linalg.norm(s - reflect_np(d), axis=1) < 1e-4
+        report.check(routine, 'scattered', scattered.all(), 'glass absorbed a ray')
+        # Snell: the refracted ray keeps the tangential component, scaled by the ratio of the indices
+        refracted = ~reflected
+        snell = np.abs(np.linalg.norm(s[refracted, :2], axis=1) - ratio[refracted] * sin[refracted]).max(initial=0.0)
+        report.check(routine, 'snell', snell < 1e-3, f'tangential error {snell:.2e}')
+        report.check(routine, 'refracted side', (s[refracted, 2] <= 1e-6).all(), 'a refracted ray went back')
+        within(reflected.mean(), p_reflect.mean(), np.sqrt(np.sum(p_reflect * (1 - p_reflect))) / n,
+               report, routine, 'reflected fraction (Schlick)')
+        rows.append((routine, timed(time_scatter, scatterers[True], GLASS, tm.vec3(1.0, 1.0, 1.0), 0.0, ior),
+                     timed(time_load), f'{reflected.mean():.1%} reflected ({p_reflect.mean():.1%})'))
 
+    def run_sampler(routine, which, in_ball):
+        record_sampler(which)
+        p = out_vec.to_numpy().astype(np.float64)
+        r2 = np.sum(p * p, axis=1)
+        for axis in range(3):
+            within(p[:, axis].mean(), 0.0, np.sqrt((1 / 5 if in_ball else 1 / 3) / n), report, routine, f'E[{"xyz"[axis]}]')
+        if in_ball:
+            # uniform in the ball: E[r^2] = 3/5, 1/8 of the samples within r = 1/2
+            report.check(routine, 'inside', r2.max() < 1.0, f'max r^2 {r2.max():.6f}')
+            within(r2.mean(), 3 / 5, np.sqrt((3 / 7 - 9 / 25) / n), report, routine, 'E[r^2]')
+            within(np.mean(r2 < 0.25), 1 / 8, np.sqrt(1 / 8 * 7 / 8 / n), report, routine, 'P(r < 1/2)')
+            note = f'E[r^2] {r2.mean():.4f} (0.6)'
+        else:
+            # uniform on the sphere: unit length, E[z^2] = 1/3, 1/4 of the samples with z > 1/2
+            report.check(routine, 'unit length', np.abs(r2 - 1).max() < 1e-5, f'max |r^2 - 1| {np.abs(r2 - 1).max():.2e}')
+            within(np.mean(p[:, 2] ** 2), 1 / 3, np.sqrt((1 / 5 - 1 / 9) / n), report, routine, 'E[z^2]')
+            within(np.mean(p[:, 2] > 0.5), 1 / 4, np.sqrt(1 / 4 * 3 / 4 / n), report, routine, 'P(z > 1/2)')
+            note = f'E[z^2] {np.mean(p[:, 2] ** 2):.4f} (1/3)'
+        rows.append((routine, timed(time_sampler, which), 0.0, note))
 
-@ti.kernel
-def test():
-    base, color = test_00()
-    # print(base.pos)
-    # print(base.dir)
-    # print(color)
-    a = tm.vec3(1, 2, 3)
-    b = tm.vec3(2, 2, 2)
-    print(a * b)
+    spheres[0] = Sphere(center=tm.vec3(0.0, 0.0, 0.0), radius=1.0, material=0)
+    planes[0] = Plane(center=tm.vec3(0.0, 0.0, 0.0), normal=tm.vec3(0.0, 0.0, 1.0), material=0, width=2.0, height=2.0)
+    cubes[0] = Cube(center=tm.vec3(0.0, 0.0, 0.0), material=0, width=2.0)
+    center = np.zeros(3)
 
+    routines = {
+        'sphere': lambda: run_hit('sphere', spheres, (3.0, 3.0, 3.0), (1.5, 1.5, 1.5),
+                                  lambda o, d: reference_sphere(o, d, center, 1.0)),
+        'plane': lambda: run_hit('plane', planes, (3.0, 3.0, 3.0), (1.5, 1.5, 0.0),
+                                 lambda o, d: reference_plane(o, d, center, np.array([0.0, 0.0, 1.0]), 2.0)),
+        'cube': lambda: run_hit('cube', cubes, (3.0, 3.0, 3.0), (1.5, 1.5, 1.5),
+                                lambda o, d: reference_cube(o, d, center, 2.0)),
+        'diffuse': lambda: run_diffuse('diffuse', True),
+        'diffuse_ball': lambda: run_diffuse('diffuse_ball', False),
+        'metal': lambda: run_metal('metal', METAL, 0.0),
+        'fuzz_metal': lambda: run_metal('fuzz_metal', FUZZ_METAL, 0.3),
+        'glass': lambda: run_glass('glass', 1.5),
+        'unit_sphere': lambda: run_sampler('unit_sphere', random_unit_vector, False),
+        'unit_ball': lambda: run_sampler('unit_ball', random_in_unit_sphere, True),
+    }
+    selected = [name.strip() for name in args.only.split(',') if name.strip()] or list(routines)
+    for name in selected:
+        if name not in routines:
+            raise SystemExit(f"unknown routine {name}, expected one of {', '.join(routines)}")
 
-test()
+    print(f'{args.arch}, {n} rays per routine, {args.repeats} launches; ns per ray, load = reading the rays')
+    print(f'{"routine":<14} {"ns/ray":>8} {"load":>6} {"Mrays/s":>8}  check')
+    for name in selected:
+        before = len(report.failures)
+        routines[name]()
+        routine, ns, load, note = rows[-1]
+        status = 'ok' if len(report.failures) == before else 'FAIL'
+        print(f'{routine:<14} {ns:>8.2f} {load:>6.2f} {1e3 / ns:>8.1f}  {status}  {note}')
+    for failure in report.failures:
+        print(f'FAIL {failure}')
+    if report.failures:
+        raise SystemExit(1)
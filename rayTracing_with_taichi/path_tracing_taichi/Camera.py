@@ -1,32 +1,68 @@
+import math
+
 import taichi as ti
 from ray_tracing_tools import Ray, PI
+from frustum import make_frustum
 
+# A camera array: num_views cameras that share the aspect ratio, view 0 is the camera of the interactive
+# renderer. Every method takes the view, defaulting to 0 (see PathTracer.render_views for the batched use).
 @ti.data_oriented
 class Camera:
-    def __init__(self, fov=60, aspect_ratio=1.0):
+    def __init__(self, fov=60, aspect_ratio=1.0, num_views=1):
+        self.num_views = num_views
         # Camera parameters
-        self.lookfrom = ti.Vector.field(3, dtype=ti.f32, shape=())
-        self.lookat = ti.Vector.field(3, dtype=ti.f32, shape=())
-        self.vup = ti.Vector.field(3, dtype=ti.f32, shape=())
-        self.fov = fov
-        self.aspect_ratio = aspect_ratio
+        self.lookfrom = ti.Vector.field(3, dtype=ti.f32, shape=num_views)
+        self.lookat = ti.Vector.field(3, dtype=ti.f32, shape=num_views)
+        self.vup = ti.Vector.field(3, dtype=ti.f32, shape=num_views)
+        # fov / aspect_ratio live in fields so that one compiled kernel serves every resolution
+        self.fov = ti.field(dtype=ti.f32, shape=num_views)
+        self.aspect_ratio = ti.field(dtype=ti.f32, shape=())
+        self.fov.fill(fov)
+        self.aspect_ratio[None] = aspect_ratio
+
+        self.cam_lower_left_corner = ti.Vector.field(3, dtype=ti.f32, shape=num_views)  # 左下角
+        self.cam_horizontal = ti.Vector.field(3, dtype=ti.f32, shape=num_views)  # 水平
+        self.cam_vertical = ti.Vector.field(3, dtype=ti.f32, shape=num_views)  # 垂直
+        self.cam_origin = ti.Vector.field(3, dtype=ti.f32, shape=num_views)
 
-        self.cam_lower_left_corner = ti.Vector.field(3, dtype=ti.f32, shape=())  # 左下角
-        self.cam_horizontal = ti.Vector.field(3, dtype=ti.f32, shape=())  # 水平
-        self.cam_vertical = ti.Vector.field(3, dtype=ti.f32, shape=())  # 垂直
-        self.cam_origin = ti.Vector.field(3, dtype=ti.f32, shape=())
+    def set_aspect_ratio(self, aspect_ratio):
+        self.aspect_ratio[None] = aspect_ratio
 
     @ti.kernel
     def reset(self, new_ori : ti.types.vector(3, ti.f32)):
-        self.lookfrom[None] = new_ori
-        self.lookat[None] = [0.0, 1.0, -1.0]
-        self.vup[None] = [0.0, 1.0, 0.0]
-        # distance = (self.lookat[None] - self.lookfrom[None]).norm()
+        self.lookfrom[0] = new_ori
+        self.lookat[0] = [0.0, 1.0, -1.0]
+        self.vup[0] = [0.0, 1.0, 0.0]
+        self.update(0)
+
+    def look_at(self, new_ori, new_lookat, new_fov, view=0):
+        self.look_at_view(view, new_ori, new_lookat, new_fov)
+
+    @ti.kernel
+    def look_at_view(self, view : ti.i32, new_ori : ti.types.vector(3, ti.f32), new_lookat : ti.types.vector(3, ti.f32), new_fov : ti.f32):
+        self.lookfrom[view] = new_ori
+        self.lookat[view] = new_lookat
+        self.vup[view] = [0.0, 1.0, 0.0]
+        self.fov[view] = new_fov
+        self.update(view)
+
+    def turntable(self, lookfrom, lookat, fov):
+        # view k looks at lookat from lookfrom turned by k / num_views of a full circle around the y axis
+        for k in range(self.num_views):
+            angle = 2 * PI * k / self.num_views
+            dx, dz = lookfrom[0] - lookat[0], lookfrom[2] - lookat[2]
+            rotated = [lookat[0] + dx * math.cos(angle) + dz * math.sin(angle), lookfrom[1],
+                       lookat[2] - dx * math.sin(angle) + dz * math.cos(angle)]
+            self.look_at_view(k, ti.math.vec3(rotated), ti.math.vec3(lookat), fov)
+
+    @ti.func
+    def update(self, view):
+        # distance = (self.lookat[view] - self.lookfrom[view]).norm()
         # hey, there is a trick that we view the distance as 1
-        theta = self.fov * (PI / 180.0)
+        theta = self.fov[view] * (PI / 180.0)
         half_height = ti.tan(theta / 2.0)
-        half_width = self.aspect_ratio * half_height
-        self.cam_origin[None] = self.lookfrom[None]
+        half_width = self.aspect_ratio[None] * half_height
+        self.cam_origin[view] = self.lookfrom[view]
         """
                             ^ (v)
                             |
@@ -38,17 +74,59 @@ class Camera:
                          /
                         (w) 
         """
-        w = (self.lookfrom[None] - self.lookat[None]).normalized()  # gaze at -y
-        u = (self.vup[None].cross(w)).normalized()
+        w = (self.lookfrom[view] - self.lookat[view]).normalized()  # gaze at -y
+        u = (self.vup[view].cross(w)).normalized()
         v = w.cross(u) # up at y
-        self.cam_lower_left_corner[None] = ti.Vector([-half_width, -half_height, -1.0])
-        distance = ti.math.sqrt((self.lookat[None] - self.lookfrom[None]).norm())
-        self.cam_lower_left_corner[None] = self.cam_origin[None] - half_width * u - half_height * v - w
-        # print(self.cam_lower_left_corner[None])
-        self.cam_horizontal[None] = 2 * half_width * u
-        self.cam_vertical[None] = 2 * half_height * v
+        self.cam_lower_left_corner[view] = ti.Vector([-half_width, -half_height, -1.0])
+        distance = ti.math.sqrt((self.lookat[view] - self.lookfrom[view]).norm())
+        self.cam_lower_left_corner[view] = self.cam_origin[view] - half_width * u - half_height * v - w
+        # print(self.cam_lower_left_corner[view])
+        self.cam_horizontal[view] = 2 * half_width * u
+        self.cam_vertical[view] = 2 * half_height * v
+
+    @ti.func
+    def get_ray(self, u, v, view=0):
+        return Ray(self.cam_origin[view], self.cam_lower_left_corner[view] + u * self.cam_horizontal[view] + v * self.cam_vertical[view] - self.cam_origin[view])
+
+    # the angle one of height pixels spans at the center of the image, the spread of the ray cones of PathTracer.ray_color
+    @ti.func
+    def pixel_spread(self, height, view=0):
+        return self.cam_vertical[view].norm() / height
+
+    # from the origin to the center of the image plane (length 1)
+    @ti.func
+    def forward(self, view=0):
+        return self.cam_lower_left_corner[view] + (self.cam_horizontal[view] + self.cam_vertical[view]) / 2 - self.cam_origin[view]
 
+    # (u, v) of the get_ray that passes through point, (-1, -1) behind the camera
     @ti.func
-    def get_ray(self, u, v):
-        return Ray(self.cam_origin[None], self.cam_lower_left_corner[None] + u * self.cam_horizontal[None] + v * self.cam_vertical[None] - self.cam_origin[None])
+    def project(self, point, view=0):
+        d = point - self.cam_origin[view]
+        depth = d.dot(self.forward(view))
+        uv = ti.Vector([-1.0, -1.0])
+        if depth > 0:
+            q = self.cam_origin[view] + d / depth - self.cam_lower_left_corner[view]
+            uv = ti.Vector([q.dot(self.cam_horizontal[view]) / self.cam_horizontal[view].norm_sqr(),
+                            q.dot(self.cam_vertical[view]) / self.cam_vertical[view].norm_sqr()])
+        return uv
 
+    # for light tracing: importance W = 1 / (A cos^4) the camera emits along direction (normalized) and the
+    # solid angle pdf 1 / (A cos^3) of get_ray at a uniform (u, v), A the area of the image plane; 0 off the image
+    @ti.func
+    def importance(self, direction, view=0):
+        importance = 0.0
+        pdf = 0.0
+        cos_theta = direction.dot(self.forward(view))
+        uv = self.project(self.cam_origin[view] + direction, view)
+        if cos_theta > 0 and 0 <= uv.x <= 1 and 0 <= uv.y <= 1:
+            area = self.cam_horizontal[view].norm() * self.cam_vertical[view].norm()
+            pdf = 1 / (area * cos_theta ** 3)
+            importance = pdf / cos_theta
+        return importance, pdf
+
+
+    # the rays of get_ray(u, v) for u in [u0, u1], v in [v0, v1] all lie inside this frustum
+    @ti.func
+    def get_frustum(self, u0, v0, u1, v1, view=0):
+        return make_frustum(self.cam_origin[view], self.get_ray(u0, v0, view).direction, self.get_ray(u1, v0, view).direction,
+                            self.get_ray(u0, v1, view).direction, self.get_ray(u1, v1, view).direction)
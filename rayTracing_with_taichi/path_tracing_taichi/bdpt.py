@@ -0,0 +1,328 @@
+import taichi as ti
+import taichi.math as tm
+from ray_tracing_tools import Ray, PI, random_unit_vector
+from object import LIGHT, DIFFUSE
+from path_tracing import PathTracer, image_width, image_height
+
+'''
+    Bidirectional path tracing (Veach 1997, in the formulation of pbrt-v3): every sample traces a camera
+    subpath and a light subpath and joins every prefix of one with every prefix of the other, a path with
+    s light vertices and t camera vertices is
+        s = 0 : the camera subpath hits a light
+        s = 1 : a point sampled on a light (LightSet.select / sample) is connected to the camera subpath
+        t = 1 : light tracing, the light subpath vertex is projected on the film and splatted to its pixel
+        else  : the two end vertices are connected by a shadow ray
+    All strategies that produce a path are weighted with the balance heuristic, from the area pdfs every
+    vertex stores for being sampled by its own subpath (pdf_fwd) and from the other end (pdf_rev).
+
+    Diffuse vertices are connected, metal, fuzzy metal and glass ones are treated as specular and only
+    scattered through. The environment is only found by the camera subpath (s = 0).
+    Light subpaths start on a light picked by power, uniform on its surface, cosine distributed.
+    Every pixel traces one light subpath per sample: the splats of width * height of them estimate the
+    whole image, pixels are processed BATCH at a time.
+'''
+
+MAX_VERTICES = 12  # per subpath, paths are at most MAX_VERTICES - 2 bounces long
+BATCH = 1 << 15
+
+# subpaths
+CAMERA_PATH = 0
+LIGHT_PATH = 1
+# vertices
+CAMERA_VERTEX = 0
+LIGHT_VERTEX = 1
+SURFACE_VERTEX = 2
+
+
+@ti.dataclass
+class PathVertex:
+    point: tm.vec3
+    normal: tm.vec3   # as returned by Scene.hit, of the light for a light vertex, the view direction for the camera
+    beta: tm.vec3     # throughput of the subpath up to the vertex
+    pdf_fwd: ti.f32   # area density of the vertex sampled by its subpath
+    pdf_rev: ti.f32   # area density of the vertex sampled from the other end of the path
+    kind: ti.i32
+    material: ti.i32
+    delta: ti.i32     # specular, cannot be connected
+
+
+@ti.func
+def remap0(pdf):
+    return pdf if pdf != 0 else 1.0
+
+
+@ti.data_oriented
+class BidirectionalPathTracer(PathTracer):
+    def __init__(self, scene, camera, width=image_width, height=image_height, sample_on_unit_sphere_surface=True,
+                 batch=BATCH, film_layout='dense', film_storage='aos'):
+        super().__init__(scene, camera, width, height, sample_on_unit_sphere_surface, film_layout=film_layout,
+                         film_storage=film_storage)
+        self.batch = min(batch, width * height)
+        self.vertices = PathVertex.field(shape=(2, self.batch, MAX_VERTICES))
+        self.num_vertices = ti.field(dtype=ti.i32, shape=(2, self.batch))
+
+    def render(self, width, height, samples_per_pixel, max_depth):
+        max_depth = min(max_depth, MAX_VERTICES - 2)
+        for _ in range(samples_per_pixel):
+            for offset in range(0, width * height, self.batch):
+                self.render_batch(width, height, offset, min(self.batch, width * height - offset), max_depth)
+
+    @ti.kernel
+    def render_batch(self, width: ti.i32, height: ti.i32, offset: ti.i32, count: ti.i32, max_depth: ti.i32):
+        for b in range(count):
+            i = (offset + b) // height
+            j = (offset + b) % height
+            ray = self.camera.get_ray((i + ti.random()) / width, (j + ti.random()) / height)
+            color = self.camera_subpath(b, ray, max_depth)
+            self.light_subpath(b, max_depth)
+            for t in range(1, self.num_vertices[CAMERA_PATH, b] + 1):
+                for s in range(self.num_vertices[LIGHT_PATH, b] + 1):
+                    depth = s + t - 2
+                    if (s == 1 and t == 1) or depth < 0 or depth > max_depth:
+                        continue
+                    color += self.connect(b, s, t, width, height)
+            self.canvas[i, j] += color
+            self.sample_count[i, j] += 1
+
+    # solid angle density -> area density at vertex
+    @ti.func
+    def to_area(self, pdf, origin, vertex):
+        d = vertex.point - origin
+        dist2 = d.dot(d)
+        if vertex.kind != CAMERA_VERTEX:
+            pdf *= ti.abs(vertex.normal.normalized().dot(d)) / ti.sqrt(dist2)
+        return pdf / dist2
+
+    # Lambertian on the side the light arrives from, wo and wi point away from the vertex
+    @ti.func
+    def bsdf(self, vertex, wo, wi):
+        f = ti.Vector([0.0, 0.0, 0.0])
+        mtl = self.scene.materials[vertex.material]
+        if mtl.type == DIFFUSE and vertex.normal.dot(wo) * vertex.normal.dot(wi) > 0:
+            f = mtl.color / PI
+        return f
+
+    @ti.func
+    def connectible(self, vertex):
+        return vertex.kind == SURFACE_VERTEX and self.scene.materials[vertex.material].type == DIFFUSE
+
+    # area density at next of sampling it from vertex, which was reached from prev
+    @ti.func
+    def pdf(self, vertex, prev, next):
+        pdf = 0.0
+        w = (next.point - vertex.point).normalized()
+        if vertex.kind == CAMERA_VERTEX:
+            _, pdf = self.camera.importance(w)
+        elif vertex.kind == LIGHT_VERTEX:
+            pdf = ti.abs(vertex.normal.normalized().dot(w)) / PI
+        elif self.connectible(vertex):
+            wo = (prev.point - vertex.point).normalized()
+            if vertex.normal.dot(wo) * vertex.normal.dot(w) > 0:
+                pdf = ti.abs(vertex.normal.normalized().dot(w)) / PI
+        return self.to_area(pdf, vertex.point, next)
+
+    # area density of a light subpath starting at a point of the light
+    @ti.func
+    def light_origin_pdf(self, light):
+        lights = self.scene.lights
+        return lights.lights[light].power / lights.total_power[None] / lights.area(light)
+
+    # fills the vertices of a subpath from its first one, returns the radiance of the environment if the
+    # camera subpath escapes
+    @ti.func
+    def random_walk(self, path, b, ray, start_beta, start_pdf, max_vertices):
+        radiance = ti.Vector([0.0, 0.0, 0.0])
+        origin = ray.origin
+        direction = ray.direction
+        beta = start_beta
+        pdf_dir = start_pdf
+        n = 1
+        while n < max_vertices:
+            is_hit, hit_point, hit_point_normal, front_face, material = self.scene.hit(Ray(origin, direction))
+            if not is_hit:
+                if path == CAMERA_PATH:
+                    radiance = beta * self.environment_light(direction, 0.0)
+                break
+            mtl = self.scene.materials[material]
+            if path == LIGHT_PATH and mtl.type == LIGHT:
+                break
+            prev = self.vertices[path, b, n - 1]
+            vertex = PathVertex(hit_point, hit_point_normal, beta, 0.0, 0.0, SURFACE_VERTEX, material, 0)
+            vertex.pdf_fwd = self.to_area(pdf_dir, prev.point, vertex)
+            self.vertices[path, b, n] = vertex
+            n += 1
+            if mtl.type == LIGHT or n == max_vertices:
+                break
+            wo = -direction.normalized()
+            pdf_rev = 0.0
+            if mtl.type == DIFFUSE:
+                # cosine distributed on the side of wo
+                normal = hit_point_normal if hit_point_normal.dot(wo) > 0 else -hit_point_normal
+                direction = (normal + random_unit_vector()).normalized()
+                pdf_dir = normal.dot(direction) / PI
+                pdf_rev = normal.dot(wo) / PI
+                beta *= mtl.color
+                if pdf_dir <= 0:
+                    break
+            else:
+                is_scattered, _, scattered_direction, attenuation = self.scatter(mtl, direction, hit_point, hit_point_normal, front_face)
+                if not is_scattered:
+                    break
+                direction = scattered_direction.normalized()
+                beta *= attenuation
+                pdf_dir = 0.0
+                self.vertices[path, b, n - 1].delta = 1
+            self.vertices[path, b, n - 2].pdf_rev = self.to_area(pdf_rev, hit_point, prev)
+            origin = hit_point
+        self.num_vertices[path, b] = n
+        return radiance
+
+    @ti.func
+    def camera_subpath(self, b, ray, max_depth):
+        direction = ray.direction.normalized()
+        self.vertices[CAMERA_PATH, b, 0] = PathVertex(ray.origin, self.camera.forward(), ti.Vector([1.0, 1.0, 1.0]), 1.0, 0.0,
+                                                      CAMERA_VERTEX, -1, 0)
+        _, pdf = self.camera.importance(direction)
+        return self.random_walk(CAMERA_PATH, b, Ray(ray.origin, direction), ti.Vector([1.0, 1.0, 1.0]), pdf, max_depth + 2)
+
+    @ti.func
+    def light_subpath(self, b, max_depth):
+        self.num_vertices[LIGHT_PATH, b] = 0
+        if self.scene.lights.num_lights[None] > 0:
+            light, prob = self.scene.lights.select_by_power()
+            point, normal, material = self.scene.lights.sample_point(light)
+            area = self.scene.lights.area(light)
+            vertex = PathVertex(point, normal, self.scene.materials[material].color * area / prob, prob / area, 0.0,
+                                LIGHT_VERTEX, material, 0)
+            self.vertices[LIGHT_PATH, b, 0] = vertex
+            direction = (normal + random_unit_vector()).normalized()
+            # radiance * cos / (pdf of the point * pdf of the cosine distributed direction)
+            self.random_walk(LIGHT_PATH, b, Ray(point, direction), vertex.beta * PI, normal.dot(direction) / PI, max_depth + 1)
+
+    @ti.func
+    def visible(self, p, q):
+        d = q - p
+        distance = d.norm()
+        is_hit, _, _, _, _ = self.scene.hit(Ray(p, d / distance), 0.001, distance * (1 - 1e-3))
+        return not is_hit
+
+    # contribution of the path of s light and t camera vertices, light tracing (t = 1) splats it and returns 0
+    @ti.func
+    def connect(self, b, s, t, width, height):
+        pt = self.vertices[CAMERA_PATH, b, t - 1]
+        qs = self.vertices[LIGHT_PATH, b, ti.max(s - 1, 0)]
+        contribution = ti.Vector([0.0, 0.0, 0.0])
+        pixel = ti.Vector([0, 0])
+        if s == 0:
+            mtl = self.scene.materials[pt.material]
+            if mtl.type == LIGHT:
+                contribution = pt.beta * mtl.color
+        elif t == 1:
+            if self.connectible(qs):
+                uv = self.camera.project(qs.point)
+                if 0 <= uv.x < 1 and 0 <= uv.y < 1:
+                    pixel = ti.min(ti.cast(uv * ti.Vector([width, height]), ti.i32), ti.Vector([width - 1, height - 1]))
+                    origin = self.camera.cam_origin[0]
+                    d = origin - qs.point
+                    dist2 = d.dot(d)
+                    wi = d / ti.sqrt(dist2)
+                    importance, _ = self.camera.importance(-wi)
+                    # the camera end, sampled with the solid angle pdf dist2 / cos
+                    pt = PathVertex(origin, self.camera.forward(), ti.Vector([1.0, 1.0, 1.0]) * importance * self.camera.forward().dot(-wi) / dist2,
+                                    0.0, 0.0, CAMERA_VERTEX, -1, 0)
+                    wo = (self.vertices[LIGHT_PATH, b, s - 2].point - qs.point).normalized()
+                    contribution = qs.beta * self.bsdf(qs, wo, wi) * pt.beta * ti.abs(qs.normal.normalized().dot(wi))
+                    if contribution.any() and not self.visible(qs.point, origin):
+                        contribution = ti.Vector([0.0, 0.0, 0.0])
+        elif s == 1:
+            if self.connectible(pt):
+                wo = (self.vertices[CAMERA_PATH, b, t - 2].point - pt.point).normalized()
+                normal = pt.normal if pt.normal.dot(wo) > 0 else -pt.normal
+                light, select_pdf = self.scene.lights.select(pt.point, normal)
+                direction, emission, pdf = self.scene.lights.sample(light, pt.point)
+                if pdf > 0 and select_pdf > 0:
+                    # visible if the first thing the ray hits is that light
+                    is_hit, hit_point, hit_point_normal, _, material = self.scene.hit(Ray(pt.point, direction))
+                    if is_hit and self.scene.materials[material].light == light:
+                        qs = PathVertex(hit_point, hit_point_normal, emission / (select_pdf * pdf), self.light_origin_pdf(light), 0.0,
+                                        LIGHT_VERTEX, material, 0)
+                        contribution = pt.beta * self.bsdf(pt, wo, direction) * qs.beta * ti.abs(pt.normal.normalized().dot(direction))
+        else:
+            if self.connectible(pt) and self.connectible(qs):
+                d = qs.point - pt.point
+                dist2 = d.dot(d)
+                w = d / ti.sqrt(dist2)
+                wo_camera = (self.vertices[CAMERA_PATH, b, t - 2].point - pt.point).normalized()
+                wo_light = (self.vertices[LIGHT_PATH, b, s - 2].point - qs.point).normalized()
+                g = ti.abs(pt.normal.normalized().dot(w)) * ti.abs(qs.normal.normalized().dot(w)) / dist2
+                contribution = qs.beta * self.bsdf(qs, wo_light, -w) * self.bsdf(pt, wo_camera, w) * pt.beta * g
+                if contribution.any() and not self.visible(pt.point, qs.point):
+                    contribution = ti.Vector([0.0, 0.0, 0.0])
+        if contribution.any():
+            contribution *= self.mis_weight(b, s, t, pt, qs)
+        if t == 1:
+            if contribution.any():
+                self.canvas[pixel.x, pixel.y] += contribution
+            contribution = ti.Vector([0.0, 0.0, 0.0])
+        return contribution
+
+    # balance heuristic over the strategies (s + t - 1 others) that could have sampled the same path,
+    # pt / qs: the end vertices of the connection, which replace the stored ones for t = 1 / s = 1
+    @ti.func
+    def mis_weight(self, b, s, t, pt, qs):
+        weight = 1.0
+        emitter_light = 0
+        if s == 0:
+            emitter_light = self.scene.materials[pt.material].light
+        if s + t > 2 and emitter_light >= 0:
+            pt_minus = self.vertices[CAMERA_PATH, b, ti.max(t - 2, 0)]
+            qs_minus = self.vertices[LIGHT_PATH, b, ti.max(s - 2, 0)]
+            # reverse pdfs of the connection vertices and of the ones before them, for this connection
+            pt_rev = 0.0
+            pt_minus_rev = 0.0
+            qs_rev = 0.0
+            qs_minus_rev = 0.0
+            if s > 0:
+                pt_rev = self.pdf(qs, qs_minus, pt)
+                qs_rev = self.pdf(pt, pt_minus, qs)
+                if t > 1:
+                    pt_minus_rev = self.pdf(pt, qs, pt_minus)
+                if s > 1:
+                    qs_minus_rev = self.pdf(qs, pt, qs_minus)
+            else:
+                # the light the camera subpath hit, as the start of a light subpath
+                pt_rev = self.light_origin_pdf(emitter_light)
+                emitter = pt
+                emitter.kind = LIGHT_VERTEX
+                pt_minus_rev = self.pdf(emitter, pt, pt_minus)
+            total = 0.0
+            ratio = 1.0
+            for k in range(t - 1):
+                i = t - 1 - k
+                vertex = self.vertices[CAMERA_PATH, b, i]
+                pdf_rev = vertex.pdf_rev
+                if i == t - 1:
+                    pdf_rev = pt_rev
+                elif i == t - 2:
+                    pdf_rev = pt_minus_rev
+                ratio *= remap0(pdf_rev) / remap0(vertex.pdf_fwd)
+                if (vertex.delta == 0 or i == t - 1) and self.vertices[CAMERA_PATH, b, i - 1].delta == 0:
+                    total += ratio
+            ratio = 1.0
+            for k in range(s):
+                i = s - 1 - k
+                vertex = self.vertices[LIGHT_PATH, b, i]
+                pdf_rev = vertex.pdf_rev
+                if i == s - 1:
+                    vertex = qs
+                    pdf_rev = qs_rev
+                elif i == s - 2:
+                    pdf_rev = qs_minus_rev
+                ratio *= remap0(pdf_rev) / remap0(vertex.pdf_fwd)
+                previous_delta = 0
+                if i > 0:
+                    previous_delta = self.vertices[LIGHT_PATH, b, i - 1].delta
+                if (vertex.delta == 0 or i == s - 1) and previous_delta == 0:
+                    total += ratio
+            weight = 1 / (1 + total)
+        return weight
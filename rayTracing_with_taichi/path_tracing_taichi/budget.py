@@ -0,0 +1,84 @@
+import numpy as np
+
+'''
+    Frame time controller of the interactive loop.
+
+    Every frame renders at 1 / scale of the resolution with spp samples per pixel (plan()), and reports how long the
+    frame took (update()). The cost of a sample is tracked as an exponential moving average of
+        frame time / (pixels * spp)
+    and spp is chosen so that the next frame lands on the target frame time (between 1 and max_spp).
+
+    A camera move (moved()) drops to the coarsest preview scale, so moving shows a cheap low resolution image
+    instead of full resolution one sample noise. Once the camera settles and a scale has min_samples samples per
+    pixel, the next finer scale takes over, down to the full resolution, where the image keeps converging.
+    A change of scale restarts the accumulation (changed_scale()).
+'''
+
+SCALES = (4, 2, 1)
+
+
+class FrameBudget:
+    def __init__(self, width, height, target_ms, max_spp=64, scales=SCALES, min_samples=4, smoothing=0.3):
+        self.width = width
+        self.height = height
+        self.target_ms = target_ms
+        self.max_spp = max_spp
+        self.scales = scales
+        self.min_samples = min_samples
+        self.smoothing = smoothing
+        self.ms_per_sample = None  # per pixel and sample, unknown until the first frame
+        self.level = 0             # index into scales, the first frames are a preview as well
+        self.samples = 0           # per pixel, at the current scale
+        self.spp = 1
+        self.previous_scale = None
+
+    @property
+    def scale(self):
+        return self.scales[self.level]
+
+    def resolution(self):
+        # the preview covers the whole image: ceil, the upscaled image is cropped
+        return -(-self.width // self.scale), -(-self.height // self.scale)
+
+    def moved(self):
+        self.level = 0
+        self.samples = 0
+
+    def settle(self):
+        # straight to the full resolution, e.g. for a resumed render
+        self.level = len(self.scales) - 1
+        self.previous_scale = self.scale
+
+    def plan(self):
+        # (width, height, spp) of the next frame
+        if self.level < len(self.scales) - 1 and self.samples >= self.min_samples:
+            self.level += 1
+            self.samples = 0
+        width, height = self.resolution()
+        if self.ms_per_sample is None:
+            self.spp = 1
+        else:
+            self.spp = int(np.clip(self.target_ms / (self.ms_per_sample * width * height), 1, self.max_spp))
+        return width, height, self.spp
+
+    def changed_scale(self):
+        # True once after every change of scale, the accumulation has to restart then
+        changed = self.scale != self.previous_scale
+        self.previous_scale = self.scale
+        return changed
+
+    def update(self, frame_ms):
+        width, height = self.resolution()
+        cost = frame_ms / (width * height * self.spp)
+        if self.ms_per_sample is None:
+            self.ms_per_sample = cost
+        else:
+            self.ms_per_sample += self.smoothing * (cost - self.ms_per_sample)
+        self.samples += self.spp
+
+    def upscale(self, img):
+        # nearest neighbour back to the full resolution
+        s = self.scale
+        if s == 1:
+            return img
+        return np.repeat(np.repeat(img, s, axis=0), s, axis=1)[:self.width, :self.height]
@@ -0,0 +1,96 @@
+import taichi as ti
+import taichi.math as tm
+import numpy as np
+
+'''
+    BVH flattened in depth-first order. Every node stores its "miss" link: the node to visit next when
+    the ray misses its box (the first node after its subtree). A hit simply moves on to the next node,
+    so the traversal needs no stack:
+
+        i = begin
+        while i < end:
+            if hit_aabb(nodes[i].box_min, nodes[i].box_max, ...):
+                if nodes[i].prim >= 0: test the primitive
+                i += 1
+            else:
+                i = nodes[i].miss
+'''
+
+# leaf kinds
+SPHERE = 0
+PLANE = 1
+CUBE = 2
+INSTANCE = 3
+
+
+@ti.dataclass
+class BVHNode:
+    box_min: tm.vec3
+    box_max: tm.vec3
+    kind: ti.i32   # SPHERE / PLANE / CUBE / INSTANCE
+    prim: ti.i32   # index of the primitive (or instance), -1 for interior nodes
+    miss: ti.i32
+
+
+# one int per thing a ray can hit: a world primitive by kind and index, instanced geometry by instance
+@ti.func
+def primitive_id(kind, index):
+    return index * 4 + kind
+
+
+@ti.func
+def hit_aabb(box_min, box_max, ray, t_min, t_max):
+    inv_d = 1.0 / ray.direction
+    t0 = (box_min - ray.origin) * inv_d
+    t1 = (box_max - ray.origin) * inv_d
+    t_near = tm.min(t0, t1)
+    t_far = tm.max(t0, t1)
+    t_min = tm.max(t_min, tm.max(t_near.x, tm.max(t_near.y, t_near.z)))
+    t_max = tm.min(t_max, tm.min(t_far.x, tm.min(t_far.y, t_far.z)))
+    return t_min <= t_max
+
+
+def build_bvh(box_min, box_max, kind, prim, offset=0):
+    # box_min / box_max: (n, 3), kind / prim: (n,) of the leaves; offset is added to every miss link,
+    # so that several BVHs can share one node field. Returns the node arrays, ready for BVHNode.from_numpy
+    box_min = np.asarray(box_min, dtype=np.float32).reshape(-1, 3)
+    box_max = np.asarray(box_max, dtype=np.float32).reshape(-1, 3)
+    centroid = (box_min + box_max) / 2
+    nodes_min, nodes_max, nodes_kind, nodes_prim, nodes_miss = [], [], [], [], []
+
+    def build(indices):
+        node = len(nodes_min)
+        nodes_min.append(box_min[indices].min(axis=0))
+        nodes_max.append(box_max[indices].max(axis=0))
+        nodes_kind.append(-1)
+        nodes_prim.append(-1)
+        nodes_miss.append(0)
+        if len(indices) == 1:
+            nodes_kind[node] = kind[indices[0]]
+            nodes_prim[node] = prim[indices[0]]
+        else:
+            # median split along the axis where the centroids spread the most
+            axis = (centroid[indices].max(axis=0) - centroid[indices].min(axis=0)).argmax()
+            indices = sorted(indices, key=lambda k: centroid[k][axis])
+            mid = len(indices) // 2
+            build(indices[:mid])
+            build(indices[mid:])
+        nodes_miss[node] = offset + len(nodes_min)
+
+    if len(box_min) > 0:
+        build(list(range(len(box_min))))
+    return {
+        'box_min': np.array(nodes_min, dtype=np.float32).reshape(-1, 3),
+        'box_max': np.array(nodes_max, dtype=np.float32).reshape(-1, 3),
+        'kind': np.array(nodes_kind, dtype=np.int32),
+        'prim': np.array(nodes_prim, dtype=np.int32),
+        'miss': np.array(nodes_miss, dtype=np.int32),
+    }
+
+
+def transform_box(box_min, box_max, matrix, offset):
+    # bounds of the 8 transformed corners of an axis aligned box
+    corners = np.array([[x, y, z] for x in (box_min[0], box_max[0])
+                        for y in (box_min[1], box_max[1]) for z in (box_min[2], box_max[2])])
+    corners = corners @ np.asarray(matrix).T + offset
+    return corners.min(axis=0), corners.max(axis=0)
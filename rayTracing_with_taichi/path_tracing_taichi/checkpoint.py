@@ -0,0 +1,104 @@
+import os
+import struct
+import threading
+
+import numpy as np
+
+'''
+    Checkpoint of a progressive render, one little-endian binary file
+        header       : magic b'PTCK', version, width, height, frame index, random seed, lookfrom, scene key
+        canvas       : width * height * 3 f32, the linear accumulation (sum of samples)
+        sample_count : width * height u32, samples per pixel
+
+    Taichi does not expose the state of ti.random, so the seed and the frame index are stored instead:
+    a resumed run re-seeds with seed_for(seed, frame) and keeps drawing fresh, deterministic samples.
+'''
+
+MAGIC = b'PTCK'
+VERSION = 1
+HEADER = struct.Struct('<4sIIIQI3f64s')
+
+
+class Checkpoint:
+    def __init__(self, canvas, sample_count, frame, seed, lookfrom, scene_key):
+        self.canvas = canvas
+        self.sample_count = sample_count
+        self.frame = frame
+        self.seed = seed
+        self.lookfrom = lookfrom
+        self.scene_key = scene_key
+
+    @property
+    def width(self):
+        return self.canvas.shape[0]
+
+    @property
+    def height(self):
+        return self.canvas.shape[1]
+
+
+def seed_for(seed, frame):
+    # ti.init only takes a 32 bit seed
+    return (seed + frame * 0x9E3779B1) & 0xFFFFFFFF
+
+
+def save_checkpoint(path, ckpt):
+    header = HEADER.pack(MAGIC, VERSION, ckpt.width, ckpt.height, ckpt.frame, ckpt.seed,
+                         *[float(x) for x in ckpt.lookfrom], ckpt.scene_key.encode()[:64])
+    # write next to the target and rename, a crash in the middle never corrupts the previous checkpoint
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header)
+        f.write(np.ascontiguousarray(ckpt.canvas, dtype='<f4').tobytes())
+        f.write(np.ascontiguousarray(ckpt.sample_count, dtype='<u4').tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path):
+    with open(path, 'rb') as f:
+        magic, version, width, height, frame, seed, x, y, z, scene_key = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} checkpoint")
+        canvas = np.frombuffer(f.read(width * height * 3 * 4), dtype='<f4').reshape(width, height, 3)
+        sample_count = np.frombuffer(f.read(width * height * 4), dtype='<u4').reshape(width, height)
+    return Checkpoint(canvas.astype(np.float32), sample_count.astype(np.int32), frame, seed, (x, y, z),
+                      scene_key.rstrip(b'\0').decode())
+
+
+class CheckpointWriter(threading.Thread):
+    # Writes checkpoints on its own thread, the render loop only pays for the device -> host copy.
+    # If a write is still running, a newer submit replaces the pending checkpoint instead of queueing up.
+    def __init__(self, path):
+        super().__init__(daemon=True)
+        self.path = path
+        self.pending = None
+        self.condition = threading.Condition()
+        self.busy = False
+
+    def submit(self, ckpt):
+        with self.condition:
+            self.pending = ckpt
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                ckpt, self.pending = self.pending, None
+                self.busy = True
+            try:
+                save_checkpoint(self.path, ckpt)
+            except OSError as e:
+                print(f"failed to write checkpoint {self.path}: {e}")
+            with self.condition:
+                self.busy = False
+                self.condition.notify_all()
+
+    def flush(self):
+        # block until everything submitted so far is on disk
+        with self.condition:
+            while self.pending is not None or self.busy:
+                self.condition.wait()
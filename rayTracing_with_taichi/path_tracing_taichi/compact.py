@@ -0,0 +1,334 @@
+import argparse
+import time
+
+import numpy as np
+import taichi as ti
+import taichi.math as tm
+from object import Sphere
+from ray_tracing_tools import Ray
+
+'''
+    Compact encodings for film, AOV and primitive data, all opt-in. Error bounds:
+        f16 (ti.f16 fields)   : relative 2^-11 (0.05%) for |x| in [6.1e-5, 65504], larger values overflow to inf
+        rgb9e5 (u32)          : 9 bit mantissas sharing a 5 bit exponent (EXT_texture_shared_exponent),
+                                every channel within 2^-9 (0.2%) of the largest channel, range [2^-24, 65408],
+                                negative values are clamped to 0
+        rgbe (u32)            : Ward's RGBE, 8 bit mantissas sharing an 8 bit exponent, every channel within
+                                2^-8 (0.4%) of the largest channel, range [2^-128, 2^127]
+        octahedral (u32)      : a unit vector folded onto the octahedron, 16 bit per axis, less than 0.004 degrees
+        QuantizedSphere       : center and |radius| as 16 bit fractions of the scene bounds, material in 15 bits and
+                                the sign of the radius (hollow glass) in the 16th, 8 + 2 bytes instead of 20;
+                                every coordinate within extent / 131070 (plus the f32 rounding of the
+                                arithmetic), materials up to 32767
+
+    Radiance is accumulated in f32 (PathTracer.canvas): a sum of thousands of samples stored with 9 or 8 bit
+    mantissas stops growing once a sample is smaller than half a quantum. The shared exponent formats are
+    for radiance that is already averaged: PathTracer.encoded_image, written next to the AOVs by
+    path_tracing.py --aovs out.npz --compact_aovs rgb9e5|rgbe (decode_*_np read them back). The same option
+    stores the float AOVs in f16 (GBuffer.aovs(half=True)), the octahedral normals are used by
+    gbuffer.GBuffer(compact=True). QuantizedSphere is not used by hittable.Scene (its spheres stay f32),
+    only measured here. The benchmark at the bottom measures the bandwidth and throughput of each against f32.
+'''
+
+RGB9E5_MAX = 65408.0
+QUANTIZED_MAX = 65535.0
+NEGATIVE_RADIUS = 0x8000  # in QuantizedSphere.material
+MATERIAL_MASK = 0x7fff
+
+
+@ti.func
+def encode_rgb9e5(c):
+    rgb = tm.clamp(c, 0.0, RGB9E5_MAX)
+    max_c = ti.max(rgb.x, rgb.y, rgb.z)
+    exponent = ti.max(-16, ti.cast(ti.floor(ti.log(ti.max(max_c, 1e-30)) / ti.log(2.0)), ti.i32)) + 16
+    scale = ti.pow(2.0, ti.cast(exponent - 24, ti.f32))
+    if ti.floor(max_c / scale + 0.5) >= 512.0:
+        # rounding carried into the next power of 2
+        scale *= 2.0
+        exponent += 1
+    m = ti.cast(ti.floor(rgb / scale + 0.5), ti.u32)
+    return m.x | (m.y << 9) | (m.z << 18) | (ti.cast(exponent, ti.u32) << 27)
+
+
+@ti.func
+def decode_rgb9e5(e):
+    scale = ti.pow(2.0, ti.cast(ti.cast(e >> 27, ti.i32) - 24, ti.f32))
+    return ti.Vector([ti.cast(e & 0x1ff, ti.f32), ti.cast((e >> 9) & 0x1ff, ti.f32), ti.cast((e >> 18) & 0x1ff, ti.f32)]) * scale
+
+
+@ti.func
+def encode_rgbe(c):
+    rgb = ti.max(c, 0.0)
+    max_c = ti.max(rgb.x, rgb.y, rgb.z)
+    e = ti.u32(0)
+    if max_c >= 1e-32:
+        exponent = ti.cast(ti.floor(ti.log(max_c) / ti.log(2.0)), ti.i32) + 1
+        m = ti.cast(ti.min(ti.floor(rgb * (256.0 / ti.pow(2.0, ti.cast(exponent, ti.f32)))), 255.0), ti.u32)
+        e = m.x | (m.y << 8) | (m.z << 16) | (ti.cast(exponent + 128, ti.u32) << 24)
+    return e
+
+
+@ti.func
+def decode_rgbe(e):
+    c = ti.Vector([0.0, 0.0, 0.0])
+    if e != 0:
+        scale = ti.pow(2.0, ti.cast(ti.cast(e >> 24, ti.i32) - 136, ti.f32))
+        c = (ti.Vector([ti.cast(e & 0xff, ti.f32), ti.cast((e >> 8) & 0xff, ti.f32), ti.cast((e >> 16) & 0xff, ti.f32)]) + 0.5) * scale
+    return c
+
+
+@ti.func
+def sign_not_zero(v):
+    return ti.select(v >= 0.0, 1.0, -1.0)
+
+
+@ti.func
+def encode_octahedral(n):
+    p = ti.Vector([n.x, n.y]) / (ti.abs(n.x) + ti.abs(n.y) + ti.abs(n.z))
+    if n.z < 0:
+        p = (1.0 - ti.abs(ti.Vector([p.y, p.x]))) * ti.Vector([sign_not_zero(p.x), sign_not_zero(p.y)])
+    q = ti.cast(ti.round(tm.clamp(p, -1.0, 1.0) * 32767.0) + 32767.0, ti.u32)
+    return q.x | (q.y << 16)
+
+
+@ti.func
+def decode_octahedral(e):
+    p = (ti.Vector([ti.cast(e & 0xffff, ti.f32), ti.cast(e >> 16, ti.f32)]) - 32767.0) / 32767.0
+    n = ti.Vector([p.x, p.y, 1.0 - ti.abs(p.x) - ti.abs(p.y)])
+    t = ti.max(-n.z, 0.0)
+    n.x -= sign_not_zero(n.x) * t
+    n.y -= sign_not_zero(n.y) * t
+    return n.normalized()
+
+
+def decode_octahedral_np(e):
+    # the same as decode_octahedral, for AOVs copied to the host: (...,) u32 -> (..., 3) f32
+    e = e.astype(np.uint32)
+    x = ((e & 0xffff).astype(np.float32) - 32767.0) / 32767.0
+    y = ((e >> 16).astype(np.float32) - 32767.0) / 32767.0
+    z = 1.0 - np.abs(x) - np.abs(y)
+    t = np.maximum(-z, 0.0)
+    x -= np.where(x >= 0.0, t, -t)
+    y -= np.where(y >= 0.0, t, -t)
+    n = np.stack([x, y, z], axis=-1)
+    return n / np.linalg.norm(n, axis=-1, keepdims=True)
+
+
+def decode_rgb9e5_np(e):
+    # the same as decode_rgb9e5, for images copied to the host: (...,) u32 -> (..., 3) f32
+    e = e.astype(np.uint32)
+    scale = np.exp2((e >> 27).astype(np.float32) - 24.0)
+    return np.stack([e & 0x1ff, (e >> 9) & 0x1ff, (e >> 18) & 0x1ff], axis=-1).astype(np.float32) * scale[..., None]
+
+
+def decode_rgbe_np(e):
+    # the same as decode_rgbe: (...,) u32 -> (..., 3) f32
+    e = e.astype(np.uint32)
+    scale = np.exp2((e >> 24).astype(np.float32) - 136.0)
+    c = (np.stack([e & 0xff, (e >> 8) & 0xff, (e >> 16) & 0xff], axis=-1).astype(np.float32) + 0.5) * scale[..., None]
+    return np.where((e != 0)[..., None], c, 0.0).astype(np.float32)
+
+
+@ti.dataclass
+class QuantizedSphere:
+    center: ti.types.vector(3, ti.u16)  # fractions of the scene bounds
+    radius: ti.u16                      # fraction of the largest extent of the scene bounds
+    material: ti.u16                    # the top bit: negative radius
+
+
+@ti.func
+def quantize_sphere(sphere, box_min, box_max):
+    extent = ti.max(box_max - box_min, 1e-6)
+    center = ti.cast(ti.round(tm.clamp((sphere.center - box_min) / extent, 0.0, 1.0) * QUANTIZED_MAX), ti.u16)
+    radius = ti.cast(ti.round(tm.clamp(ti.abs(sphere.radius) / extent.max(), 0.0, 1.0) * QUANTIZED_MAX), ti.u16)
+    material = ti.cast(sphere.material & MATERIAL_MASK, ti.u16)
+    if sphere.radius < 0:
+        material |= ti.u16(NEGATIVE_RADIUS)
+    return QuantizedSphere(center=center, radius=radius, material=material)
+
+
+@ti.func
+def dequantize_sphere(q, box_min, box_max):
+    extent = ti.max(box_max - box_min, 1e-6)
+    material = ti.cast(q.material, ti.i32)
+    radius = ti.cast(q.radius, ti.f32) / QUANTIZED_MAX * extent.max()
+    if material & NEGATIVE_RADIUS:
+        radius = -radius
+    return Sphere(center=box_min + ti.cast(q.center, ti.f32) / QUANTIZED_MAX * extent, radius=radius,
+                  material=material & MATERIAL_MASK)
+
+
+if __name__ == "__main__":
+    # encode + store and load + decode of an 8K film in every format, and sphere records at f32 vs 16 bits
+    parser = argparse.ArgumentParser(description='compact encoding benchmark')
+    parser.add_argument(
+        '--resolution', type=str, default='7680x4320', help='WxH of the film (default: 8K)')
+    parser.add_argument(
+        '--num_spheres', type=int, default=1 << 24, help='sphere records (default: 16M)')
+    parser.add_argument(
+        '--frames', type=int, default=10, help='timed passes per format (default: 10)')
+    parser.add_argument(
+        '--arch', type=str, default='gpu', help='taichi arch: gpu, cuda, vulkan, cpu (default: gpu)')
+    args = parser.parse_args()
+
+    ti.init(arch=getattr(ti, args.arch), device_memory_GB=4)
+    width, height = (int(x) for x in args.resolution.split('x'))
+
+    def timed(func, *func_args):
+        func(*func_args)  # compile
+        ti.sync()
+        start = time.perf_counter()
+        for _ in range(args.frames):
+            func(*func_args)
+        ti.sync()
+        return (time.perf_counter() - start) / args.frames
+
+    @ti.func
+    def sample(i, j):
+        # an HDR color / a unit normal that differ from pixel to pixel
+        h = ti.cast((i * 73856093) ^ (j * 19349663), ti.u32)
+        c = ti.exp(ti.Vector([ti.cast(h & 0xff, ti.f32), ti.cast((h >> 8) & 0xff, ti.f32), ti.cast((h >> 16) & 0xff, ti.f32)]) / 32.0 - 4.0)
+        return c, (c - ti.Vector([1.0, 2.0, 3.0])).normalized()
+
+    F16, RGB9E5, RGBE, OCTAHEDRAL = range(4)
+
+    @ti.kernel
+    def store_f32(film: ti.template()):
+        for i, j in film:
+            c, _ = sample(i, j)
+            film[i, j] = c
+
+    @ti.kernel
+    def store_f16(film: ti.template()):
+        for i, j in film:
+            c, _ = sample(i, j)
+            film[i, j] = ti.cast(c, ti.f16)
+
+    @ti.kernel
+    def store_rgb9e5(film: ti.template()):
+        for i, j in film:
+            c, _ = sample(i, j)
+            film[i, j] = encode_rgb9e5(c)
+
+    @ti.kernel
+    def store_rgbe(film: ti.template()):
+        for i, j in film:
+            c, _ = sample(i, j)
+            film[i, j] = encode_rgbe(c)
+
+    @ti.kernel
+    def store_octahedral(film: ti.template()):
+        for i, j in film:
+            _, n = sample(i, j)
+            film[i, j] = encode_octahedral(n)
+
+    @ti.kernel
+    def load_vector(film: ti.template()) -> ti.f32:
+        total = 0.0
+        for i, j in film:
+            total += ti.cast(film[i, j], ti.f32).sum()
+        return total
+
+    @ti.kernel
+    def load_encoded(film: ti.template(), kind: ti.template()) -> ti.f32:
+        total = 0.0
+        for i, j in film:
+            if ti.static(kind == RGB9E5):
+                total += decode_rgb9e5(film[i, j]).sum()
+            elif ti.static(kind == RGBE):
+                total += decode_rgbe(film[i, j]).sum()
+            else:
+                total += decode_octahedral(film[i, j]).sum()
+        return total
+
+    @ti.kernel
+    def errors(film: ti.template(), kind: ti.template()) -> ti.f32:
+        # the largest relative (to the largest channel) / angular (degrees) error
+        worst = 0.0
+        for i, j in film:
+            c, n = sample(i, j)
+            if ti.static(kind == F16):
+                ti.atomic_max(worst, (ti.abs(ti.cast(film[i, j], ti.f32) - c) / c.max()).max())
+            elif ti.static(kind == RGB9E5):
+                ti.atomic_max(worst, (ti.abs(decode_rgb9e5(film[i, j]) - c) / c.max()).max())
+            elif ti.static(kind == RGBE):
+                ti.atomic_max(worst, (ti.abs(decode_rgbe(film[i, j]) - c) / c.max()).max())
+            else:
+                # atan2 of |cross| and dot, acos of a dot product close to 1 is only good to about 0.03 degrees in f32
+                d = decode_octahedral(film[i, j])
+                ti.atomic_max(worst, tm.degrees(ti.atan2(d.cross(n).norm(), d.dot(n))))
+        return worst
+
+    print(f'{args.arch}, {width}x{height}, {args.frames} passes; ms per pass, GB/s, Mpixel/s')
+    print(f'{"format":>10} {"bytes":>5} {"store":>8} {"GB/s":>6} {"Mpix/s":>7} {"load":>8} {"GB/s":>6} {"Mpix/s":>7} {"max error":>10}')
+    pixels = width * height
+    # the films are created one at a time, a field that is not placed yet stops every kernel launch
+    formats = [('f32', lambda: ti.Vector.field(3, ti.f32), 12, store_f32, None),
+               ('f16', lambda: ti.Vector.field(3, ti.f16), 6, store_f16, F16),
+               ('rgb9e5', lambda: ti.field(ti.u32), 4, store_rgb9e5, RGB9E5),
+               ('rgbe', lambda: ti.field(ti.u32), 4, store_rgbe, RGBE),
+               ('oct32', lambda: ti.field(ti.u32), 4, store_octahedral, OCTAHEDRAL)]
+    for name, make_film, size, store, kind in formats:
+        film = make_film()
+        builder = ti.FieldsBuilder()
+        builder.dense(ti.ij, (width, height)).place(film)
+        tree = builder.finalize()
+        t_store = timed(store, film)
+        t_load = timed(load_vector, film) if kind in (None, F16) else timed(load_encoded, film, kind)
+        error = '' if kind is None else f'{errors(film, kind):.2e}'
+        print(f'{name:>10} {size:>5} {t_store * 1000:>8.2f} {pixels * size / t_store / 1e9:>6.1f} {pixels / t_store / 1e6:>7.0f} '
+              f'{t_load * 1000:>8.2f} {pixels * size / t_load / 1e9:>6.1f} {pixels / t_load / 1e6:>7.0f} {error:>10}')
+        tree.destroy()
+
+    # sphere records: one ray per sphere, every thread reads one record
+    n = args.num_spheres
+    spheres = Sphere.field(shape=n)
+    quantized = QuantizedSphere.field(shape=n)
+    box_min, box_max = tm.vec3(-100.0), tm.vec3(100.0)
+
+    @ti.kernel
+    def scatter_spheres():
+        for k in spheres:
+            # every fifth one hollow (negative radius), the sign has to survive
+            spheres[k] = Sphere(center=ti.Vector([ti.random(), ti.random(), ti.random()]) * 200.0 - 100.0,
+                                radius=-0.5 if k % 5 == 0 else 0.5, material=k % 7)
+            quantized[k] = quantize_sphere(spheres[k], box_min, box_max)
+
+    @ti.func
+    def probe(sphere, k):
+        # a ray from the origin at the sphere, hits unless the quantization moved it too far
+        d = ti.Vector([ti.sin(k * 0.1), ti.cos(k * 0.1), 1.0]).normalized()
+        is_hit, _, _, _, _, _ = sphere.hit(Ray(sphere.center - d * 200.0, d))
+        return ti.cast(is_hit, ti.i32)
+
+    @ti.kernel
+    def hit_f32() -> ti.i32:
+        hits = 0
+        for k in spheres:
+            hits += probe(spheres[k], k)
+        return hits
+
+    @ti.kernel
+    def hit_quantized() -> ti.i32:
+        hits = 0
+        for k in quantized:
+            hits += probe(dequantize_sphere(quantized[k], box_min, box_max), k)
+        return hits
+
+    @ti.kernel
+    def sphere_error(field: ti.template()) -> ti.f32:
+        worst = 0.0
+        for k in spheres:
+            q = dequantize_sphere(quantized[k], box_min, box_max)
+            if ti.static(field == 'center'):
+                ti.atomic_max(worst, (ti.abs(q.center - spheres[k].center)).max())
+            else:
+                ti.atomic_max(worst, ti.abs(q.radius - spheres[k].radius))
+        return worst
+
+    scatter_spheres()
+    t_f32, t_quantized = timed(hit_f32), timed(hit_quantized)
+    print(f'{n} spheres: f32 records {t_f32 * 1000:.2f} ms ({n * 20 / t_f32 / 1e9:.1f} GB/s), '
+          f'16 bit records {t_quantized * 1000:.2f} ms ({n * 10 / t_quantized / 1e9:.1f} GB/s), '
+          f'largest center error {sphere_error("center"):.2e} (bound {200.0 / 131070:.2e} + f32 rounding), '
+          f'largest radius error {sphere_error("radius"):.2e}')
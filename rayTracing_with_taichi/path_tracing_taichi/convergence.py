@@ -0,0 +1,279 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import taichi as ti
+from Camera import Camera
+from hittable import Scene
+from scene import load_scene, SCENE_DIR
+from photons import PhotonMap
+from guiding import PathGuide
+from path_tracing import PathTracer
+
+'''
+    Equal-time convergence harness: is a configuration faster to a clean image, not just faster per ray.
+
+    For every scene a reference (linear radiance, many samples per pixel) is rendered once with the default path
+    tracer and cached in --cache, keyed by the scene contents, camera, resolution, depth and sample count.
+    Every configuration then renders the scene progressively under the clock (compilation excluded, the error
+    evaluation between frames excluded) up to the largest time budget, and its error against the reference is
+    recorded along the way:
+        RMSE   = sqrt(mean((image - reference)^2))
+        relMSE = mean((image - reference)^2 / (reference^2 + 0.01))
+    both on linear radiance. The results go to a CSV (scene, config, frame, seconds, spp, rmse, relmse), a table
+    of relMSE at each budget is printed, and with matplotlib installed relMSE is plotted against wall time and spp.
+
+        python convergence.py --scenes cornell_box.json --configs path,rr_off,adaptive --budgets 1,2,4
+'''
+
+SCENES = ('cornell_box.json', 'cornell_box_glass.toml', 'many_lights.json', 'outdoor.json')
+BUDGETS = (2.0, 4.0, 8.0, 16.0)
+RELMSE_EPSILON = 0.01
+REFERENCE_SEED = 7919  # added to --seed for the references
+
+# name -> options of Configuration, 'path' is the baseline the others are compared to
+CONFIGS = {
+    'path': {},
+    'unit_ball': {'sample_on_unit_sphere_surface': False},
+    'rr_0.5': {'rr': 0.5},
+    'rr_off': {'rr': 1.0},
+    'adaptive': {'adaptive': 0.02},
+    'lights_uniform': {'light_sampling': 'uniform'},
+    'lights_power': {'light_sampling': 'power'},
+    'wavefront': {'wavefront': True},
+    'guiding': {'guiding': True},
+    'caustics': {'caustics': True},
+    'bdpt': {'integrator': 'bdpt'},
+}
+
+
+class Configuration:
+    # one renderer (compiled once) and how its frames are rendered, it is reused for every scene
+    def __init__(self, scene, camera, resolution, integrator='path', light_sampling='tree', wavefront=False, guiding=False,
+                 caustics=False, photons_per_frame=200000, photon_radius=0.05, **tracer_options):
+        self.scene = scene
+        self.resolution = resolution
+        self.light_sampling = light_sampling
+        self.wavefront = wavefront
+        self.photons_per_frame = photons_per_frame
+        self.photons = PhotonMap(photon_radius) if caustics else None
+        self.guide = PathGuide() if guiding else None
+        if integrator == 'bdpt':
+            from bdpt import BidirectionalPathTracer
+            self.path_tracer = BidirectionalPathTracer(scene, camera, resolution, resolution, **tracer_options)
+        else:
+            self.path_tracer = PathTracer(scene, camera, resolution, resolution, photons=self.photons, guide=self.guide,
+                                          **tracer_options)
+
+    def start(self, scene_data):
+        # the light strategy lives in the shared scene, set it for every run
+        self.scene.lights.set_strategy(self.light_sampling)
+        self.path_tracer.clear()
+        if self.guide is not None:
+            self.guide.reset(*scene_data.bounds())
+        if self.photons is not None:
+            self.photons.reset()
+
+    def frame(self, samples_per_pixel, max_depth):
+        if self.photons is not None:
+            self.path_tracer.photon_pass(self.photons_per_frame)
+        if self.wavefront:
+            self.path_tracer.render_wavefront(self.resolution, self.resolution, samples_per_pixel, max_depth)
+        else:
+            self.path_tracer.render(self.resolution, self.resolution, samples_per_pixel, max_depth)
+        if self.photons is not None:
+            self.photons.advance()
+        if self.guide is not None:
+            self.guide.advance()
+
+    def radiance(self):
+        # linear radiance and the mean samples per pixel
+        canvas, sample_count = self.path_tracer.state(self.resolution, self.resolution)
+        return canvas / np.maximum(sample_count, 1)[:, :, None], float(sample_count.mean())
+
+
+def errors(image, reference):
+    squared = (image - reference) ** 2
+    return float(np.sqrt(squared.mean())), float((squared / (reference ** 2 + RELMSE_EPSILON)).mean())
+
+
+def reference_key(scene_data, resolution, max_depth, spp):
+    h = hashlib.sha256()
+    h.update(scene_data.geometry_key().encode())
+    h.update(json.dumps([scene_data.camera, resolution, max_depth, spp], sort_keys=True).encode())
+    return h.hexdigest()[:16]
+
+
+def reference_path(scene_data, name, args):
+    return os.path.join(args.cache, f'{os.path.splitext(name)[0]}_{reference_key(scene_data, args.resolution, args.max_depth, args.reference_spp)}.npy')
+
+
+def render_reference(config, scene_data, name, args):
+    # cached: rendering it takes far longer than any configuration run
+    print(f'{name}: rendering the {args.reference_spp} spp reference ...')
+    start = time.perf_counter()
+    config.start(scene_data)
+    for _ in range(0, args.reference_spp, args.spp):
+        config.frame(args.spp, args.max_depth)
+    image, _ = config.radiance()
+    path = reference_path(scene_data, name, args)
+    os.makedirs(args.cache, exist_ok=True)
+    np.save(path, image)
+    print(f'{name}: reference in {time.perf_counter() - start:.1f} s -> {path}')
+    return image
+
+
+def show(scene, camera, scene_data):
+    scene.load(scene_data)
+    camera.look_at(ti.math.vec3(scene_data.camera["lookfrom"]), ti.math.vec3(scene_data.camera["lookat"]), scene_data.camera["fov"])
+
+
+def run(config, scene_data, ref, args):
+    # progressive rendering under the clock, the error is measured at (roughly) log spaced times
+    config.start(scene_data)
+    config.frame(args.spp, args.max_depth)  # compile outside of the clock
+    config.start(scene_data)
+    ti.sync()
+    records = []
+    elapsed = 0.0
+    next_record = 0.01
+    frame = 0
+    budget = max(args.budgets)
+    while elapsed < budget:
+        start = time.perf_counter()
+        config.frame(args.spp, args.max_depth)
+        ti.sync()
+        elapsed += time.perf_counter() - start
+        frame += 1
+        if elapsed >= next_record or elapsed >= budget:
+            image, spp = config.radiance()
+            records.append((frame, elapsed, spp) + errors(image, ref))
+            next_record = elapsed * 1.25
+    return records
+
+
+def at_budget(records, budget):
+    # the last record within the budget
+    within = [r for r in records if r[1] <= budget]
+    return within[-1] if within else None
+
+
+def plot(results, scenes, out):
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print('matplotlib is not installed, only the CSV was written')
+        return
+    for name in scenes:
+        fig, (by_time, by_spp) = plt.subplots(1, 2, figsize=(12, 5))
+        for (scene_name, config_name), records in results.items():
+            if scene_name != name:
+                continue
+            seconds = [r[1] for r in records]
+            spp = [r[2] for r in records]
+            relmse = [r[4] for r in records]
+            by_time.loglog(seconds, relmse, label=config_name)
+            by_spp.loglog(spp, relmse, label=config_name)
+        by_time.set_xlabel('wall time (s)')
+        by_spp.set_xlabel('samples per pixel')
+        for ax in (by_time, by_spp):
+            ax.set_ylabel('relMSE')
+            ax.grid(True, which='both', alpha=0.3)
+        by_time.legend()
+        fig.suptitle(name)
+        path = os.path.join(out, f'convergence_{os.path.splitext(name)[0]}.png')
+        fig.savefig(path, dpi=100)
+        plt.close(fig)
+        print(f'plot -> {path}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='equal-time convergence of the integrators and samplers')
+    parser.add_argument(
+        '--scenes', type=str, default=','.join(SCENES), help=f'comma separated scene files in {SCENE_DIR} (default: {",".join(SCENES)})')
+    parser.add_argument(
+        '--configs', type=str, default=','.join(CONFIGS), help=f'comma separated configurations (default: all, {",".join(CONFIGS)})')
+    parser.add_argument(
+        '--budgets', type=str, default=','.join(str(b) for b in BUDGETS), help='comma separated time budgets in s (default: 2,4,8,16)')
+    parser.add_argument(
+        '--resolution', type=int, default=128, help='square image resolution (default: 128)')
+    parser.add_argument(
+        '--spp', type=int, default=1, help='samples per pixel of a frame (default: 1)')
+    parser.add_argument(
+        '--max_depth', type=int, default=10, help='max depth (default: 10)')
+    parser.add_argument(
+        '--reference_spp', type=int, default=4096, help='samples per pixel of the references (default: 4096)')
+    parser.add_argument(
+        '--cache', type=str, default='convergence_cache', help='where the references are kept (default: convergence_cache)')
+    parser.add_argument(
+        '--out', type=str, default='convergence', help='directory of the CSV and the plots (default: convergence)')
+    parser.add_argument(
+        '--arch', type=str, default='cpu', help='taichi arch: cpu, gpu, cuda, vulkan (default: cpu)')
+    parser.add_argument(
+        '--seed', type=int, default=0, help='random seed (default: 0)')
+    args = parser.parse_args()
+    args.budgets = sorted(float(b) for b in args.budgets.split(','))
+    scenes = [s.strip() for s in args.scenes.split(',') if s.strip()]
+    config_names = [c.strip() for c in args.configs.split(',') if c.strip()]
+    for name in config_names:
+        if name not in CONFIGS:
+            parser.error(f"unknown configuration {name}, expected one of {', '.join(CONFIGS)}")
+
+    scene_data = {name: load_scene(os.path.join(SCENE_DIR, name)) for name in scenes}
+    # the wavefront queues and bdpt do not carry what Scene.albedo needs, they would converge to the untextured scene
+    for name in scenes:
+        for config_name in config_names:
+            untextured = CONFIGS[config_name].get('wavefront', False) or CONFIGS[config_name].get('integrator') == 'bdpt'
+            if untextured and scene_data[name].textures is not None:
+                parser.error(f"{name} has textures, the {config_name} configuration does not render them")
+    refs = {name: np.load(reference_path(scene_data[name], name, args)) for name in scenes
+            if os.path.exists(reference_path(scene_data[name], name, args))}
+    missing = [name for name in scenes if name not in refs]
+    if missing:
+        # the references get a seed of their own, a run must not replay the random numbers of its reference
+        ti.init(arch=getattr(ti, args.arch), random_seed=args.seed + REFERENCE_SEED)
+        scene, camera = Scene(), Camera()
+        reference_config = Configuration(scene, camera, args.resolution)
+        for name in missing:
+            show(scene, camera, scene_data[name])
+            refs[name] = render_reference(reference_config, scene_data[name], name, args)
+
+    ti.init(arch=getattr(ti, args.arch), random_seed=args.seed)
+    scene, camera = Scene(), Camera()
+    configs = {name: Configuration(scene, camera, args.resolution, **CONFIGS[name]) for name in config_names}
+
+    os.makedirs(args.out, exist_ok=True)
+    results = {}
+    for name in scenes:
+        show(scene, camera, scene_data[name])
+        for config_name, config in configs.items():
+            results[name, config_name] = run(config, scene_data[name], refs[name], args)
+
+        print(f'\n{name}, {args.resolution}x{args.resolution}: relMSE at equal time (spp reached in brackets)')
+        print(f'{"config":<16}' + ''.join(f'{f"{b:g} s":>20}' for b in args.budgets) + f'{"vs path":>10}')
+        baseline = at_budget(results.get((name, 'path'), []), args.budgets[-1])
+        for config_name in configs:
+            cells = []
+            for b in args.budgets:
+                r = at_budget(results[name, config_name], b)
+                cells.append(f'{r[4]:.3e} ({r[2]:>5.0f})' if r is not None else '-')
+            last = at_budget(results[name, config_name], args.budgets[-1])
+            # > 1: less error than the path tracer in the same time
+            gain = f'{baseline[4] / last[4]:.2f}x' if baseline is not None and last is not None and last[4] > 0 else '-'
+            print(f'{config_name:<16}' + ''.join(f'{c:>20}' for c in cells) + f'{gain:>10}')
+
+    path = os.path.join(args.out, 'convergence.csv')
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['scene', 'config', 'frame', 'seconds', 'spp', 'rmse', 'relmse'])
+        for (scene_name, config_name), records in results.items():
+            for record in records:
+                writer.writerow([scene_name, config_name, *record])
+    print(f'\nresults -> {path}')
+    plot(results, scenes, args.out)
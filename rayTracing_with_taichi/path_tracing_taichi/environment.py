@@ -0,0 +1,197 @@
+import taichi as ti
+import taichi.math as tm
+import numpy as np
+from ray_tracing_tools import PI
+
+'''
+    Equirectangular HDR environment, row 0 is straight up (+y):
+        u = phi / 2pi - rotate, phi = atan2(z, x)      v = theta / pi, theta measured from +y
+
+    Importance sampling: a texel is picked with an alias table built once per load (Vose, O(1) per sample),
+    proportionally to luminance * sin(theta), then a point is picked uniformly inside it. The pdf of the
+    direction is p_texel * width * height / (2 pi^2 sin(theta)).
+'''
+
+MAX_ENV_WIDTH = 2048
+MAX_ENV_HEIGHT = 1024
+
+
+def read_hdr(path):
+    # Radiance .hdr (RGBE, flat or run-length encoded scanlines) -> float32 (height, width, 3)
+    with open(path, 'rb') as f:
+        data = f.read()
+    pos = 0
+    while True:
+        end = data.index(b'\n', pos)
+        line = data[pos:end].strip()
+        pos = end + 1
+        if line.startswith(b'FORMAT') and b'32-bit_rle_rgbe' not in line:
+            raise ValueError(f"{path}: unsupported format {line.decode()}")
+        if line.startswith(b'-Y') or line.startswith(b'+Y'):
+            fields = line.split()
+            height, width = int(fields[1]), int(fields[3])
+            break
+    rgbe = np.zeros((height, width, 4), dtype=np.uint8)
+    for y in range(height):
+        if width >= 8 and width < 32768 and data[pos] == 2 and data[pos + 1] == 2 and (data[pos + 2] << 8 | data[pos + 3]) == width:
+            pos += 4
+            for channel in range(4):
+                x = 0
+                while x < width:
+                    count = data[pos]
+                    if count > 128:
+                        count -= 128
+                        rgbe[y, x:x + count, channel] = data[pos + 1]
+                        pos += 2
+                    else:
+                        rgbe[y, x:x + count, channel] = np.frombuffer(data, np.uint8, count, pos + 1)
+                        pos += count + 1
+                    x += count
+        else:
+            rgbe[y] = np.frombuffer(data, np.uint8, width * 4, pos).reshape(width, 4)
+            pos += width * 4
+    scale = np.where(rgbe[..., 3] > 0, np.ldexp(1.0, rgbe[..., 3].astype(np.int32) - 136), 0.0)
+    return (rgbe[..., :3] * scale[..., None]).astype(np.float32)
+
+
+def read_environment(path):
+    if path.endswith('.npy'):
+        return np.load(path).astype(np.float32)
+    return read_hdr(path)
+
+
+def sky(sun_direction, sun_radiance, sun_size=2.0, zenith=(0.3, 0.5, 1.0), horizon=(0.9, 0.9, 1.0), ground=(0.3, 0.3, 0.3),
+        width=1024, height=512):
+    # procedural sky: gradient, grey ground and a small, very bright sun (sun_size: angular diameter, degrees)
+    v, u = np.meshgrid((np.arange(height) + 0.5) / height, (np.arange(width) + 0.5) / width, indexing='ij')
+    theta, phi = v * np.pi, u * 2 * np.pi
+    d = np.stack([np.sin(theta) * np.cos(phi), np.cos(theta), np.sin(theta) * np.sin(phi)], axis=-1)
+    up = np.clip(d[..., 1:2], 0, 1)
+    pixels = np.where(d[..., 1:2] > 0, (1 - up) * np.array(horizon) + up * np.array(zenith), np.array(ground))
+    sun = np.asarray(sun_direction, dtype=np.float64)
+    sun = sun / np.linalg.norm(sun)
+    pixels[d @ sun > np.cos(np.radians(sun_size / 2))] = sun_radiance
+    return pixels.astype(np.float32)
+
+
+def fit(pixels, max_width, max_height):
+    # box filter a map that does not fit the fields
+    factor = 1
+    while pixels.shape[1] // factor > max_width or pixels.shape[0] // factor > max_height:
+        factor *= 2
+    if factor > 1:
+        height, width = pixels.shape[0] // factor, pixels.shape[1] // factor
+        pixels = pixels[:height * factor, :width * factor].reshape(height, factor, width, factor, 3).mean(axis=(1, 3))
+    return pixels
+
+
+@ti.data_oriented
+class Environment:
+    def __init__(self, max_width=MAX_ENV_WIDTH, max_height=MAX_ENV_HEIGHT):
+        self.max_width = max_width
+        self.max_height = max_height
+        self.radiance = ti.Vector.field(3, dtype=ti.f32, shape=(max_height, max_width))
+        self.width = ti.field(dtype=ti.i32, shape=())    # 0: no environment, escaped rays are black
+        self.height = ti.field(dtype=ti.i32, shape=())
+        self.intensity = ti.field(dtype=ti.f32, shape=())
+        self.rotate = ti.field(dtype=ti.f32, shape=())   # in turns
+        # alias table: texel i is kept with probability prob[i], otherwise alias[i] is taken
+        self.prob = ti.field(dtype=ti.f32, shape=max_width * max_height)
+        self.alias = ti.field(dtype=ti.i32, shape=max_width * max_height)
+        self.small = ti.field(dtype=ti.i32, shape=max_width * max_height)
+        self.large = ti.field(dtype=ti.i32, shape=max_width * max_height)
+        self.weight_sum = ti.field(dtype=ti.f32, shape=())
+
+    def load(self, environment):
+        # environment: {"pixels": (height, width, 3), "intensity": s, "rotate": degrees} or None
+        if environment is None:
+            self.width[None] = 0
+            self.height[None] = 0
+            return
+        pixels = fit(np.asarray(environment["pixels"], dtype=np.float32), self.max_width, self.max_height)
+        padded = np.zeros((self.max_height, self.max_width, 3), dtype=np.float32)
+        padded[:pixels.shape[0], :pixels.shape[1]] = pixels
+        self.radiance.from_numpy(padded)
+        self.height[None], self.width[None] = pixels.shape[:2]
+        self.intensity[None] = environment.get("intensity", 1.0)
+        self.rotate[None] = environment.get("rotate", 0.0) / 360.0
+        self.build_alias()
+
+    @ti.func
+    def texel_weight(self, x, y):
+        sin_theta = ti.sin(PI * (y + 0.5) / self.height[None])
+        return self.radiance[y, x].dot(ti.Vector([0.2126, 0.7152, 0.0722])) * sin_theta
+
+    @ti.kernel
+    def build_alias(self):
+        n = self.width[None] * self.height[None]
+        self.weight_sum[None] = 0.0
+        for i in range(n):
+            self.weight_sum[None] += self.texel_weight(i % self.width[None], i // self.width[None])
+        for i in range(n):
+            # scaled so that the average is 1
+            self.prob[i] = self.texel_weight(i % self.width[None], i // self.width[None]) * n / ti.max(self.weight_sum[None], 1e-20)
+            self.alias[i] = i
+        for _ in range(1):
+            num_small = 0
+            num_large = 0
+            for i in range(n):
+                if self.prob[i] < 1.0:
+                    self.small[num_small] = i
+                    num_small += 1
+                else:
+                    self.large[num_large] = i
+                    num_large += 1
+            while num_small > 0 and num_large > 0:
+                num_small -= 1
+                s = self.small[num_small]
+                l = self.large[num_large - 1]
+                self.alias[s] = l
+                self.prob[l] += self.prob[s] - 1.0
+                if self.prob[l] < 1.0:
+                    num_large -= 1
+                    self.small[num_small] = l
+                    num_small += 1
+            # what is left only suffers from rounding
+            for i in range(num_small):
+                self.prob[self.small[i]] = 1.0
+            for i in range(num_large):
+                self.prob[self.large[i]] = 1.0
+
+    @ti.func
+    def enabled(self):
+        return self.width[None] > 0 and self.weight_sum[None] > 0
+
+    @ti.func
+    def texel(self, direction):
+        d = direction.normalized()
+        u = tm.fract(ti.atan2(d.z, d.x) / (2 * PI) - self.rotate[None])
+        v = ti.acos(tm.clamp(d.y, -1.0, 1.0)) / PI
+        x = ti.min(ti.cast(u * self.width[None], ti.i32), self.width[None] - 1)
+        y = ti.min(ti.cast(v * self.height[None], ti.i32), self.height[None] - 1)
+        return x, y, ti.sqrt(ti.max(1 - d.y * d.y, 0.0))
+
+    @ti.func
+    def eval(self, direction):
+        x, y, _ = self.texel(direction)
+        return self.radiance[y, x] * self.intensity[None]
+
+    @ti.func
+    def pdf(self, direction):
+        x, y, sin_theta = self.texel(direction)
+        return self.texel_weight(x, y) / self.weight_sum[None] * self.width[None] * self.height[None] / (2 * PI * PI * ti.max(sin_theta, 1e-6))
+
+    # returns (direction, radiance, pdf)
+    @ti.func
+    def sample(self):
+        n = self.width[None] * self.height[None]
+        i = ti.min(ti.cast(ti.random() * n, ti.i32), n - 1)
+        if ti.random() >= self.prob[i]:
+            i = self.alias[i]
+        x = i % self.width[None]
+        y = i // self.width[None]
+        phi = 2 * PI * ((x + ti.random()) / self.width[None] + self.rotate[None])
+        theta = PI * (y + ti.random()) / self.height[None]
+        direction = ti.Vector([ti.sin(theta) * ti.cos(phi), ti.cos(theta), ti.sin(theta) * ti.sin(phi)])
+        pdf = self.texel_weight(x, y) / self.weight_sum[None] * n / (2 * PI * PI * ti.max(ti.sin(theta), 1e-6))
+        return direction, self.radiance[y, x] * self.intensity[None], pdf
@@ -0,0 +1,139 @@
+import argparse
+import time
+
+import taichi as ti
+
+'''
+    Film layouts: how the per pixel fields of the path tracer (canvas, sample_count, AOVs) are placed in memory.
+        dense  : ti.root.dense(ij), row major, pixel (i, j + 1) follows pixel (i, j)
+        tiled  : tile x tile blocks, row major inside a block and between blocks
+        morton : tile x tile blocks stored in Morton (Z) order, nested 2 x 2 dense levels
+    and how the fields of a pixel are stored:
+        aos    : all the fields of a pixel side by side (canvas rgb and sample_count share a cache line)
+        soa    : one array per channel (canvas r, canvas g, canvas b, sample_count)
+
+    tiled and morton round the size up to whole tiles, the fields are larger than the image then (the image
+    is their lower-left corner, like it already is for the largest-resolution canvas of PathTracer).
+    The struct-for (for i, j in field) visits the pixels in storage order, so with tiles neighbouring threads
+    work in the same block. Which layout is best depends on the backend, see the benchmark below.
+'''
+
+LAYOUTS = ('dense', 'tiled', 'morton')
+CHANNELS = ('aos', 'soa')
+TILE = 8
+
+
+def film_shape(width, height, layout='dense', tile=TILE):
+    if layout == 'dense':
+        return width, height
+    return (width + tile - 1) // tile * tile, (height + tile - 1) // tile * tile
+
+
+def _pixels(root, width, height, layout, tile):
+    # the snode the fields of one pixel are placed in
+    if layout == 'dense':
+        return root.dense(ti.ij, (width, height))
+    block = root.dense(ti.ij, ((width + tile - 1) // tile, (height + tile - 1) // tile))
+    if layout == 'tiled':
+        return block.dense(ti.ij, (tile, tile))
+    size = 1
+    while size < tile:
+        block = block.dense(ti.ij, (2, 2))
+        size *= 2
+    return block
+
+
+def film_fields(width, height, channels, layout='dense', storage='aos', tile=TILE, root=None):
+    '''
+        One field per entry of channels, (n, dtype) with n = 0 for a scalar field, all with the given layout.
+        root is ti.root or a ti.FieldsBuilder.
+    '''
+    if layout not in LAYOUTS:
+        raise ValueError(f"unknown film layout {layout}, expected one of {', '.join(LAYOUTS)}")
+    if storage not in CHANNELS:
+        raise ValueError(f"unknown film storage {storage}, expected one of {', '.join(CHANNELS)}")
+    if layout == 'morton' and tile & (tile - 1):
+        raise ValueError(f"morton tiles are a power of 2, not {tile}")
+    root = ti.root if root is None else root
+    fields = [ti.Vector.field(n, dtype=dtype) if n > 0 else ti.field(dtype=dtype) for n, dtype in channels]
+    if storage == 'aos':
+        _pixels(root, width, height, layout, tile).place(*fields)
+    else:
+        for field, (n, _) in zip(fields, channels):
+            for c in range(n):
+                _pixels(root, width, height, layout, tile).place(field.get_scalar_field(c))
+            if n == 0:
+                _pixels(root, width, height, layout, tile).place(field)
+    return fields
+
+
+if __name__ == "__main__":
+    # progressive accumulation and a 3 x 3 AOV filter at 4K / 8K in every layout
+    parser = argparse.ArgumentParser(description='film layout benchmark')
+    parser.add_argument(
+        '--resolutions', type=str, default='3840x2160,7680x4320', help='comma separated WxH (default: 4K and 8K)')
+    parser.add_argument(
+        '--frames', type=int, default=10, help='timed frames per layout (default: 10)')
+    parser.add_argument(
+        '--tile', type=int, default=TILE, help=f'tile size of tiled / morton (default: {TILE})')
+    parser.add_argument(
+        '--arch', type=str, default='cpu', help='taichi arch: gpu, cuda, vulkan, cpu (default: cpu)')
+    args = parser.parse_args()
+
+    ti.init(arch=getattr(ti, args.arch), device_memory_GB=4)
+
+    @ti.kernel
+    def accumulate(canvas: ti.template(), sample_count: ti.template(), normal: ti.template(), frame: ti.i32):
+        # what a frame of PathTracer.render writes: the sample, its count and an AOV
+        for i, j in canvas:
+            h = ti.cast((i * 73856093) ^ (j * 19349663) ^ (frame * 83492791), ti.u32)
+            c = ti.cast(h & 0xff, ti.f32) / 255.0
+            canvas[i, j] += ti.Vector([c, 1.0 - c, 0.5 * c])
+            sample_count[i, j] += 1
+            normal[i, j] = ti.Vector([c, 0.0, 1.0 - c])
+
+    @ti.kernel
+    def filter_3x3(canvas: ti.template(), normal: ti.template(), out: ti.template()) -> ti.f32:
+        # neighbour reads, like a denoiser guided by the normal AOV
+        total = 0.0
+        for i, j in canvas:
+            if 0 < i < canvas.shape[0] - 1 and 0 < j < canvas.shape[1] - 1:
+                s = ti.Vector([0.0, 0.0, 0.0])
+                for di, dj in ti.static(ti.ndrange((-1, 2), (-1, 2))):
+                    s += canvas[i + di, j + dj] * normal[i + di, j + dj].dot(normal[i, j])
+                out[i, j] = s
+                total += s.x
+        return total
+
+    def timed(func, *func_args):
+        ti.sync()
+        start = time.perf_counter()
+        for _ in range(args.frames):
+            func(*func_args)
+        ti.sync()
+        return (time.perf_counter() - start) / args.frames
+
+    print(f'{args.arch}, {args.frames} frames, tile {args.tile}; ms per frame, GB/s, Mpixel/s')
+    print(f'{"resolution":>10} {"layout":>7} {"storage":>7} {"accumulate":>10} {"GB/s":>7} {"Mpix/s":>7} '
+          f'{"filter":>8} {"GB/s":>7} {"Mpix/s":>7}')
+    for resolution in args.resolutions.split(','):
+        width, height = (int(x) for x in resolution.split('x'))
+        for layout in LAYOUTS:
+            for storage in CHANNELS:
+                builder = ti.FieldsBuilder()
+                canvas, sample_count, normal, out = film_fields(
+                    width, height, [(3, ti.f32), (0, ti.i32), (3, ti.f32), (3, ti.f32)], layout, storage, args.tile, builder)
+                tree = builder.finalize()
+                pixels = canvas.shape[0] * canvas.shape[1]
+                accumulate(canvas, sample_count, normal, 0)  # compile
+                filter_3x3(canvas, normal, out)
+                t_acc = timed(accumulate, canvas, sample_count, normal, 1)
+                t_filter = timed(filter_3x3, canvas, normal, out)
+                # bytes that have to move at least once: read + write canvas and count, write normal
+                bytes_acc = pixels * (2 * 12 + 2 * 4 + 12)
+                # read canvas and normal, write out
+                bytes_filter = pixels * (12 + 12 + 12)
+                print(f'{resolution:>10} {layout:>7} {storage:>7} {t_acc * 1000:>10.2f} {bytes_acc / t_acc / 1e9:>7.1f} '
+                      f'{pixels / t_acc / 1e6:>7.0f} {t_filter * 1000:>8.2f} {bytes_filter / t_filter / 1e9:>7.1f} '
+                      f'{pixels / t_filter / 1e6:>7.0f}')
+                tree.destroy()
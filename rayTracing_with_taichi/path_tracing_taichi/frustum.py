@@ -0,0 +1,47 @@
+import taichi as ti
+import taichi.math as tm
+
+'''
+    Frustum of a packet of camera rays: the rays share their origin and their directions lie between the
+    four corner rays of a screen tile. Each side is a plane through the origin, its normal points inside,
+    so a primitive or a BVH node entirely behind one of the planes cannot be hit by any ray of the packet.
+'''
+
+
+@ti.dataclass
+class Frustum:
+    origin: tm.vec3
+    left: tm.vec3
+    right: tm.vec3
+    bottom: tm.vec3
+    top: tm.vec3
+
+    @ti.func
+    def outside_box(self, normal, box_min, box_max):
+        # the corner furthest along the normal, if it is behind the plane so is the whole box
+        p = ti.select(normal > 0, box_max, box_min)
+        return normal.dot(p - self.origin) < 0
+
+    @ti.func
+    def hit_box(self, box_min, box_max):
+        return not (self.outside_box(self.left, box_min, box_max) or self.outside_box(self.right, box_min, box_max)
+                    or self.outside_box(self.bottom, box_min, box_max) or self.outside_box(self.top, box_min, box_max))
+
+    @ti.func
+    def hit_sphere(self, center, radius):
+        oc = center - self.origin
+        return (self.left.dot(oc) >= -radius * self.left.norm() and self.right.dot(oc) >= -radius * self.right.norm()
+                and self.bottom.dot(oc) >= -radius * self.bottom.norm() and self.top.dot(oc) >= -radius * self.top.norm())
+
+
+@ti.func
+def make_frustum(origin, d00, d10, d01, d11):
+    # d00 / d10 / d01 / d11: directions of the lower-left, lower-right, upper-left and upper-right corners
+    center = d00 + d10 + d01 + d11
+    left = d00.cross(d01)
+    right = d11.cross(d10)
+    bottom = d10.cross(d00)
+    top = d01.cross(d11)
+    return Frustum(origin,
+                   ti.select(left.dot(center) < 0, -left, left), ti.select(right.dot(center) < 0, -right, right),
+                   ti.select(bottom.dot(center) < 0, -bottom, bottom), ti.select(top.dot(center) < 0, -top, top))
@@ -0,0 +1,120 @@
+import taichi as ti
+import numpy as np
+from compact import encode_octahedral, decode_octahedral, decode_octahedral_np
+
+'''
+    First hit cache (G-buffer): the camera rays of render() go through num_jitters fixed subpixel offsets
+    (Halton 2, 3), frame f uses offset f % num_jitters. The first time an offset is used its hits are traced
+    and stored per pixel (position, normal, material, primitive id, front face), after that the frames read
+    them and start tracing at the first bounce. clear() of the path tracer drops the cache, which happens
+    whenever the camera or the scene changes.
+
+    With fixed offsets the image converges to the average of num_jitters subpixel positions instead of
+    the whole pixel footprint (num_jitters samples of antialiasing).
+    The layers double as AOVs (position, normal, material, primitive), see aovs().
+    compact=True stores the distance along the camera ray instead of the position (the ray of a pixel and offset
+    is fixed, so the hit is ray.at(t) again) and the normal octahedral encoded in a u32, 17 instead of 33 bytes
+    per pixel and offset (error bound in compact.py). aovs() then has a depth instead of a position.
+    aovs(half=True) returns the depth / position and normal in f16 (error bound in compact.py as well).
+'''
+
+NUM_JITTERS = 8
+
+
+def halton(index, base):
+    result, f = 0.0, 1.0
+    while index > 0:
+        f /= base
+        result += f * (index % base)
+        index //= base
+    return result
+
+
+@ti.data_oriented
+class GBuffer:
+    def __init__(self, width, height, num_jitters=NUM_JITTERS, compact=False):
+        self.num_jitters = num_jitters
+        self.compact = compact
+        self.jitter = ti.Vector.field(2, dtype=ti.f32, shape=num_jitters)
+        self.jitter.from_numpy(np.array([[halton(k + 1, 2), halton(k + 1, 3)] for k in range(num_jitters)], dtype=np.float32))
+        # [jitter, i, j]
+        if compact:
+            self.depth = ti.field(dtype=ti.f32, shape=(num_jitters, width, height))  # t of the camera ray
+            self.normal = ti.field(dtype=ti.u32, shape=(num_jitters, width, height))  # compact.encode_octahedral
+        else:
+            self.position = ti.Vector.field(3, dtype=ti.f32, shape=(num_jitters, width, height))
+            self.normal = ti.Vector.field(3, dtype=ti.f32, shape=(num_jitters, width, height))
+        self.material = ti.field(dtype=ti.i32, shape=(num_jitters, width, height))
+        self.primitive = ti.field(dtype=ti.i32, shape=(num_jitters, width, height))  # bvh.primitive_id, -1: missed
+        self.front_face = ti.field(dtype=ti.i8, shape=(num_jitters, width, height))
+        self.valid = ti.field(dtype=ti.i32, shape=num_jitters)
+        self.layer = ti.field(dtype=ti.i32, shape=())  # the offset of the next frame
+
+    def invalidate(self):
+        self.valid.fill(0)
+        self.layer[None] = 0
+
+    def advance(self):
+        # after every frame, the layer it used is complete
+        self.valid[self.layer[None]] = 1
+        self.layer[None] = (self.layer[None] + 1) % self.num_jitters
+
+    # camera.get_ray coordinates of pixel (i, j) for this frame
+    @ti.func
+    def uv(self, i, j, width, height):
+        jitter = self.jitter[self.layer[None]]
+        return (i + jitter.x) / width, (j + jitter.y) / height
+
+    # Scene.hit_with_id of the camera ray of pixel (i, j), from the cache or traced and stored
+    @ti.func
+    def hit(self, scene, ray, i, j):
+        k = self.layer[None]
+        is_hit = False
+        hit_point = ti.Vector([0.0, 0.0, 0.0])
+        hit_point_normal = ti.Vector([0.0, 0.0, 0.0])
+        front_face = False
+        material = 1
+        primitive = -1
+        if self.valid[k]:
+            is_hit = self.primitive[k, i, j] >= 0
+            if ti.static(self.compact):
+                hit_point = ray.at(self.depth[k, i, j])
+                hit_point_normal = decode_octahedral(self.normal[k, i, j])
+            else:
+                hit_point = self.position[k, i, j]
+                hit_point_normal = self.normal[k, i, j]
+            front_face = self.front_face[k, i, j] != 0
+            material = self.material[k, i, j]
+            primitive = self.primitive[k, i, j]
+        else:
+            is_hit, hit_point, hit_point_normal, front_face, material, primitive = scene.hit_with_id(ray)
+            if ti.static(self.compact):
+                self.depth[k, i, j] = (hit_point - ray.origin).dot(ray.direction) / ray.direction.dot(ray.direction)
+                self.normal[k, i, j] = 0
+                if is_hit:
+                    self.normal[k, i, j] = encode_octahedral(hit_point_normal)
+            else:
+                self.position[k, i, j] = hit_point
+                self.normal[k, i, j] = hit_point_normal
+            self.front_face[k, i, j] = ti.cast(front_face, ti.i8)
+            self.material[k, i, j] = material
+            self.primitive[k, i, j] = primitive
+        return is_hit, hit_point, hit_point_normal, front_face, material, primitive
+
+    def aovs(self, width, height, layer=0, half=False):
+        # the first hits of one subpixel offset, as numpy arrays (i, j, ...), half: the float ones in f16
+        if not self.valid[layer]:
+            raise ValueError(f"jitter {layer} has not been traced since the last change")
+        aovs = {"material": self.material.to_numpy()[layer, :width, :height],
+                "primitive": self.primitive.to_numpy()[layer, :width, :height]}
+        if self.compact:
+            aovs["depth"] = self.depth.to_numpy()[layer, :width, :height]
+            aovs["normal"] = decode_octahedral_np(self.normal.to_numpy()[layer, :width, :height])
+        else:
+            aovs["position"] = self.position.to_numpy()[layer, :width, :height]
+            aovs["normal"] = self.normal.to_numpy()[layer, :width, :height]
+        if half:
+            for name in ("depth", "position", "normal"):
+                if name in aovs:
+                    aovs[name] = aovs[name].astype(np.float16)
+        return aovs
@@ -0,0 +1,221 @@
+import taichi as ti
+import taichi.math as tm
+from ray_tracing_tools import PI
+
+'''
+    Path guiding (Müller et al. 2017 "Practical path guiding", with a grid instead of the spatial tree):
+    the scene box is cut into RESOLUTION^3 cells, every cell holds a quadtree over the directions, mapped to
+    the unit square with the cylindrical equal-area map (u = (z + 1) / 2, v = phi / 2pi, constant jacobian 4pi).
+
+    Two sets of trees: the one from the last iteration is sampled, the other one learns. A training sample
+    adds the incident radiance it found divided by its pdf to every node from the root to its leaf.
+    At the end of an iteration the trees swap and the new learning trees are refined from the fresh ones:
+    a node holding more than SPLIT of the energy of its cell is split, down to MAX_DEPTH. Iterations double
+    in length (1, 2, 4, ... frames), later ones have less noise to learn from.
+
+    Diffuse bounces pick the quadtree with a probability alpha (per cell) and the BSDF otherwise, the pdf is
+    the mixture. alpha = sigmoid(theta), theta follows the gradient of the KL divergence between the
+    mixture and the radiance * cosine it samples (Müller 2019 "Practical path guiding in production").
+    Cells that received less than MIN_SAMPLES training samples in the last iteration only use the BSDF.
+'''
+
+RESOLUTION = 16
+MAX_NODES = 256   # per cell and per set
+MAX_DEPTH = 10
+SPLIT = 0.01
+LEARNING_RATE = 0.5
+MIN_SAMPLES = 256  # training samples a cell needs before its quadtree is trusted
+
+
+@ti.func
+def to_square(direction):
+    return ti.Vector([(direction.z + 1) / 2, (tm.atan2(direction.y, direction.x) / (2 * PI)) % 1.0])
+
+
+@ti.func
+def from_square(p):
+    z = 2 * p.x - 1
+    r = ti.sqrt(ti.max(1 - z * z, 0.0))
+    phi = 2 * PI * p.y
+    return ti.Vector([r * ti.cos(phi), r * ti.sin(phi), z])
+
+
+@ti.data_oriented
+class PathGuide:
+    def __init__(self, resolution=RESOLUTION, max_nodes=MAX_NODES):
+        self.resolution = resolution
+        num_cells = resolution ** 3
+        self.box_min = ti.Vector.field(3, dtype=ti.f32, shape=())
+        self.box_max = ti.Vector.field(3, dtype=ti.f32, shape=())
+        # [set, cell, node]: first of the 4 children (0 for a leaf) and the energy below the node
+        self.child = ti.field(dtype=ti.i32, shape=(2, num_cells, max_nodes))
+        self.energy = ti.field(dtype=ti.f32, shape=(2, num_cells, max_nodes))
+        self.num_nodes = ti.field(dtype=ti.i32, shape=(2, num_cells))
+        self.num_samples = ti.field(dtype=ti.i32, shape=(2, num_cells))
+        self.sampling = ti.field(dtype=ti.i32, shape=())  # the set that is sampled, 1 - sampling learns
+        # refinement bookkeeping of the new learning tree: node of the sampling tree it covers (-1: finer), depth
+        self.source = ti.field(dtype=ti.i32, shape=(num_cells, max_nodes))
+        self.depth = ti.field(dtype=ti.i32, shape=(num_cells, max_nodes))
+        # selection probability between the quadtree and the BSDF
+        self.theta = ti.field(dtype=ti.f32, shape=num_cells)
+        self.gradient = ti.field(dtype=ti.f32, shape=num_cells)
+        self.gradient_weight = ti.field(dtype=ti.f32, shape=num_cells)
+        self.reset()
+
+    def reset(self, box_min=None, box_max=None):
+        if box_min is not None:
+            # a little margin, hit points on the bounds stay inside
+            extent = [b - a for a, b in zip(box_min, box_max)]
+            self.box_min[None] = [a - 1e-3 * e - 1e-4 for a, e in zip(box_min, extent)]
+            self.box_max[None] = [b + 1e-3 * e + 1e-4 for b, e in zip(box_max, extent)]
+        self.clear_trees()
+        self.frames = 0
+        self.iteration_length = 1
+
+    @ti.kernel
+    def clear_trees(self):
+        for s, c in self.num_nodes:
+            self.num_nodes[s, c] = 1
+            self.num_samples[s, c] = 0
+            self.child[s, c, 0] = 0
+            self.energy[s, c, 0] = 0.0
+        for c in self.theta:
+            self.theta[c] = 0.0
+            self.gradient[c] = 0.0
+            self.gradient_weight[c] = 0.0
+        self.sampling[None] = 0
+
+    def advance(self):
+        # after every frame
+        self.frames += 1
+        if self.frames == self.iteration_length:
+            self.update()
+            self.frames = 0
+            self.iteration_length *= 2
+
+    @ti.func
+    def cell(self, p):
+        size = self.box_max[None] - self.box_min[None]
+        index = ti.floor((p - self.box_min[None]) / size * self.resolution, ti.i32)
+        index = ti.math.clamp(index, 0, self.resolution - 1)
+        return (index.x * self.resolution + index.y) * self.resolution + index.z
+
+    @ti.func
+    def enabled(self, cell):
+        s = self.sampling[None]
+        return self.num_samples[s, cell] >= MIN_SAMPLES and self.energy[s, cell, 0] > 0
+
+    @ti.func
+    def selection_probability(self, cell):
+        alpha = 0.0
+        if self.enabled(cell):
+            alpha = ti.math.clamp(1 / (1 + ti.exp(-self.theta[cell])), 0.1, 0.9)
+        return alpha
+
+    # direction from the sampling quadtree of the cell
+    @ti.func
+    def sample(self, cell):
+        s = self.sampling[None]
+        node = 0
+        origin = ti.Vector([0.0, 0.0])
+        size = 1.0
+        while self.child[s, cell, node] > 0:
+            first = self.child[s, cell, node]
+            r = ti.random() * self.energy[s, cell, node]
+            q = 0
+            while q < 3 and r >= self.energy[s, cell, first + q]:
+                r -= self.energy[s, cell, first + q]
+                q += 1
+            size /= 2
+            origin += ti.Vector([q & 1, q >> 1], dt=ti.f32) * size
+            node = first + q
+        return from_square(origin + ti.Vector([ti.random(), ti.random()]) * size)
+
+    # solid angle pdf of sample()
+    @ti.func
+    def pdf(self, cell, direction):
+        s = self.sampling[None]
+        p = to_square(direction)
+        node = 0
+        density = 1.0
+        while self.child[s, cell, node] > 0 and density > 0:
+            first = self.child[s, cell, node]
+            q = ti.cast(p.x >= 0.5, ti.i32) + 2 * ti.cast(p.y >= 0.5, ti.i32)
+            if self.energy[s, cell, node] > 0:
+                density *= 4 * self.energy[s, cell, first + q] / self.energy[s, cell, node]
+            else:
+                density = 0.0
+            p = p * 2 - ti.Vector([q & 1, q >> 1], dt=ti.f32)
+            node = first + q
+        return density / (4 * PI)
+
+    # a training sample: radiance arrived from direction, sampled with pdf;
+    # f_over_pdf = radiance * cos / PI / pdf and pdf_difference = (guide pdf - bsdf pdf) / pdf for alpha
+    @ti.func
+    def splat(self, cell, direction, radiance, pdf, f_over_pdf, pdf_difference):
+        s = 1 - self.sampling[None]
+        p = to_square(direction)
+        node = 0
+        value = radiance / pdf
+        ti.atomic_add(self.num_samples[s, cell], 1)
+        ti.atomic_add(self.energy[s, cell, node], value)
+        while self.child[s, cell, node] > 0:
+            q = ti.cast(p.x >= 0.5, ti.i32) + 2 * ti.cast(p.y >= 0.5, ti.i32)
+            p = p * 2 - ti.Vector([q & 1, q >> 1], dt=ti.f32)
+            node = self.child[s, cell, node] + q
+            ti.atomic_add(self.energy[s, cell, node], value)
+        if self.enabled(cell):
+            ti.atomic_add(self.gradient[cell], -f_over_pdf * pdf_difference)
+            ti.atomic_add(self.gradient_weight[cell], f_over_pdf)
+
+    @ti.kernel
+    def update_selection(self):
+        for c in self.theta:
+            if self.gradient_weight[c] > 0:
+                alpha = 1 / (1 + ti.exp(-self.theta[c]))
+                # d KL / d theta = d KL / d alpha * alpha * (1 - alpha), normalized by the estimate of the integral
+                step = self.gradient[c] / self.gradient_weight[c] * alpha * (1 - alpha)
+                self.theta[c] = ti.math.clamp(self.theta[c] - LEARNING_RATE * step, -3.0, 3.0)
+            self.gradient[c] = 0.0
+            self.gradient_weight[c] = 0.0
+
+    @ti.kernel
+    def refine(self):
+        # the set that just learned becomes the sampled one, the other one is rebuilt to learn from it
+        self.sampling[None] = 1 - self.sampling[None]
+        s = self.sampling[None]
+        t = 1 - s
+        for c in range(self.resolution ** 3):
+            total = self.energy[s, c, 0]
+            self.num_nodes[t, c] = 1
+            self.num_samples[t, c] = 0
+            self.child[t, c, 0] = 0
+            self.source[c, 0] = 0
+            self.depth[c, 0] = 0
+            n = 0
+            while n < self.num_nodes[t, c]:
+                # the energy of the node, spread evenly below the leaves of the sampling tree
+                e = 0.0
+                if self.source[c, n] >= 0:
+                    e = self.energy[s, c, self.source[c, n]]
+                else:
+                    e = self.energy[t, c, n]
+                self.energy[t, c, n] = e
+                first = self.num_nodes[t, c]
+                if total > 0 and e > SPLIT * total and self.depth[c, n] < MAX_DEPTH and first + 4 <= self.child.shape[2]:
+                    self.child[t, c, n] = first
+                    self.num_nodes[t, c] = first + 4
+                    for q in range(4):
+                        self.child[t, c, first + q] = 0
+                        self.depth[c, first + q] = self.depth[c, n] + 1
+                        self.source[c, first + q] = -1
+                        self.energy[t, c, first + q] = e / 4
+                        if self.source[c, n] >= 0 and self.child[s, c, self.source[c, n]] > 0:
+                            self.source[c, first + q] = self.child[s, c, self.source[c, n]] + q
+                n += 1
+            for k in range(self.num_nodes[t, c]):
+                self.energy[t, c, k] = 0.0
+
+    def update(self):
+        self.update_selection()
+        self.refine()
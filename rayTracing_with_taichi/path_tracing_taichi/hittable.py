@@ -1,25 +1,310 @@
 import taichi as ti
+import taichi.math as tm
+import numpy as np
+from object import Material, Plane, Cube, Sphere
+from bvh import BVHNode, hit_aabb, primitive_id, SPHERE, PLANE, CUBE, INSTANCE
+from ray_tracing_tools import Ray
+from lbvh import LBVH
+from environment import Environment
+from lights import LightSet
+from textures import TextureAtlas
+
+# capacities of the scene fields, a loaded scene may use any part of them
+MAX_MATERIALS = 1024
+MAX_SPHERES = 1024
+MAX_PLANES = 256
+MAX_CUBES = 256
+MAX_GEOMETRIES = 64
+MAX_BLAS_NODES = 4096
+MAX_INSTANCES = 4096
+
+
+# a shared piece of geometry: its BVH is blas_nodes[node_begin:node_end]
+@ti.dataclass
+class Geometry:
+    node_begin: ti.i32
+    node_end: ti.i32
+
+
+@ti.dataclass
+class Instance:
+    world_to_object: tm.mat3
+    offset: tm.vec3          # translation part of world_to_object
+    normal_matrix: tm.mat3   # object -> world for normals, transpose(world_to_object)
+    geometry: ti.i32
+    material: ti.i32         # -1 keeps the materials of the geometry
+
+
+def fill(records, arrays):
+    n = len(next(iter(arrays.values())))
+    if n > records.shape[0]:
+        raise ValueError(f"scene needs {n} records, the field only holds {records.shape[0]}")
+    padded = {}
+    for key, value in arrays.items():
+        padded[key] = np.zeros((records.shape[0],) + value.shape[1:], dtype=value.dtype)
+        padded[key][:n] = value
+    records.from_numpy(padded)
+    return n
+
 
 @ti.data_oriented
-class Hittable_list:
-    def __init__(self):
-        self.objects = []
-    def add(self, obj):
-        self.objects.append(obj)
-    def clear(self):
-        self.objects = []
+class Scene:
+    def __init__(self, max_materials=MAX_MATERIALS, max_spheres=MAX_SPHERES, max_planes=MAX_PLANES, max_cubes=MAX_CUBES,
+                 max_geometries=MAX_GEOMETRIES, max_blas_nodes=MAX_BLAS_NODES, max_instances=MAX_INSTANCES, lbvh=False):
+        # the material table, primitives refer to it by index
+        self.materials = Material.field(shape=max_materials)
+        self.spheres = Sphere.field(shape=max_spheres)
+        self.planes = Plane.field(shape=max_planes)
+        self.cubes = Cube.field(shape=max_cubes)
+        # only the first num_* primitives belong to the world, the others are referenced by geometries
+        self.num_spheres = ti.field(dtype=ti.i32, shape=())
+        self.num_planes = ti.field(dtype=ti.i32, shape=())
+        self.num_cubes = ti.field(dtype=ti.i32, shape=())
+
+        # two level instancing: TLAS over the instances, one BLAS per geometry
+        self.geometries = Geometry.field(shape=max_geometries)
+        self.blas_nodes = BVHNode.field(shape=max_blas_nodes)
+        self.instances = Instance.field(shape=max_instances)
+        self.tlas_nodes = BVHNode.field(shape=max(2 * max_instances - 1, 1))
+        self.num_tlas_nodes = ti.field(dtype=ti.i32, shape=())
+
+        # lbvh: the world primitives get a BVH built on the device (see lbvh.py) instead of being tested one by one
+        # what escaped rays see
+        self.environment = Environment()
+        # the emissive primitives, for next event estimation
+        self.lights = LightSet(self)
+        # the textures of the materials and the atlas of their images
+        self.textures = TextureAtlas()
+
+        self.use_lbvh = lbvh
+        self.lbvh = LBVH(self, max_spheres + max_planes + max_cubes) if lbvh else None
+
+    def check(self, data):
+        # every capacity before any field is written: a scene that does not fit raises and leaves the fields as they were
+        for name, records, arrays in (("materials", self.materials, data.materials), ("spheres", self.spheres, data.spheres),
+                                      ("planes", self.planes, data.planes), ("cubes", self.cubes, data.cubes),
+                                      ("geometries", self.geometries, data.geometries), ("BLAS nodes", self.blas_nodes, data.blas),
+                                      ("instances", self.instances, data.instances), ("TLAS nodes", self.tlas_nodes, data.tlas),
+                                      ("lights", self.lights.lights, data.lights), ("light tree nodes", self.lights.nodes, data.light_nodes)):
+            n = len(next(iter(arrays.values())))
+            if n > records.shape[0]:
+                raise ValueError(f"scene needs {n} {name}, the field only holds {records.shape[0]}")
+        self.textures.check(data.textures)
+
+    def load(self, data):
+        # data: scene.SceneData, only the field contents change so no kernel is recompiled
+        self.check(data)
+        fill(self.materials, data.materials)
+        fill(self.spheres, data.spheres)
+        fill(self.planes, data.planes)
+        fill(self.cubes, data.cubes)
+        self.num_spheres[None] = data.counts["spheres"]
+        self.num_planes[None] = data.counts["planes"]
+        self.num_cubes[None] = data.counts["cubes"]
+        fill(self.geometries, data.geometries)
+        fill(self.blas_nodes, data.blas)
+        fill(self.instances, data.instances)
+        self.num_tlas_nodes[None] = fill(self.tlas_nodes, data.tlas)
+        self.environment.load(data.environment)
+        self.lights.num_lights[None] = fill(self.lights.lights, data.lights)
+        fill(self.lights.nodes, data.light_nodes)
+        fill(self.lights.table, data.light_alias)
+        self.lights.total_power[None] = float(np.sum(data.lights["power"]))
+        self.textures.load(data.textures)
+        if self.use_lbvh:
+            self.lbvh.build()
+
+    # same boxes as scene.primitive_bounds
+    @ti.func
+    def primitive_box(self, kind, index):
+        center = ti.Vector([0.0, 0.0, 0.0])
+        half = 0.0
+        if kind == SPHERE:
+            center = self.spheres[index].center
+            half = ti.abs(self.spheres[index].radius)
+        elif kind == PLANE:
+            center = self.planes[index].center
+            half = self.planes[index].width / 2
+        else:
+            center = self.cubes[index].center
+            half = self.cubes[index].width / 2
+        return center - half, center + half
+
+    # texture coordinates of a hit on primitive (see primitive_id) and how many world units one uv unit spans there
+    #   sphere : longitude, latitude from the bottom; the smaller of the two spans, so the poles filter more
+    #   plane  : the square seen from the front, u along a tangent, v along the bitangent
+    #   cube   : every face gets the whole [0, 1] square, projected along the axis of the normal
+    #   instance: the primitive inside is not known, box projection of the world position (1 uv unit per world unit)
+    @ti.func
+    def surface_uv(self, primitive, hit_point, hit_point_normal):
+        kind = primitive % 4
+        index = primitive // 4
+        uv = ti.Vector([0.0, 0.0])
+        size = 1.0
+        axis = 0
+        if ti.abs(hit_point_normal.y) >= ti.abs(hit_point_normal.x) and ti.abs(hit_point_normal.y) >= ti.abs(hit_point_normal.z):
+            axis = 1
+        elif ti.abs(hit_point_normal.z) >= ti.abs(hit_point_normal.x):
+            axis = 2
+        if kind == SPHERE:
+            sphere = self.spheres[index]
+            d = (hit_point - sphere.center).normalized()
+            uv = ti.Vector([ti.atan2(-d.z, d.x) / (2 * tm.pi) + 0.5, ti.acos(tm.clamp(-d.y, -1.0, 1.0)) / tm.pi])
+            r = ti.abs(sphere.radius)
+            size = ti.min(2 * tm.pi * r * ti.sqrt(ti.max(1 - d.y * d.y, 0.0)), tm.pi * r)
+        elif kind == PLANE:
+            plane = self.planes[index]
+            helper = ti.Vector([0.0, 1.0, 0.0]) if ti.abs(plane.normal.y) < 0.9 else ti.Vector([0.0, 0.0, 1.0])
+            tangent = helper.cross(plane.normal).normalized()
+            bitangent = plane.normal.normalized().cross(tangent)
+            d = hit_point - plane.center
+            uv = ti.Vector([d.dot(tangent), d.dot(bitangent)]) / plane.width + 0.5
+            size = plane.width
+        elif kind == CUBE:
+            cube = self.cubes[index]
+            local = (hit_point - cube.center) / cube.width + 0.5
+            uv = ti.Vector([local.z, local.y]) if axis == 0 else (ti.Vector([local.x, local.z]) if axis == 1 else ti.Vector([local.x, local.y]))
+            size = cube.width
+        else:
+            uv = ti.Vector([hit_point.z, hit_point.y]) if axis == 0 else (
+                ti.Vector([hit_point.x, hit_point.z]) if axis == 1 else ti.Vector([hit_point.x, hit_point.y]))
+        return uv, size
+
+    # the color of mtl at a hit on primitive, footprint: width of the ray footprint there in world units
+    @ti.func
+    def albedo(self, mtl, primitive, hit_point, hit_point_normal, footprint):
+        color = mtl.color
+        if mtl.texture >= 0 and primitive >= 0:
+            uv, size = self.surface_uv(primitive, hit_point, hit_point_normal)
+            color *= self.textures.sample(mtl.texture, uv, footprint / ti.max(size, 1e-6))
+        return color
+
+    @ti.func
+    def hit_primitive(self, kind, index, ray, t_min, t_max):
+        is_hit = False
+        root = t_max
+        front_face = False
+        hit_point = ti.Vector([0.0, 0.0, 0.0])
+        hit_point_normal = ti.Vector([0.0, 0.0, 0.0])
+        material = 1
+        if kind == SPHERE:
+            is_hit, root, hit_point, hit_point_normal, front_face, material = self.spheres[index].hit(ray, t_min, t_max)
+        elif kind == PLANE:
+            is_hit, root, hit_point, hit_point_normal, front_face, material = self.planes[index].hit(ray, t_min, t_max)
+        else:
+            is_hit, root, hit_point, hit_point_normal, front_face, material = self.cubes[index].hit(ray, t_min, t_max)
+        return is_hit, root, hit_point, hit_point_normal, front_face, material
+
+    @ti.func
+    def hit_instance(self, index, ray, t_min, t_max):
+        closest_t = t_max
+        is_hit = False
+        front_face = False
+        hit_point = ti.Vector([0.0, 0.0, 0.0])
+        hit_point_normal = ti.Vector([0.0, 0.0, 0.0])
+        material = 1
+        instance = self.instances[index]
+        # the object space direction is not normalized, so t is the same in both spaces
+        local_ray = Ray(instance.world_to_object @ ray.origin + instance.offset, instance.world_to_object @ ray.direction)
+        geometry = self.geometries[instance.geometry]
+        j = geometry.node_begin
+        while j < geometry.node_end:
+            blas_node = self.blas_nodes[j]
+            if hit_aabb(blas_node.box_min, blas_node.box_max, local_ray, t_min, closest_t):
+                if blas_node.prim >= 0:
+                    is_hit_tmp, root_tmp, hit_point_tmp, hit_point_normal_tmp, front_face_tmp, material_tmp = self.hit_primitive(blas_node.kind, blas_node.prim, local_ray, t_min, closest_t)
+                    if is_hit_tmp:
+                        closest_t = root_tmp
+                        is_hit = True
+                        hit_point = ray.at(root_tmp)
+                        hit_point_normal = (instance.normal_matrix @ hit_point_normal_tmp).normalized()
+                        front_face = front_face_tmp
+                        material = material_tmp
+                        if instance.material >= 0:
+                            material = instance.material
+                j += 1
+            else:
+                j = blas_node.miss
+        return is_hit, closest_t, hit_point, hit_point_normal, front_face, material
+
+    @ti.func
+    def hit_instances(self, ray, t_min, t_max):
+        closest_t = t_max
+        is_hit = False
+        front_face = False
+        hit_point = ti.Vector([0.0, 0.0, 0.0])
+        hit_point_normal = ti.Vector([0.0, 0.0, 0.0])
+        material = 1
+        instance = -1
+        i = 0
+        while i < self.num_tlas_nodes[None]:
+            node = self.tlas_nodes[i]
+            if hit_aabb(node.box_min, node.box_max, ray, t_min, closest_t):
+                if node.prim >= 0:
+                    is_hit_tmp, root_tmp, hit_point_tmp, hit_point_normal_tmp, front_face_tmp, material_tmp = self.hit_instance(node.prim, ray, t_min, closest_t)
+                    if is_hit_tmp:
+                        closest_t = root_tmp
+                        is_hit = True
+                        hit_point = hit_point_tmp
+                        hit_point_normal = hit_point_normal_tmp
+                        front_face = front_face_tmp
+                        material = material_tmp
+                        instance = node.prim
+                i += 1
+            else:
+                i = node.miss
+        return is_hit, closest_t, hit_point, hit_point_normal, front_face, material, instance
 
     @ti.func
     def hit(self, ray, t_min=0.001, t_max=10e8):
+        is_hit, hit_point, hit_point_normal, front_face, material, _ = self.hit_with_id(ray, t_min, t_max)
+        return is_hit, hit_point, hit_point_normal, front_face, material
+
+    # hit() and the id of what was hit, see primitive_id (-1 for a miss)
+    @ti.func
+    def hit_with_id(self, ray, t_min=0.001, t_max=10e8):
         closest_t = t_max
         is_hit = False
         front_face = False
         hit_point = ti.Vector([0.0, 0.0, 0.0])
         hit_point_normal = ti.Vector([0.0, 0.0, 0.0])
-        color = ti.Vector([0.0, 0.0, 0.0])
         material = 1
-        for index in ti.static(range(len(self.objects))):
-            is_hit_tmp, root_tmp, hit_point_tmp, hit_point_normal_tmp, front_face_tmp, material_tmp, color_tmp =  self.objects[index].hit(ray, t_min, closest_t)
+        primitive = -1
+        if ti.static(self.use_lbvh):
+            is_hit, closest_t, hit_point, hit_point_normal, front_face, material, primitive = self.lbvh.hit(ray, t_min, closest_t)
+        else:
+            for index in range(self.num_spheres[None]):
+                is_hit_tmp, root_tmp, hit_point_tmp, hit_point_normal_tmp, front_face_tmp, material_tmp = self.spheres[index].hit(ray, t_min, closest_t)
+                if is_hit_tmp:
+                    closest_t = root_tmp
+                    is_hit = is_hit_tmp
+                    hit_point = hit_point_tmp
+                    hit_point_normal = hit_point_normal_tmp
+                    front_face = front_face_tmp
+                    material = material_tmp
+                    primitive = primitive_id(SPHERE, index)
+            for index in range(self.num_planes[None]):
+                is_hit_tmp, root_tmp, hit_point_tmp, hit_point_normal_tmp, front_face_tmp, material_tmp = self.planes[index].hit(ray, t_min, closest_t)
+                if is_hit_tmp:
+                    closest_t = root_tmp
+                    is_hit = is_hit_tmp
+                    hit_point = hit_point_tmp
+                    hit_point_normal = hit_point_normal_tmp
+                    front_face = front_face_tmp
+                    material = material_tmp
+                    primitive = primitive_id(PLANE, index)
+            for index in range(self.num_cubes[None]):
+                is_hit_tmp, root_tmp, hit_point_tmp, hit_point_normal_tmp, front_face_tmp, material_tmp = self.cubes[index].hit(ray, t_min, closest_t)
+                if is_hit_tmp:
+                    closest_t = root_tmp
+                    is_hit = is_hit_tmp
+                    hit_point = hit_point_tmp
+                    hit_point_normal = hit_point_normal_tmp
+                    front_face = front_face_tmp
+                    material = material_tmp
+                    primitive = primitive_id(CUBE, index)
+        if self.num_tlas_nodes[None] > 0:
+            is_hit_tmp, root_tmp, hit_point_tmp, hit_point_normal_tmp, front_face_tmp, material_tmp, instance = self.hit_instances(ray, t_min, closest_t)
             if is_hit_tmp:
                 closest_t = root_tmp
                 is_hit = is_hit_tmp
@@ -27,29 +312,5 @@ class Hittable_list:
                 hit_point_normal = hit_point_normal_tmp
                 front_face = front_face_tmp
                 material = material_tmp
-                color = color_tmp
-        return is_hit, hit_point, hit_point_normal, front_face, material, color
-
-    @ti.func
-    def hit_shadow(self, ray, t_min=0.001, t_max=10e8):
-        # 是否击中光源
-        is_hit_source = False
-        is_hit_source_temp = False
-        hitted_dielectric_num = 0
-        is_hitted_non_dielectric = False
-        # Compute the t_max to light source
-        is_hit_tmp, root_light_source, hit_point_tmp, hit_point_normal_tmp, front_face_tmp, material_tmp, color_tmp, shape_tmp = \
-        self.objects[0].hit(ray, t_min)
-        for index in ti.static(range(len(self.objects))):
-            is_hit_tmp, root_tmp, hit_point_tmp, hit_point_normal_tmp, front_face_tmp, material_tmp, color_tmp, shape_tmp =  self.objects[index].hit(ray, t_min, root_light_source)
-            if is_hit_tmp:
-                if material_tmp != 3 and material_tmp != 0:
-                    is_hitted_non_dielectric = True
-                if material_tmp == 3:
-                    hitted_dielectric_num += 1
-                if material_tmp == 0:
-                    is_hit_source_temp = True
-        if is_hit_source_temp and (not is_hitted_non_dielectric) and hitted_dielectric_num == 0:
-            is_hit_source = True
-        return is_hit_source, hitted_dielectric_num, is_hitted_non_dielectric
-        
\ No newline at end of file
+                primitive = primitive_id(INSTANCE, instance)
+        return is_hit, hit_point, hit_point_normal, front_face, material, primitive
@@ -0,0 +1,386 @@
+import argparse
+import time
+
+import taichi as ti
+import taichi.math as tm
+from bvh import hit_aabb, primitive_id
+
+'''
+    Linear BVH over the world primitives of a hittable.Scene, built on the device every time it is needed:
+        1. morton code of every primitive centroid (10 bits per axis)
+        2. LSD radix sort of the codes, 8 bits per pass
+        3. Karras 2012 hierarchy: every internal node finds its key range and split independently
+        4. bottom-up refit, the second child to arrive at a node computes its box (atomic counter)
+        5. miss links, so the traversal is the same stackless walk as bvh.py
+
+    Nodes 0 .. n-2 are internal (0 is the root), node n-1+i is the leaf of the i-th sorted primitive.
+    After the primitives moved, refit() only redoes step 4 (the tree stays valid, it just gets looser),
+    build() redoes everything; both record their time in self.timings (milliseconds).
+
+    The primitives are numbered spheres first, then planes, then cubes (only the world ones, see Scene.num_*).
+'''
+
+RADIX_BITS = 8
+RADIX = 1 << RADIX_BITS
+SORT_BLOCK = 1024   # keys handled by one thread of the radix sort, in order, which keeps the sort stable
+SCAN_CHUNK = 1024
+
+
+@ti.dataclass
+class LBVHNode:
+    box_min: tm.vec3
+    box_max: tm.vec3
+    left: ti.i32
+    right: ti.i32
+    parent: ti.i32   # -1 for the root
+    miss: ti.i32     # -1 ends the traversal
+    prim: ti.i32     # primitive of a leaf, -1 for internal nodes
+
+
+@ti.func
+def expand_bits(v):
+    # 10 bits -> 30 bits, two zeros after each bit
+    v = (v * ti.u32(0x00010001)) & ti.u32(0xFF0000FF)
+    v = (v * ti.u32(0x00000101)) & ti.u32(0x0F00F00F)
+    v = (v * ti.u32(0x00000011)) & ti.u32(0xC30C30C3)
+    v = (v * ti.u32(0x00000005)) & ti.u32(0x49249249)
+    return v
+
+
+@ti.data_oriented
+class LBVH:
+    def __init__(self, scene, max_prims, profile=False):
+        self.scene = scene
+        self.profile = profile   # sync after every stage, so that self.timings has the cost of each of them
+        self.timings = {}
+        self.num_prims = ti.field(dtype=ti.i32, shape=())
+        self.centroid_min = ti.Vector.field(3, dtype=ti.f32, shape=())
+        self.centroid_max = ti.Vector.field(3, dtype=ti.f32, shape=())
+
+        self.keys = ti.field(dtype=ti.u32, shape=max_prims)
+        self.values = ti.field(dtype=ti.i32, shape=max_prims)
+        self.keys_tmp = ti.field(dtype=ti.u32, shape=max_prims)
+        self.values_tmp = ti.field(dtype=ti.i32, shape=max_prims)
+        max_blocks = (max_prims + SORT_BLOCK - 1) // SORT_BLOCK
+        self.histogram = ti.field(dtype=ti.i32, shape=RADIX * max_blocks)
+        self.chunk_sum = ti.field(dtype=ti.i32, shape=(RADIX * max_blocks + SCAN_CHUNK - 1) // SCAN_CHUNK)
+
+        self.nodes = LBVHNode.field(shape=max(2 * max_prims - 1, 1))
+        self.visits = ti.field(dtype=ti.i32, shape=max(max_prims - 1, 1))
+
+    @ti.func
+    def primitive(self, p):
+        kind = 0
+        index = p
+        if index >= self.scene.num_spheres[None]:
+            index -= self.scene.num_spheres[None]
+            kind = 1
+            if index >= self.scene.num_planes[None]:
+                index -= self.scene.num_planes[None]
+                kind = 2
+        return kind, index
+
+    @ti.func
+    def primitive_box(self, p):
+        kind, index = self.primitive(p)
+        return self.scene.primitive_box(kind, index)
+
+    @ti.kernel
+    def compute_morton(self, n: ti.i32):
+        self.centroid_min[None] = ti.Vector([tm.inf, tm.inf, tm.inf])
+        self.centroid_max[None] = ti.Vector([-tm.inf, -tm.inf, -tm.inf])
+        for p in range(n):
+            box_min, box_max = self.primitive_box(p)
+            ti.atomic_min(self.centroid_min[None], (box_min + box_max) / 2)
+            ti.atomic_max(self.centroid_max[None], (box_min + box_max) / 2)
+        for p in range(n):
+            box_min, box_max = self.primitive_box(p)
+            extent = tm.max(self.centroid_max[None] - self.centroid_min[None], 1e-12)
+            q = tm.clamp(((box_min + box_max) / 2 - self.centroid_min[None]) / extent * 1024, 0, 1023)
+            self.keys[p] = (expand_bits(ti.cast(q.x, ti.u32)) << 2) | (expand_bits(ti.cast(q.y, ti.u32)) << 1) \
+                | expand_bits(ti.cast(q.z, ti.u32))
+            self.values[p] = p
+
+    @ti.kernel
+    def radix_histogram(self, keys: ti.template(), n: ti.i32, shift: ti.i32):
+        # histogram[digit * num_blocks + block], its exclusive scan is where each block writes each digit
+        num_blocks = (n + SORT_BLOCK - 1) // SORT_BLOCK
+        for i in range(RADIX * num_blocks):
+            self.histogram[i] = 0
+        for b in range(num_blocks):
+            for e in range(b * SORT_BLOCK, ti.min((b + 1) * SORT_BLOCK, n)):
+                self.histogram[ti.cast((keys[e] >> shift) & (RADIX - 1), ti.i32) * num_blocks + b] += 1
+
+    @ti.kernel
+    def radix_scan(self, n: ti.i32):
+        m = RADIX * ((n + SORT_BLOCK - 1) // SORT_BLOCK)
+        num_chunks = (m + SCAN_CHUNK - 1) // SCAN_CHUNK
+        for c in range(num_chunks):
+            total = 0
+            for i in range(c * SCAN_CHUNK, ti.min((c + 1) * SCAN_CHUNK, m)):
+                count = self.histogram[i]
+                self.histogram[i] = total
+                total += count
+            self.chunk_sum[c] = total
+        for _ in range(1):
+            total = 0
+            for c in range(num_chunks):
+                count = self.chunk_sum[c]
+                self.chunk_sum[c] = total
+                total += count
+        for i in range(m):
+            self.histogram[i] += self.chunk_sum[i // SCAN_CHUNK]
+
+    @ti.kernel
+    def radix_scatter(self, keys: ti.template(), values: ti.template(), keys_out: ti.template(),
+                      values_out: ti.template(), n: ti.i32, shift: ti.i32):
+        num_blocks = (n + SORT_BLOCK - 1) // SORT_BLOCK
+        for b in range(num_blocks):
+            for e in range(b * SORT_BLOCK, ti.min((b + 1) * SORT_BLOCK, n)):
+                slot = ti.cast((keys[e] >> shift) & (RADIX - 1), ti.i32) * num_blocks + b
+                dst = self.histogram[slot]
+                self.histogram[slot] = dst + 1
+                keys_out[dst] = keys[e]
+                values_out[dst] = values[e]
+
+    def radix_sort(self, n):
+        # an even number of passes, the sorted keys end up back in self.keys
+        for shift in range(0, 32, 2 * RADIX_BITS):
+            self.radix_histogram(self.keys, n, shift)
+            self.radix_scan(n)
+            self.radix_scatter(self.keys, self.values, self.keys_tmp, self.values_tmp, n, shift)
+            self.radix_histogram(self.keys_tmp, n, shift + RADIX_BITS)
+            self.radix_scan(n)
+            self.radix_scatter(self.keys_tmp, self.values_tmp, self.keys, self.values, n, shift + RADIX_BITS)
+
+    # length of the common prefix of the keys i and j, -1 out of range; equal keys fall back on the indices
+    @ti.func
+    def delta(self, i, j, n):
+        d = -1
+        if j >= 0 and j < n:
+            if self.keys[i] == self.keys[j]:
+                d = 32 + tm.clz(i ^ j)
+            else:
+                d = tm.clz(ti.cast(self.keys[i] ^ self.keys[j], ti.i32))
+        return d
+
+    @ti.kernel
+    def emit_hierarchy(self, n: ti.i32):
+        for i in range(n):
+            self.nodes[n - 1 + i] = LBVHNode(left=-1, right=-1, parent=-1, miss=-1, prim=self.values[i])
+        for i in range(n - 1):
+            # direction of the range of node i, then its other end j by exponential and binary search
+            d = 1 if self.delta(i, i + 1, n) > self.delta(i, i - 1, n) else -1
+            delta_min = self.delta(i, i - d, n)
+            l_max = 2
+            while self.delta(i, i + l_max * d, n) > delta_min:
+                l_max *= 2
+            l = 0
+            t = l_max // 2
+            while t >= 1:
+                if self.delta(i, i + (l + t) * d, n) > delta_min:
+                    l += t
+                t //= 2
+            j = i + l * d
+            # split position: the last key that shares more than delta_node bits with key i
+            delta_node = self.delta(i, j, n)
+            s = 0
+            div = 2
+            t = (l + div - 1) // div
+            while True:
+                if self.delta(i, i + (s + t) * d, n) > delta_node:
+                    s += t
+                if t == 1:
+                    break
+                div *= 2
+                t = (l + div - 1) // div
+            gamma = i + s * d + ti.min(d, 0)
+            left = gamma
+            if ti.min(i, j) == gamma:
+                left = n - 1 + gamma
+            right = gamma + 1
+            if ti.max(i, j) == gamma + 1:
+                right = n - 1 + gamma + 1
+            self.nodes[i].left = left
+            self.nodes[i].right = right
+            self.nodes[i].prim = -1
+            self.nodes[left].parent = i
+            self.nodes[right].parent = i
+        if n > 1:
+            self.nodes[0].parent = -1
+
+    @ti.kernel
+    def refit_bounds(self, n: ti.i32):
+        for i in range(n - 1):
+            self.visits[i] = 0
+        for i in range(n):
+            node = n - 1 + i
+            self.nodes[node].box_min, self.nodes[node].box_max = self.primitive_box(self.nodes[node].prim)
+            parent = self.nodes[node].parent
+            while parent >= 0:
+                # the first child to get here stops, the second one knows both boxes are ready
+                if ti.atomic_add(self.visits[parent], 1) == 0:
+                    break
+                left = self.nodes[self.nodes[parent].left]
+                right = self.nodes[self.nodes[parent].right]
+                self.nodes[parent].box_min = tm.min(left.box_min, right.box_min)
+                self.nodes[parent].box_max = tm.max(left.box_max, right.box_max)
+                parent = self.nodes[parent].parent
+
+    @ti.kernel
+    def link_miss(self, n: ti.i32):
+        # a node is missed -> go to the right sibling of the first ancestor entered from its left child
+        for node in range(2 * n - 1):
+            x = node
+            miss = -1
+            while self.nodes[x].parent >= 0:
+                parent = self.nodes[x].parent
+                if self.nodes[parent].left == x:
+                    miss = self.nodes[parent].right
+                    break
+                x = parent
+            self.nodes[node].miss = miss
+
+    def stage(self, name, func, *args):
+        if self.profile:
+            ti.sync()
+            start = time.perf_counter()
+            func(*args)
+            ti.sync()
+            self.timings[name] = (time.perf_counter() - start) * 1000
+        else:
+            func(*args)
+
+    def count(self):
+        return self.scene.num_spheres[None] + self.scene.num_planes[None] + self.scene.num_cubes[None]
+
+    def build(self):
+        start = time.perf_counter()
+        n = self.count()
+        self.num_prims[None] = n
+        if n > 0:
+            self.stage('morton', self.compute_morton, n)
+            self.stage('sort', self.radix_sort, n)
+            self.stage('hierarchy', self.emit_hierarchy, n)
+            self.stage('refit', self.refit_bounds, n)
+            self.stage('link', self.link_miss, n)
+        ti.sync()
+        self.timings['build'] = (time.perf_counter() - start) * 1000
+
+    def refit(self):
+        # same primitives, moved: keep the tree, only recompute the boxes
+        start = time.perf_counter()
+        n = self.num_prims[None]
+        if n > 0:
+            self.stage('refit', self.refit_bounds, n)
+        ti.sync()
+        self.timings['refit'] = (time.perf_counter() - start) * 1000
+
+    @ti.func
+    def hit(self, ray, t_min, t_max):
+        closest_t = t_max
+        is_hit = False
+        front_face = False
+        hit_point = ti.Vector([0.0, 0.0, 0.0])
+        hit_point_normal = ti.Vector([0.0, 0.0, 0.0])
+        material = 1
+        primitive = -1
+        node = 0 if self.num_prims[None] > 0 else -1
+        while node >= 0:
+            record = self.nodes[node]
+            if hit_aabb(record.box_min, record.box_max, ray, t_min, closest_t):
+                if record.prim >= 0:
+                    kind, index = self.primitive(record.prim)
+                    is_hit_tmp, root_tmp, hit_point_tmp, hit_point_normal_tmp, front_face_tmp, material_tmp = self.scene.hit_primitive(kind, index, ray, t_min, closest_t)
+                    if is_hit_tmp:
+                        closest_t = root_tmp
+                        is_hit = True
+                        hit_point = hit_point_tmp
+                        hit_point_normal = hit_point_normal_tmp
+                        front_face = front_face_tmp
+                        material = material_tmp
+                        primitive = primitive_id(kind, index)
+                    node = record.miss
+                else:
+                    node = record.left
+            else:
+                node = record.miss
+        return is_hit, closest_t, hit_point, hit_point_normal, front_face, material, primitive
+
+
+if __name__ == "__main__":
+    # rebuild vs refit on an animated cloud of spheres, and what each of them costs the primary rays
+    from hittable import Scene
+    from Camera import Camera
+
+    parser = argparse.ArgumentParser(description='LBVH rebuild / refit benchmark')
+    parser.add_argument(
+        '--num_spheres', type=int, default=1000000, help='number of moving spheres (default: 1000000)')
+    parser.add_argument(
+        '--frames', type=int, default=10, help='animated frames (default: 10)')
+    parser.add_argument(
+        '--resolution', type=int, default=256, help='primary rays are traced at resolution x resolution (default: 256)')
+    parser.add_argument(
+        '--arch', type=str, default='gpu', help='taichi arch: gpu, cuda, vulkan, cpu (default: gpu)')
+    args = parser.parse_args()
+
+    ti.init(arch=getattr(ti, args.arch))
+    n = args.num_spheres
+    scene = Scene(max_spheres=n, max_planes=1, max_cubes=1, max_geometries=1, max_blas_nodes=1, max_instances=1, lbvh=True)
+    camera = Camera()
+    origin = ti.Vector.field(3, dtype=ti.f32, shape=n)
+    hits = ti.field(dtype=ti.i32, shape=())
+
+    @ti.kernel
+    def scatter_spheres(n: ti.i32):
+        for i in range(n):
+            origin[i] = ti.Vector([ti.random(), ti.random(), ti.random()]) * 20 - 10
+            scene.spheres[i].radius = 0.02
+            scene.spheres[i].material = 0
+        scene.num_spheres[None] = n
+        scene.materials[0].type = 1
+        scene.materials[0].color = ti.Vector([0.5, 0.5, 0.5])
+
+    @ti.kernel
+    def move_spheres(n: ti.i32, time: ti.f32):
+        for i in range(n):
+            scene.spheres[i].center = origin[i] + ti.Vector([ti.sin(time + i), ti.cos(time * 1.3 + i), 0.0])
+
+    @ti.kernel
+    def trace(resolution: ti.i32):
+        hits[None] = 0
+        for i, j in ti.ndrange(resolution, resolution):
+            is_hit, _, _, _, _ = scene.hit(camera.get_ray((i + 0.5) / resolution, (j + 0.5) / resolution))
+            if is_hit:
+                hits[None] += 1
+
+    def timed(func, *func_args):
+        ti.sync()
+        start = time.perf_counter()
+        func(*func_args)
+        ti.sync()
+        return (time.perf_counter() - start) * 1000
+
+    scatter_spheres(n)
+    camera.look_at(ti.math.vec3(0, 0, -25), ti.math.vec3(0, 0, 0), 50)
+    results = {}
+    for mode in ('refit', 'rebuild'):
+        # refit: the tree of frame 0 follows the spheres, rebuild: a new tree every frame
+        move_spheres(n, 0.0)
+        scene.lbvh.build()
+        trace(args.resolution)
+        for frame in range(1, args.frames + 1):
+            move_spheres(n, frame * 0.1)
+            if mode == 'refit':
+                scene.lbvh.refit()
+            else:
+                scene.lbvh.build()
+            results[mode, frame] = (scene.lbvh.timings['refit' if mode == 'refit' else 'build'], timed(trace, args.resolution))
+    print(f'{n} spheres, primary rays {args.resolution}x{args.resolution}, times in ms')
+    print(f'{"frame":>5} {"refit":>9} {"trace":>9} {"rebuild":>9} {"trace":>9}')
+    for frame in range(1, args.frames + 1):
+        print(f'{frame:>5} {results["refit", frame][0]:>9.2f} {results["refit", frame][1]:>9.2f} '
+              f'{results["rebuild", frame][0]:>9.2f} {results["rebuild", frame][1]:>9.2f}')
+    scene.lbvh.profile = True
+    scene.lbvh.build()
+    print('build stages:', ', '.join(f'{k} {v:.2f}' for k, v in scene.lbvh.timings.items()))
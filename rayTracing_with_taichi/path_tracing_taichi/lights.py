@@ -0,0 +1,332 @@
+import taichi as ti
+import taichi.math as tm
+import numpy as np
+from bvh import build_bvh, SPHERE, PLANE
+from ray_tracing_tools import PI, random_unit_vector
+
+'''
+    Light sampling over the emissive primitives (the "lights" of a scene file). A light is picked with
+        UNIFORM : probability 1 / n
+        POWER   : probability power / total power, alias table
+        TREE    : descend a BVH over the lights, at every node the child is picked proportionally to an
+                  estimate of its contribution at the shading point (power, distance, bound on the cosine),
+                  O(log n) per shading point
+    then a point on it: spheres are sampled inside the cone they subtend, planes and the faces of cubes that
+    face the shading point by area.
+    Every pdf is a solid angle pdf, so that hits of the diffuse bounce on a light can be MIS weighted.
+'''
+
+MAX_LIGHTS = 4096
+
+UNIFORM = 0
+POWER = 1
+TREE = 2
+STRATEGIES = {"uniform": UNIFORM, "power": POWER, "tree": TREE}
+
+
+@ti.dataclass
+class Light:
+    kind: ti.i32    # SPHERE / PLANE / CUBE
+    index: ti.i32   # in scene.spheres / planes / cubes
+    node: ti.i32    # its leaf in the light tree
+    power: ti.f32
+
+
+@ti.dataclass
+class LightNode:
+    box_min: tm.vec3
+    box_max: tm.vec3
+    power: ti.f32
+    light: ti.i32   # -1 for interior nodes, whose children are node + 1 and nodes[node + 1].miss
+    miss: ti.i32
+
+
+@ti.dataclass
+class AliasEntry:
+    prob: ti.f32
+    alias: ti.i32
+
+
+# a plane / cube face is a square across the dominant axis of its normal: 0 on that axis, 1 on the others
+@ti.func
+def square_mask(normal):
+    mask = ti.Vector([1.0, 1.0, 1.0])
+    if ti.abs(normal.x) >= ti.abs(normal.y) and ti.abs(normal.x) >= ti.abs(normal.z):
+        mask.x = 0.0
+    elif ti.abs(normal.y) >= ti.abs(normal.z):
+        mask.y = 0.0
+    else:
+        mask.z = 0.0
+    return mask
+
+
+def alias_table(weights):
+    # Vose: prob[i] keeps i, otherwise alias[i]
+    n = len(weights)
+    prob = np.asarray(weights, dtype=np.float64) * n / max(np.sum(weights), 1e-20)
+    alias = np.arange(n)
+    small = [i for i in range(n) if prob[i] < 1.0]
+    large = [i for i in range(n) if prob[i] >= 1.0]
+    while small and large:
+        s, l = small.pop(), large[-1]
+        alias[s] = l
+        prob[l] += prob[s] - 1.0
+        if prob[l] < 1.0:
+            small.append(large.pop())
+    for i in small + large:
+        prob[i] = 1.0
+    return {"prob": prob.astype(np.float32), "alias": alias.astype(np.int32)}
+
+
+def build_lights(kind, index, box_min, box_max, power):
+    # host side: the light records, the light tree and the alias table, ready for LightSet.load
+    n = len(kind)
+    nodes = build_bvh(box_min, box_max, np.zeros(n, dtype=np.int32), np.arange(n))
+    count = len(nodes["prim"])
+    node_power = np.zeros(count, dtype=np.float32)
+    light_node = np.zeros(n, dtype=np.int32)
+    for node in reversed(range(count)):
+        if nodes["prim"][node] >= 0:
+            node_power[node] = power[nodes["prim"][node]]
+            light_node[nodes["prim"][node]] = node
+        else:
+            node_power[node] = node_power[node + 1] + node_power[nodes["miss"][node + 1]]
+    lights = {"kind": np.array(kind, dtype=np.int32), "index": np.array(index, dtype=np.int32),
+              "node": light_node, "power": np.array(power, dtype=np.float32)}
+    light_nodes = {"box_min": nodes["box_min"], "box_max": nodes["box_max"], "power": node_power,
+                   "light": nodes["prim"], "miss": nodes["miss"]}
+    return lights, light_nodes, alias_table(power)
+
+
+@ti.data_oriented
+class LightSet:
+    def __init__(self, scene, max_lights=MAX_LIGHTS):
+        self.scene = scene
+        self.lights = Light.field(shape=max_lights)
+        self.nodes = LightNode.field(shape=2 * max_lights - 1)
+        self.table = AliasEntry.field(shape=max_lights)
+        self.num_lights = ti.field(dtype=ti.i32, shape=())
+        self.total_power = ti.field(dtype=ti.f32, shape=())
+        self.strategy = ti.field(dtype=ti.i32, shape=())
+        self.strategy[None] = TREE
+
+    def set_strategy(self, name):
+        self.strategy[None] = STRATEGIES[name]
+
+    @ti.func
+    def importance(self, node, p, n):
+        record = self.nodes[node]
+        center = (record.box_min + record.box_max) / 2
+        radius = (record.box_max - record.box_min).norm() / 2
+        d = center - p
+        dist2 = d.dot(d)
+        # upper bound of the cosine at the shading point over the bounding sphere of the node
+        cos_upper = 1.0
+        if dist2 > radius * radius:
+            dist = ti.sqrt(dist2)
+            cos_theta = n.dot(d) / dist
+            sin_box = radius / dist
+            cos_box = ti.sqrt(1 - sin_box * sin_box)
+            if cos_theta < cos_box:
+                cos_upper = cos_theta * cos_box + ti.sqrt(ti.max(1 - cos_theta * cos_theta, 0.0)) * sin_box
+        return record.power * ti.max(cos_upper, 0.0) / ti.max(dist2, radius * radius)
+
+    @ti.func
+    def left_probability(self, node, p, n):
+        left = node + 1
+        importance_left = self.importance(left, p, n)
+        importance_right = self.importance(self.nodes[left].miss, p, n)
+        prob = 0.5
+        if importance_left + importance_right > 0:
+            prob = importance_left / (importance_left + importance_right)
+        return prob
+
+    # returns (light, probability of picking it)
+    @ti.func
+    def select(self, p, n):
+        light = 0
+        prob = 1.0
+        if self.strategy[None] == UNIFORM:
+            light = ti.min(ti.cast(ti.random() * self.num_lights[None], ti.i32), self.num_lights[None] - 1)
+            prob = 1.0 / self.num_lights[None]
+        elif self.strategy[None] == POWER:
+            light, prob = self.select_by_power()
+        else:
+            node = 0
+            while self.nodes[node].light < 0:
+                prob_left = self.left_probability(node, p, n)
+                if ti.random() < prob_left:
+                    node = node + 1
+                    prob *= prob_left
+                else:
+                    node = self.nodes[node + 1].miss
+                    prob *= 1 - prob_left
+            light = self.nodes[node].light
+        return light, prob
+
+    @ti.func
+    def select_by_power(self):
+        light = ti.min(ti.cast(ti.random() * self.num_lights[None], ti.i32), self.num_lights[None] - 1)
+        if ti.random() >= self.table[light].prob:
+            light = self.table[light].alias
+        return light, self.lights[light].power / self.total_power[None]
+
+    @ti.func
+    def selection_pdf(self, light, p, n):
+        prob = 1.0
+        if self.strategy[None] == UNIFORM:
+            prob = 1.0 / self.num_lights[None]
+        elif self.strategy[None] == POWER:
+            prob = self.lights[light].power / self.total_power[None]
+        else:
+            # same descent as select, steered towards the leaf of the light
+            target = self.lights[light].node
+            node = 0
+            while node != target:
+                prob_left = self.left_probability(node, p, n)
+                right = self.nodes[node + 1].miss
+                if target < right:
+                    node = node + 1
+                    prob *= prob_left
+                else:
+                    node = right
+                    prob *= 1 - prob_left
+        return prob
+
+    # faces of a cube that p sees: +1 / -1 per axis, 0 when p is between the two faces of that axis
+    @ti.func
+    def cube_faces(self, cube, p):
+        offset = p - cube.center
+        return ti.select(ti.abs(offset) > cube.width / 2, tm.sign(offset), 0.0)
+
+    # a point on the light seen from p: returns (direction (normalized), emitted radiance, solid angle pdf)
+    @ti.func
+    def sample(self, light, p):
+        record = self.lights[light]
+        direction = ti.Vector([0.0, 1.0, 0.0])
+        radiance = ti.Vector([0.0, 0.0, 0.0])
+        pdf = 0.0
+        if record.kind == SPHERE:
+            sphere = self.scene.spheres[record.index]
+            radiance = self.scene.materials[sphere.material].color
+            oc = sphere.center - p
+            dist2 = oc.dot(oc)
+            r2 = sphere.radius * sphere.radius
+            if dist2 > r2 * 1.0001:
+                # uniform in the cone of directions that hit the sphere
+                cos_max = ti.sqrt(1 - r2 / dist2)
+                cos_theta = 1 - ti.random() * (1 - cos_max)
+                sin_theta = ti.sqrt(ti.max(1 - cos_theta * cos_theta, 0.0))
+                phi = 2 * PI * ti.random()
+                w = oc / ti.sqrt(dist2)
+                u = (ti.Vector([0.0, 1.0, 0.0]) if ti.abs(w.x) > 0.9 else ti.Vector([1.0, 0.0, 0.0])).cross(w).normalized()
+                v = w.cross(u)
+                direction = (u * ti.cos(phi) * sin_theta + v * ti.sin(phi) * sin_theta + w * cos_theta).normalized()
+                pdf = 1 / (2 * PI * (1 - cos_max))
+        else:
+            center = ti.Vector([0.0, 0.0, 0.0])
+            normal = ti.Vector([0.0, 0.0, 0.0])
+            width = 0.0
+            area = 0.0
+            material = 0
+            if record.kind == PLANE:
+                plane = self.scene.planes[record.index]
+                center, normal, width, material = plane.center, plane.normal, plane.width, plane.material
+                area = width * width
+            else:
+                # one of the (at most three) faces turned towards p
+                cube = self.scene.cubes[record.index]
+                faces = self.cube_faces(cube, p)
+                num_faces = ti.abs(faces).sum()
+                pick = ti.min(ti.cast(ti.random() * num_faces, ti.i32), ti.cast(num_faces, ti.i32) - 1)
+                for a in ti.static(range(3)):
+                    if faces[a] != 0:
+                        if pick == 0:
+                            normal[a] = faces[a]
+                        pick -= 1
+                center, width, material = cube.center + normal * cube.width / 2, cube.width, cube.material
+                area = num_faces * width * width
+            point = center + (ti.Vector([ti.random(), ti.random(), ti.random()]) - 0.5) * width * square_mask(normal)
+            d = point - p
+            distance = d.norm()
+            direction = d / distance
+            cos_light = ti.abs(normal.normalized().dot(direction))
+            if cos_light > 1e-6 and area > 0:
+                pdf = distance * distance / (cos_light * area)
+            radiance = self.scene.materials[material].color
+        return direction, radiance, pdf
+
+    # solid angle pdf of sample() producing the ray p -> hit_point on the light
+    @ti.func
+    def pdf(self, light, p, hit_point, hit_point_normal):
+        record = self.lights[light]
+        pdf = 0.0
+        if record.kind == SPHERE:
+            sphere = self.scene.spheres[record.index]
+            oc = sphere.center - p
+            dist2 = oc.dot(oc)
+            r2 = sphere.radius * sphere.radius
+            if dist2 > r2 * 1.0001:
+                pdf = 1 / (2 * PI * (1 - ti.sqrt(1 - r2 / dist2)))
+        else:
+            area = 0.0
+            if record.kind == PLANE:
+                area = self.scene.planes[record.index].width ** 2
+            else:
+                cube = self.scene.cubes[record.index]
+                area = ti.abs(self.cube_faces(cube, p)).sum() * cube.width ** 2
+            d = hit_point - p
+            dist2 = d.dot(d)
+            cos_light = ti.abs(hit_point_normal.dot(d)) / ti.sqrt(dist2)
+            if cos_light > 1e-6 and area > 0:
+                pdf = dist2 / (cos_light * area)
+        return pdf
+
+    # surface the light emits from, both sides of a plane light count
+    @ti.func
+    def area(self, light):
+        record = self.lights[light]
+        area = 0.0
+        if record.kind == SPHERE:
+            area = 4 * PI * self.scene.spheres[record.index].radius ** 2
+        elif record.kind == PLANE:
+            area = 2 * self.scene.planes[record.index].width ** 2
+        else:
+            area = 6 * self.scene.cubes[record.index].width ** 2
+        return area
+
+    # a point uniform on the light: returns (point, normal, material), the normal of a plane light points
+    # to a random side, so that the density is 1 / area(light) on both
+    @ti.func
+    def sample_point(self, light):
+        record = self.lights[light]
+        point = ti.Vector([0.0, 0.0, 0.0])
+        normal = ti.Vector([0.0, 1.0, 0.0])
+        material = 0
+        if record.kind == SPHERE:
+            sphere = self.scene.spheres[record.index]
+            normal = random_unit_vector()
+            point = sphere.center + ti.abs(sphere.radius) * normal
+            material = sphere.material
+        else:
+            center = ti.Vector([0.0, 0.0, 0.0])
+            width = 0.0
+            if record.kind == PLANE:
+                plane = self.scene.planes[record.index]
+                normal = plane.normal.normalized() * (1.0 if ti.random() < 0.5 else -1.0)
+                center, width, material = plane.center, plane.width, plane.material
+            else:
+                cube = self.scene.cubes[record.index]
+                axis = ti.min(ti.cast(ti.random() * 3, ti.i32), 2)
+                normal = ti.Vector([axis == 0, axis == 1, axis == 2], dt=ti.f32) * (1.0 if ti.random() < 0.5 else -1.0)
+                center, width, material = cube.center + normal * cube.width / 2, cube.width, cube.material
+            point = center + (ti.Vector([ti.random(), ti.random(), ti.random()]) - 0.5) * width * square_mask(normal)
+        return point, normal, material
+
+    # a ray leaving the light, for photon tracing: returns (origin, direction, flux).
+    # Uniform on the surface, cosine distributed around the normal, flux = radiance * area * PI
+    @ti.func
+    def emit(self, light):
+        origin, normal, material = self.sample_point(light)
+        direction = (normal + random_unit_vector()).normalized()
+        return origin, direction, self.scene.materials[material].color * self.area(light) * PI
@@ -1,25 +1,45 @@
 import taichi as ti
+import taichi.math as tm
 
 
 '''
     Material
         0 : light_source
-        1 : diffuse  
+        1 : diffuse
         2 : metal        (金属)
         3 : glass        (dielectric)
         4 : Fuzz Metal   (有光泽)
+
+    The primitives are plain records (ti.dataclass) so that a scene lives in fields (see hittable.Scene)
+    and can be swapped or edited without recompiling the kernels.
+    A primitive only stores the index of its material in the material table (hittable.Scene.materials).
 '''
+LIGHT = 0
+DIFFUSE = 1
+METAL = 2
+GLASS = 3
+FUZZ_METAL = 4
+NUM_MATERIAL_TYPES = 5
+
+
+@ti.dataclass
+class Material:
+    type: ti.i32
+    color: tm.vec3    # albedo, the emitted radiance for a light source
+    fuzz: ti.f32      # 金属的粗糙程度
+    ior: ti.f32       # 折射率
+    light: ti.i32     # index in the light list (hittable.Scene.lights) of a sampled light source, else -1
+    texture: ti.i32   # index in the texture table (hittable.Scene.textures), it multiplies color, else -1
+
 
 # 平面
-@ti.data_oriented
+@ti.dataclass
 class Plane:
-    def __init__(self, center, normal, color, material=1, width=5, height=5):
-        self.center = center
-        self.normal = normal
-        self.color = color
-        self.material = material
-        self.width = width
-        self.height = height
+    center: tm.vec3
+    normal: tm.vec3
+    material: ti.i32
+    width: ti.f32
+    height: ti.f32
 
     @ti.func
     def is_inside_plane(self, point):
@@ -47,82 +67,65 @@ class Plane:
                 hit_point_normal = self.normal
                 if ray.direction.dot(hit_point_normal) < 0:
                     front_face = True
-        return is_hit, root, hit_point, hit_point_normal, front_face, self.material, self.color
+        return is_hit, root, hit_point, hit_point_normal, front_face, self.material
 
 
 # TODO:三角形
-@ti.data_oriented
-class Triangle:
-    def __init__(self, a, b, c, normal, color, material=1):
-        ...
 
-    
-    @ti.func
-    def hit(self, ray, t_min=0.001, t_max=10e8):
-        ...
 
 # 正方体
-@ti.data_oriented
+@ti.dataclass
 class Cube:
-    def __init__(self, center, material, color, width=1):
-        self.material = material
-        self.color = color
-
-        self.center = center
-        self.front_center = (center[0], center[1], center[2]-width/2)
-        self.bottom_center = (center[0], center[1]-width/2, center[2])
-        self.left_center = (center[0]-width/2, center[1], center[2])
-
-        self.front_normal = (self.front_center - center).normalized()
-        self.back_normal = -self.front_normal
-        self.left_normal = (self.left_center - center).normalized()
-        self.right_normal = -self.left_normal
-        self.bottom_normal = (self.bottom_center - center).normalized()
-        self.top_normal = -self.bottom_normal
-        self.width = width
-
-        self.plane_list = [
-            Plane(self.front_center, self.front_normal, color, material=self.material, width=self.width),
-            Plane(center + (center - self.front_center), self.back_normal, color, material=self.material, width=self.width),
-            Plane(self.left_center, self.left_normal, color, material=self.material, width=self.width),
-            Plane(center + (center - self.left_center), self.right_normal, color, material=self.material, width=self.width),
-            Plane(center + (center - self.bottom_center), self.top_normal, color, material=self.material, width=self.width),
-            Plane(self.bottom_center, self.bottom_normal, color, material=self.material, width=self.width),
-        ]
+    center: tm.vec3
+    material: ti.i32
+    width: ti.f32
 
     @ti.func
     def hit(self, ray, t_min=0.001, t_max=10e8):
-        closest_t = t_max
-        root = 0.0
+        # slab test against the six faces, the normals always point outward (same as the six planes it replaces)
         is_hit = False
         front_face = False
+        root = t_max
         hit_point = ti.Vector([0.0, 0.0, 0.0])
         hit_point_normal = ti.Vector([0.0, 0.0, 0.0])
-        color = ti.Vector([0.0, 0.0, 0.0])
-        material = self.material
-
-        for index in ti.static(range(len(self.plane_list))):
-            is_hit_tmp, root_tmp, hit_point_tmp, hit_point_normal_tmp, front_face_tmp, material_tmp, color_tmp =  self.plane_list[index].hit(ray, t_min, closest_t)
-            if is_hit_tmp:
-                closest_t = root_tmp
-                is_hit = is_hit_tmp
-                hit_point = hit_point_tmp
-                hit_point_normal = hit_point_normal_tmp
-                front_face = front_face_tmp
-                color = color_tmp
-                material = material_tmp
-        return is_hit, root, hit_point, hit_point_normal, front_face, material, color
+        t_enter = -tm.inf
+        t_exit = tm.inf
+        enter_axis = 0
+        exit_axis = 0
+        for a in ti.static(range(3)):
+            inv_d = 1.0 / ray.direction[a]
+            t0 = (self.center[a] - self.width / 2 - ray.origin[a]) * inv_d
+            t1 = (self.center[a] + self.width / 2 - ray.origin[a]) * inv_d
+            if inv_d < 0:
+                t0, t1 = t1, t0
+            if t0 > t_enter:
+                t_enter = t0
+                enter_axis = a
+            if t1 < t_exit:
+                t_exit = t1
+                exit_axis = a
+        if t_enter <= t_exit:
+            axis = -1
+            if t_enter > t_min and t_enter < t_max:
+                root = t_enter
+                axis = enter_axis
+                front_face = True
+            elif t_exit > t_min and t_exit < t_max:
+                root = t_exit
+                axis = exit_axis
+            if axis >= 0:
+                is_hit = True
+                hit_point = ray.at(root)
+                hit_point_normal[axis] = tm.sign(hit_point[axis] - self.center[axis])
+        return is_hit, root, hit_point, hit_point_normal, front_face, self.material
 
 
 # 球体
-@ti.data_oriented
+@ti.dataclass
 class Sphere:
-    def __init__(self, center, radius, material, color):
-        self.center = center
-        self.radius = radius
-        self.material = material
-        self.color = color
-
+    center: tm.vec3
+    radius: ti.f32
+    material: ti.i32
 
     @ti.func
     def hit(self, ray, t_min=0.001, t_max=10e8):
@@ -153,4 +156,4 @@ class Sphere:
                 front_face = True
             else:
                 hit_point_normal = -hit_point_normal
-        return is_hit, root, hit_point, hit_point_normal, front_face, self.material, self.color
+        return is_hit, root, hit_point, hit_point_normal, front_face, self.material
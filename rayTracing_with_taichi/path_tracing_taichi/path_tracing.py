@@ -1,101 +1,728 @@
 import taichi as ti
 import numpy as np
 import argparse
-from ray_tracing_tools import Ray, random_in_unit_sphere, refract, reflect, reflectance, random_unit_vector
-from camera import Camera
-from object import Plane, Cube, Sphere
-from hittable import Hittable_list
-
-ti.init(arch=ti.cuda)
+import os
+import time
+from ray_tracing_tools import Ray, PI, random_in_unit_sphere, refract, reflect, reflectance, random_unit_vector, power_heuristic
+from Camera import Camera
+from hittable import Scene
+from bvh import SPHERE, PLANE, CUBE, INSTANCE
+from object import LIGHT, DIFFUSE, METAL, GLASS, FUZZ_METAL, NUM_MATERIAL_TYPES
+from scene import load_scene, SceneWatcher, SCENE_DIR
+from checkpoint import Checkpoint, CheckpointWriter, load_checkpoint, seed_for
+from photons import PhotonMap
+from guiding import PathGuide
+from gbuffer import GBuffer, NUM_JITTERS
+from compact import encode_rgb9e5, encode_rgbe
+from film import film_fields, LAYOUTS, CHANNELS
+from profiler import FrameProfiler
+from budget import FrameBudget
 
 # Canvas
 aspect_ratio = 1.0
 image_width = 800
 image_height = int(image_width / aspect_ratio)
-canvas = ti.Vector.field(3, dtype=ti.f32, shape=(image_width, image_height))
 
 # Rendering parameters
 samples_per_pixel = 4
 max_depth = 10
 sample_on_unit_sphere_surface = True
+p_RR = 0.8  # russian roulette
+
+# material bins of the wavefront renderer
+TERMINATED = NUM_MATERIAL_TYPES
+NUM_BINS = NUM_MATERIAL_TYPES + 1
+PACKET_SIZE = 8  # primary ray packets are PACKET_SIZE x PACKET_SIZE pixels
+MAX_PACKET_CANDIDATES = 64  # per kind, a packet that sees more is traced ray by ray
+PHOTON_DEPTH = 8
+GUIDE_VERTICES = 4  # diffuse vertices of a path that train the guide with the radiance found after them
+ADAPTIVE_MIN_SAMPLES = 16  # adaptive sampling only judges a pixel after this many samples
+ROUGH_SPREAD = 0.1  # spread (radians) of a ray cone after a diffuse / fuzzy bounce, what it sees only needs a blurred texture
+MIN_CONE_COS = 0.05  # the footprint of a ray cone grows with 1 / cos at grazing angles, up to this
 
 
-@ti.kernel
-def clear():
-    for i, j in canvas:
-        canvas[i, j] = ti.Vector([0.0, 0.0, 0.0])
-    
-@ti.kernel
-def render():
-    for i, j in canvas:
-        u = (i + ti.random()) / image_width
-        v = (j + ti.random()) / image_height
-        color = ti.Vector([0.0, 0.0, 0.0])
-        for n in range(samples_per_pixel):
-            ray = camera.get_ray(u, v)
-            color += ray_color(ray)
-        color /= samples_per_pixel
-        canvas[i, j] += color
-
-# Path tracing
 @ti.func
-def ray_color(ray):
-    color_buffer = ti.Vector([0.0, 0.0, 0.0])
-    brightness = ti.Vector([1.0, 1.0, 1.0])
-    scattered_origin = ray.origin
-    scattered_direction = ray.direction
-    p_RR = 0.8
-    for n in range(max_depth):
-        if ti.random() > p_RR:
-            break
-        is_hit, hit_point, hit_point_normal, front_face, material, color = scene.hit(Ray(scattered_origin, scattered_direction))
-        if is_hit:
-            if material == 0:
-                color_buffer = color * brightness
-                break
+def luminance(color):
+    return color.dot(ti.Vector([0.2126, 0.7152, 0.0722]))
+
+
+@ti.data_oriented
+class PathTracer:
+    def __init__(self, scene, camera, width=image_width, height=image_height, sample_on_unit_sphere_surface=True, photons=None,
+                 guide=None, gbuffer=None, film_layout='dense', film_storage='aos', rr=p_RR, adaptive=0.0):
+        self.scene = scene
+        self.camera = camera
+        self.sample_on_unit_sphere_surface = sample_on_unit_sphere_surface
+        # russian roulette: the probability that a path goes on at every bounce (1: no russian roulette)
+        self.rr = rr
+        # caustics: a photons.PhotonMap, gathered at diffuse hits, it replaces the paths diffuse -> specular+ -> light
+        self.photons = photons
+        self.caustics = photons is not None
+        # path guiding: a guiding.PathGuide, learned and sampled at the diffuse bounces of render()
+        self.guide = guide
+        self.guiding = guide is not None
+        # first hit cache: a gbuffer.GBuffer, the camera rays of render() are looked up in it
+        self.gbuffer = gbuffer
+        self.caching = gbuffer is not None
+        # the canvas is allocated once at the largest resolution, smaller images use its lower-left corner
+        # canvas holds the linear sum of the samples, sample_count how many samples each pixel got
+        # film_layout / film_storage: how they are placed in memory, see film.py
+        # adaptive sampling (render(), > 0): also the sum of the squared luminance of the samples, a pixel stops getting
+        # samples once the relative standard error of its mean luminance is below adaptive
+        self.adaptive = adaptive
+        channels = [(3, ti.f32), (0, ti.i32)] + ([(0, ti.f32)] if adaptive > 0 else [])
+        self.canvas, self.sample_count, *luminance_sq = film_fields(width, height, channels, film_layout, film_storage)
+        self.luminance_sq = luminance_sq[0] if adaptive > 0 else None
+        # batched rendering of a camera array: a (view, x, y) film, every pixel of it gets the same number of samples
+        if camera.num_views > 1:
+            self.view_canvas = ti.Vector.field(3, dtype=ti.f32, shape=(camera.num_views, width, height))
+            self.view_samples = 0
+
+    def clear(self):
+        self.clear_canvas()
+        if self.caching:
+            self.gbuffer.invalidate()
+
+    @ti.kernel
+    def clear_canvas(self):
+        for i, j in self.canvas:
+            self.canvas[i, j] = ti.Vector([0.0, 0.0, 0.0])
+            self.sample_count[i, j] = 0
+            if ti.static(self.adaptive > 0):
+                self.luminance_sq[i, j] = 0.0
+
+    def render(self, width, height, samples_per_pixel, max_depth):
+        self.render_frame(width, height, samples_per_pixel, max_depth)
+        if self.caching:
+            self.gbuffer.advance()
+
+    @ti.kernel
+    def render_frame(self, width: ti.i32, height: ti.i32, samples_per_pixel: ti.i32, max_depth: ti.i32):
+        # struct-for: the pixels are visited in the storage order of the film layout
+        for i, j in self.canvas:
+            if i < width and j < height and self.needs_samples(i, j):
+                u = (i + ti.random()) / width
+                v = (j + ti.random()) / height
+                if ti.static(self.caching):
+                    u, v = self.gbuffer.uv(i, j, width, height)
+                ray = self.camera.get_ray(u, v)
+                spread = self.camera.pixel_spread(height)
+                color = ti.Vector([0.0, 0.0, 0.0])
+                for n in range(samples_per_pixel):
+                    sample = self.ray_color(ray, max_depth, i, j, spread)
+                    color += sample
+                    if ti.static(self.adaptive > 0):
+                        self.luminance_sq[i, j] += luminance(sample) ** 2
+                self.canvas[i, j] += color
+                self.sample_count[i, j] += samples_per_pixel
+
+    @ti.func
+    def needs_samples(self, i, j):
+        needed = True
+        if ti.static(self.adaptive > 0):
+            n = self.sample_count[i, j]
+            mean = luminance(self.canvas[i, j]) / ti.max(n, 1)
+            # a pixel that only got black samples so far has no variance estimate yet, it keeps sampling
+            if n >= ADAPTIVE_MIN_SAMPLES and mean > 0:
+                variance = ti.max(self.luminance_sq[i, j] / n - mean * mean, 0.0)
+                needed = ti.sqrt(variance / n) > self.adaptive * mean
+        return needed
+
+    def clear_views(self):
+        self.view_canvas.fill(0)
+        self.view_samples = 0
+
+    def render_views(self, width, height, samples_per_pixel, max_depth):
+        # every view of the camera array in one launch, small views / animation frames fill the device together
+        if self.caching:
+            raise ValueError("render_views does not go through the first hit cache, create the PathTracer without it")
+        self.render_views_frame(width, height, samples_per_pixel, max_depth)
+        self.view_samples += samples_per_pixel
+
+    @ti.kernel
+    def render_views_frame(self, width: ti.i32, height: ti.i32, samples_per_pixel: ti.i32, max_depth: ti.i32):
+        for view, i, j in ti.ndrange(self.camera.num_views, width, height):
+            u = (i + ti.random()) / width
+            v = (j + ti.random()) / height
+            ray = self.camera.get_ray(u, v, view)
+            spread = self.camera.pixel_spread(height, view)
+            color = ti.Vector([0.0, 0.0, 0.0])
+            for n in range(samples_per_pixel):
+                color += self.ray_color(ray, max_depth, i, j, spread)
+            self.view_canvas[view, i, j] += color
+
+    def view_images(self, width, height):
+        # (view, width, height, 3), like image()
+        return np.sqrt(self.view_canvas.to_numpy()[:, :width, :height] / max(self.view_samples, 1))
+
+    # Scene.hit_with_id, the camera ray of pixel (i, j) (bounce 0) goes through the first hit cache
+    @ti.func
+    def hit(self, ray, bounce, i, j):
+        is_hit = False
+        hit_point = ti.Vector([0.0, 0.0, 0.0])
+        hit_point_normal = ti.Vector([0.0, 0.0, 0.0])
+        front_face = False
+        material = 1
+        primitive = -1
+        if ti.static(self.caching):
+            if bounce == 0:
+                is_hit, hit_point, hit_point_normal, front_face, material, primitive = self.gbuffer.hit(self.scene, ray, i, j)
             else:
-                # Diffuse
-                if material == 1:
-                    target = hit_point + hit_point_normal
-                    if sample_on_unit_sphere_surface:
-                        target += random_unit_vector()
-                    else:
-                        target += random_in_unit_sphere()
-                    scattered_direction = target - hit_point
-                    scattered_origin = hit_point
-                    brightness *= color
-                # Metal and Fuzz Metal
-                elif material == 2 or material == 4:
-                    fuzz = 0.0
-                    if material == 4:
-                        fuzz = 0.4
-                    scattered_direction = reflect(scattered_direction.normalized(),
-                                                  hit_point_normal)
-                    if sample_on_unit_sphere_surface:
-                        scattered_direction += fuzz * random_unit_vector()
+                is_hit, hit_point, hit_point_normal, front_face, material, primitive = self.scene.hit_with_id(ray)
+        else:
+            is_hit, hit_point, hit_point_normal, front_face, material, primitive = self.scene.hit_with_id(ray)
+        return is_hit, hit_point, hit_point_normal, front_face, material, primitive
+
+    # 根据材质散射光线, returns (is_scattered, scattered_origin, scattered_direction, attenuation)
+    @ti.func
+    def scatter(self, mtl, direction, hit_point, hit_point_normal, front_face):
+        is_scattered = True
+        scattered_direction = direction
+        # Diffuse
+        if mtl.type == DIFFUSE:
+            target = hit_point + hit_point_normal
+            if ti.static(self.sample_on_unit_sphere_surface):
+                target += random_unit_vector()
+            else:
+                target += random_in_unit_sphere()
+            scattered_direction = target - hit_point
+        # Metal and Fuzz Metal
+        elif mtl.type == METAL or mtl.type == FUZZ_METAL:
+            scattered_direction = reflect(direction.normalized(), hit_point_normal)
+            if ti.static(self.sample_on_unit_sphere_surface):
+                scattered_direction += mtl.fuzz * random_unit_vector()
+            else:
+                scattered_direction += mtl.fuzz * random_in_unit_sphere()
+            if scattered_direction.dot(hit_point_normal) < 0:
+                is_scattered = False
+        # Dielectric
+        elif mtl.type == GLASS:
+            refraction_ratio = mtl.ior
+            if front_face:
+                refraction_ratio = 1 / refraction_ratio
+            cos_theta = min(-direction.normalized().dot(hit_point_normal), 1.0)
+            sin_theta = ti.sqrt(1 - cos_theta * cos_theta)
+            # total internal reflection
+            if refraction_ratio * sin_theta > 1.0 or reflectance(cos_theta, refraction_ratio) > ti.random():
+                scattered_direction = reflect(direction.normalized(), hit_point_normal)
+            else:
+                scattered_direction = refract(direction.normalized(), hit_point_normal, refraction_ratio)
+        return is_scattered, hit_point, scattered_direction, mtl.color
+
+    # pdf of a scattered direction, 0 for the (near) specular materials which are never light sampled
+    @ti.func
+    def bsdf_pdf(self, mtl, hit_point_normal, direction):
+        pdf = 0.0
+        if mtl.type == DIFFUSE:
+            pdf = ti.max(hit_point_normal.dot(direction.normalized()), 0.0) / PI
+        return pdf
+
+    # pdf of the diffuse bounce of render() producing direction, guided or not
+    @ti.func
+    def scatter_pdf(self, mtl, hit_point, hit_point_normal, direction):
+        pdf = self.bsdf_pdf(mtl, hit_point_normal, direction)
+        if ti.static(self.guiding):
+            cell = self.guide.cell(hit_point)
+            alpha = self.guide.selection_probability(cell)
+            pdf = alpha * self.guide.pdf(cell, direction.normalized()) + (1 - alpha) * pdf
+        return pdf
+
+    # radiance of the environment seen by an escaped ray, bsdf_pdf: pdf of the bounce that produced it
+    # (0 for camera rays and specular bounces, which the light sampling cannot produce)
+    @ti.func
+    def environment_light(self, direction, bsdf_pdf):
+        radiance = ti.Vector([0.0, 0.0, 0.0])
+        if self.scene.environment.enabled():
+            radiance = self.scene.environment.eval(direction)
+            if bsdf_pdf > 0:
+                radiance *= power_heuristic(bsdf_pdf, self.scene.environment.pdf(direction))
+        return radiance
+
+    # solid angle pdf of next event estimation reaching hit_point on a light from origin (with normal origin_normal)
+    @ti.func
+    def light_pdf(self, light, origin, origin_normal, hit_point, hit_point_normal):
+        return self.scene.lights.selection_pdf(light, origin, origin_normal) * self.scene.lights.pdf(light, origin, hit_point, hit_point_normal)
+
+    # radiance of a light hit by a path, bsdf_pdf as for environment_light; diffuse_vertex: the path went through
+    # a diffuse hit, with the caustic photon map the specular chains that follow one are left to the photons
+    @ti.func
+    def emitted(self, mtl, bsdf_pdf, origin, origin_normal, hit_point, hit_point_normal, diffuse_vertex):
+        radiance = mtl.color
+        if bsdf_pdf > 0 and mtl.light >= 0:
+            radiance *= power_heuristic(bsdf_pdf, self.light_pdf(mtl.light, origin, origin_normal, hit_point, hit_point_normal))
+        if ti.static(self.caustics):
+            if diffuse_vertex and bsdf_pdf == 0 and mtl.light >= 0:
+                radiance = ti.Vector([0.0, 0.0, 0.0])
+        return radiance
+
+    # caustic radiance leaving a diffuse hit towards -direction
+    @ti.func
+    def caustic(self, mtl, hit_point, hit_point_normal, direction):
+        radiance = ti.Vector([0.0, 0.0, 0.0])
+        if ti.static(self.caustics):
+            radiance = mtl.color / PI * self.photons.gather(hit_point, hit_point_normal, direction)
+        return radiance
+
+    # next event estimation at a diffuse hit, MIS weighted against the diffuse bounce:
+    # one sample of the environment and one of the light list
+    @ti.func
+    def sample_lights(self, mtl, hit_point, hit_point_normal):
+        radiance = ti.Vector([0.0, 0.0, 0.0])
+        if self.scene.environment.enabled():
+            direction, light, pdf = self.scene.environment.sample()
+            cos_theta = hit_point_normal.dot(direction)
+            if pdf > 0 and cos_theta > 0:
+                is_hit, _, _, _, _ = self.scene.hit(Ray(hit_point, direction))
+                if not is_hit:
+                    radiance = mtl.color / PI * cos_theta * light / pdf * power_heuristic(pdf, self.scatter_pdf(mtl, hit_point, hit_point_normal, direction))
+        if self.scene.lights.num_lights[None] > 0:
+            light, select_pdf = self.scene.lights.select(hit_point, hit_point_normal)
+            direction, emission, pdf = self.scene.lights.sample(light, hit_point)
+            cos_theta = hit_point_normal.dot(direction)
+            if pdf > 0 and select_pdf > 0 and cos_theta > 0:
+                # visible if the first thing the ray hits is that light
+                is_hit, _, _, _, material = self.scene.hit(Ray(hit_point, direction))
+                if is_hit and self.scene.materials[material].light == light:
+                    pdf *= select_pdf
+                    radiance += mtl.color / PI * cos_theta * emission / pdf * power_heuristic(pdf, self.scatter_pdf(mtl, hit_point, hit_point_normal, direction))
+        return radiance
+
+    # Guided diffuse bounce: the quadtree of the cell with probability alpha, the BSDF otherwise.
+    # returns (is_scattered, direction, attenuation (cos / PI / pdf included), mixture pdf, guide pdf - bsdf pdf)
+    @ti.func
+    def guided_scatter(self, mtl, direction, hit_point, hit_point_normal, cell):
+        alpha = self.guide.selection_probability(cell)
+        if ti.random() < alpha:
+            direction = self.guide.sample(cell)
+        direction = direction.normalized()
+        guide_pdf = self.guide.pdf(cell, direction)
+        bsdf_pdf = self.bsdf_pdf(mtl, hit_point_normal, direction)
+        pdf = alpha * guide_pdf + (1 - alpha) * bsdf_pdf
+        cos_theta = hit_point_normal.dot(direction)
+        is_scattered = pdf > 0 and cos_theta > 0
+        attenuation = ti.Vector([0.0, 0.0, 0.0])
+        if is_scattered:
+            attenuation = mtl.color * cos_theta / PI / pdf
+        return is_scattered, direction, attenuation, pdf, guide_pdf - bsdf_pdf
+
+    # vertices: one row per guiding vertex of the path, (cell, direction, luminance of the throughput after it,
+    # radiance found after it, pdf, cos / PI / pdf, (guide pdf - bsdf pdf) / pdf), rows with no throughput are empty
+    @ti.func
+    def record_radiance(self, vertices, contribution):
+        if ti.static(self.guiding):
+            radiance = contribution.dot(ti.Vector([0.2126, 0.7152, 0.0722]))
+            for v in ti.static(range(GUIDE_VERTICES)):
+                if vertices[v, 4] > 0:
+                    vertices[v, 5] += radiance / vertices[v, 4]
+        return vertices
+
+    @ti.func
+    def train_guide(self, vertices, v: ti.template()):
+        if vertices[v, 4] > 0:
+            self.guide.splat(ti.cast(vertices[v, 0], ti.i32), ti.Vector([vertices[v, 1], vertices[v, 2], vertices[v, 3]]),
+                             vertices[v, 5], vertices[v, 6], vertices[v, 5] * vertices[v, 7], vertices[v, 8])
+
+    # Path tracing
+    # spread: angle of the ray cone around ray (0: textures are not filtered); the cone is as wide as the pixel
+    # footprint, widens along every segment and spreads to at least ROUGH_SPREAD at a diffuse / fuzzy bounce,
+    # its width at a hit picks how much the texture there is filtered (ray cones, a cheap form of ray differentials)
+    @ti.func
+    def ray_color(self, ray, max_depth, i, j, spread=0.0):
+        color_buffer = ti.Vector([0.0, 0.0, 0.0])
+        cone_width = 0.0
+        cone_spread = spread
+        # every ray goes through the russian roulette, the camera ray too
+        brightness = ti.Vector([1.0, 1.0, 1.0]) / self.rr
+        scattered_origin = ray.origin
+        scattered_direction = ray.direction
+        scattered_normal = ti.Vector([0.0, 0.0, 0.0])
+        bsdf_pdf = 0.0
+        diffuse_vertex = False
+        vertices = ti.Matrix.zero(ti.f32, GUIDE_VERTICES, 9)
+        for n in range(max_depth):
+            survives = ti.random() <= self.rr
+            if ti.static(self.caching):
+                # the camera ray is looked up before the roulette, so that the frame filling a cache layer
+                # writes the entry of every pixel (the roll does not depend on the hit, the estimate is the same)
+                if n > 0 and not survives:
+                    break
+            elif not survives:
+                break
+            is_hit, hit_point, hit_point_normal, front_face, material, primitive = self.hit(Ray(scattered_origin, scattered_direction), n, i, j)
+            if ti.static(self.caching):
+                if not survives:
+                    break
+            if not is_hit:
+                contribution = brightness * self.environment_light(scattered_direction, bsdf_pdf)
+                color_buffer += contribution
+                vertices = self.record_radiance(vertices, contribution)
+                break
+            mtl = self.scene.materials[material]
+            cone_width += cone_spread * (hit_point - scattered_origin).norm()
+            if mtl.texture >= 0:
+                # everything below sees the textured color
+                cos_theta = ti.abs(hit_point_normal.dot(scattered_direction.normalized()))
+                mtl.color = self.scene.albedo(mtl, primitive, hit_point, hit_point_normal, cone_width / ti.max(cos_theta, MIN_CONE_COS))
+            if mtl.type == LIGHT:
+                contribution = brightness * self.emitted(mtl, bsdf_pdf, scattered_origin, scattered_normal, hit_point, hit_point_normal, diffuse_vertex)
+                color_buffer += contribution
+                vertices = self.record_radiance(vertices, contribution)
+                break
+            if mtl.type == DIFFUSE:
+                contribution = brightness * (self.sample_lights(mtl, hit_point, hit_point_normal)
+                                             + self.caustic(mtl, hit_point, hit_point_normal, scattered_direction))
+                color_buffer += contribution
+                vertices = self.record_radiance(vertices, contribution)
+                diffuse_vertex = True
+            is_scattered, scattered_origin, scattered_direction, attenuation = self.scatter(
+                mtl, scattered_direction, hit_point, hit_point_normal, front_face)
+            bsdf_pdf = self.bsdf_pdf(mtl, hit_point_normal, scattered_direction)
+            if ti.static(self.guiding):
+                if mtl.type == DIFFUSE:
+                    cell = self.guide.cell(hit_point)
+                    is_scattered, scattered_direction, attenuation, bsdf_pdf, pdf_difference = self.guided_scatter(
+                        mtl, scattered_direction, hit_point, hit_point_normal, cell)
+                    if is_scattered:
+                        # the oldest vertex leaves the window
+                        self.train_guide(vertices, GUIDE_VERTICES - 1)
+                        for v in ti.static(range(GUIDE_VERTICES - 1, 0, -1)):
+                            for c in ti.static(range(9)):
+                                vertices[v, c] = vertices[v - 1, c]
+                        cos_theta = hit_point_normal.dot(scattered_direction)
+                        throughput = luminance(brightness * attenuation / self.rr)
+                        vertices[0, 0] = cell
+                        for c in ti.static(range(3)):
+                            vertices[0, 1 + c] = scattered_direction[c]
+                        vertices[0, 4] = throughput
+                        vertices[0, 5] = 0.0
+                        vertices[0, 6] = bsdf_pdf
+                        vertices[0, 7] = cos_theta / PI / bsdf_pdf
+                        vertices[0, 8] = pdf_difference / bsdf_pdf
+            if not is_scattered:
+                break
+            if mtl.type == DIFFUSE or mtl.type == FUZZ_METAL:
+                cone_spread = ti.max(cone_spread, ROUGH_SPREAD)
+            scattered_normal = hit_point_normal
+            brightness *= attenuation / self.rr
+        if ti.static(self.guiding):
+            for v in ti.static(range(GUIDE_VERTICES)):
+                self.train_guide(vertices, v)
+        return color_buffer
+
+    # Wavefront path tracing: one kernel per bounce over the paths still alive. Between tracing and
+    # shading the hits are grouped by material type (counting sort), so neighbouring threads / SIMD lanes
+    # run the same branch of scatter() instead of diverging on every pixel.
+    def allocate_paths(self):
+        num_paths = self.canvas.shape[0] * self.canvas.shape[1]
+        self.path_origin = ti.Vector.field(3, dtype=ti.f32, shape=num_paths)
+        self.path_direction = ti.Vector.field(3, dtype=ti.f32, shape=num_paths)
+        self.path_throughput = ti.Vector.field(3, dtype=ti.f32, shape=num_paths)
+        self.path_bsdf_pdf = ti.field(dtype=ti.f32, shape=num_paths)
+        self.path_normal = ti.Vector.field(3, dtype=ti.f32, shape=num_paths)  # normal at path_origin, for the light pdf
+        self.path_diffuse = ti.field(dtype=ti.i32, shape=num_paths)  # the path went through a diffuse hit
+        self.path_pixel = ti.Vector.field(2, dtype=ti.i32, shape=num_paths)
+        # queue of the alive paths and the hit of each queue slot
+        self.active = ti.field(dtype=ti.i32, shape=num_paths)
+        self.next_active = ti.field(dtype=ti.i32, shape=num_paths)
+        self.num_active = ti.field(dtype=ti.i32, shape=())
+        self.num_next = ti.field(dtype=ti.i32, shape=())
+        self.hit_point = ti.Vector.field(3, dtype=ti.f32, shape=num_paths)
+        self.hit_normal = ti.Vector.field(3, dtype=ti.f32, shape=num_paths)
+        self.hit_front_face = ti.field(dtype=ti.i32, shape=num_paths)
+        self.hit_material = ti.field(dtype=ti.i32, shape=num_paths)
+        # one bin per material type, the last one collects the terminated paths
+        self.hit_bin = ti.field(dtype=ti.i32, shape=num_paths)
+        self.bin_count = ti.field(dtype=ti.i32, shape=NUM_BINS)
+        self.bin_offset = ti.field(dtype=ti.i32, shape=NUM_BINS)
+        self.order = ti.field(dtype=ti.i32, shape=num_paths)
+        # per kind, the indices of what each primary ray packet can see, see trace_primary_packets
+        num_tiles = ((self.canvas.shape[0] + PACKET_SIZE - 1) // PACKET_SIZE) * ((self.canvas.shape[1] + PACKET_SIZE - 1) // PACKET_SIZE)
+        self.packet_candidates = ti.field(dtype=ti.i32, shape=(num_tiles, 4, MAX_PACKET_CANDIDATES))
+
+    @ti.kernel
+    def generate_paths(self, width: ti.i32, height: ti.i32):
+        for i, j in ti.ndrange(width, height):
+            k = i * height + j
+            u = (i + ti.random()) / width
+            v = (j + ti.random()) / height
+            ray = self.camera.get_ray(u, v)
+            self.path_origin[k] = ray.origin
+            self.path_direction[k] = ray.direction
+            self.path_throughput[k] = ti.Vector([1.0, 1.0, 1.0]) / self.rr
+            self.path_bsdf_pdf[k] = 0.0
+            self.path_diffuse[k] = 0
+            self.path_pixel[k] = ti.Vector([i, j])
+            self.active[k] = k
+            self.sample_count[i, j] += 1
+        self.num_active[None] = width * height
+
+    @ti.kernel
+    def trace_paths(self):
+        for b in range(NUM_BINS):
+            self.bin_count[b] = 0
+        for s in range(self.num_active[None]):
+            k = self.active[s]
+            key = TERMINATED
+            if ti.random() <= self.rr:
+                is_hit, hit_point, hit_point_normal, front_face, material = self.scene.hit(Ray(self.path_origin[k], self.path_direction[k]))
+                if is_hit:
+                    self.hit_point[s] = hit_point
+                    self.hit_normal[s] = hit_point_normal
+                    self.hit_front_face[s] = front_face
+                    self.hit_material[s] = material
+                    key = self.scene.materials[material].type
+                else:
+                    self.add_environment_light(k)
+            self.hit_bin[s] = key
+            ti.atomic_add(self.bin_count[key], 1)
+
+    # Primary rays in packets: one thread per PACKET_SIZE x PACKET_SIZE tile walks the primitives (or the LBVH
+    # over them) and the TLAS once for the whole tile, keeping only what the frustum of the tile can see (one list per kind).
+    # Every ray of the tile is then intersected with those short lists. Only right after generate_paths,
+    # where the path of pixel (i, j) sits in queue slot i * height + j.
+    @ti.kernel
+    def trace_primary_packets(self, width: ti.i32, height: ti.i32):
+        for b in range(NUM_BINS):
+            self.bin_count[b] = 0
+        tiles_y = (height + PACKET_SIZE - 1) // PACKET_SIZE
+        for tx, ty in ti.ndrange((width + PACKET_SIZE - 1) // PACKET_SIZE, tiles_y):
+            tile = tx * tiles_y + ty
+            i0 = tx * PACKET_SIZE
+            j0 = ty * PACKET_SIZE
+            i1 = ti.min(i0 + PACKET_SIZE, width)
+            j1 = ti.min(j0 + PACKET_SIZE, height)
+            frustum = self.camera.get_frustum(i0 / width, j0 / height, i1 / width, j1 / height)
+            num_spheres = 0
+            num_planes = 0
+            num_cubes = 0
+            if ti.static(self.scene.use_lbvh):
+                # the same stackless walk as LBVH.hit, with the frustum test in place of the ray test
+                node = 0 if self.scene.lbvh.num_prims[None] > 0 else -1
+                while node >= 0:
+                    record = self.scene.lbvh.nodes[node]
+                    if frustum.hit_box(record.box_min, record.box_max):
+                        if record.prim >= 0:
+                            kind, index = self.scene.lbvh.primitive(record.prim)
+                            if kind == SPHERE:
+                                num_spheres = self.add_packet_candidate(tile, SPHERE, num_spheres, index)
+                            elif kind == PLANE:
+                                num_planes = self.add_packet_candidate(tile, PLANE, num_planes, index)
+                            else:
+                                num_cubes = self.add_packet_candidate(tile, CUBE, num_cubes, index)
+                            node = record.miss
+                        else:
+                            node = record.left
                     else:
-                        scattered_direction += fuzz * random_in_unit_sphere()
-                    scattered_origin = hit_point
-                    if scattered_direction.dot(hit_point_normal) < 0:
+                        node = record.miss
+            else:
+                for index in range(self.scene.num_spheres[None]):
+                    sphere = self.scene.spheres[index]
+                    if frustum.hit_sphere(sphere.center, ti.abs(sphere.radius)):
+                        num_spheres = self.add_packet_candidate(tile, SPHERE, num_spheres, index)
+                for index in range(self.scene.num_planes[None]):
+                    plane = self.scene.planes[index]
+                    if frustum.hit_box(plane.center - plane.width / 2, plane.center + plane.width / 2):
+                        num_planes = self.add_packet_candidate(tile, PLANE, num_planes, index)
+                for index in range(self.scene.num_cubes[None]):
+                    cube = self.scene.cubes[index]
+                    if frustum.hit_box(cube.center - cube.width / 2, cube.center + cube.width / 2):
+                        num_cubes = self.add_packet_candidate(tile, CUBE, num_cubes, index)
+            num_instances = 0
+            n = 0
+            while n < self.scene.num_tlas_nodes[None]:
+                node = self.scene.tlas_nodes[n]
+                if frustum.hit_box(node.box_min, node.box_max):
+                    if node.prim >= 0:
+                        num_instances = self.add_packet_candidate(tile, INSTANCE, num_instances, node.prim)
+                    n += 1
+                else:
+                    n = node.miss
+            overflow = ti.max(ti.max(num_spheres, num_planes), ti.max(num_cubes, num_instances)) > MAX_PACKET_CANDIDATES
+            for i in range(i0, i1):
+                for j in range(j0, j1):
+                    k = i * height + j
+                    # same russian roulette and bins as trace_paths
+                    key = TERMINATED
+                    if ti.random() <= self.rr:
+                        ray = Ray(self.path_origin[k], self.path_direction[k])
+                        is_hit = False
+                        closest_t = 10e8
+                        hit_point = ti.Vector([0.0, 0.0, 0.0])
+                        hit_point_normal = ti.Vector([0.0, 0.0, 0.0])
+                        front_face = False
+                        material = 1
+                        if overflow:
+                            # too much in view for the lists, trace the ray on its own
+                            is_hit, hit_point, hit_point_normal, front_face, material = self.scene.hit(ray)
+                        else:
+                            for c in range(num_spheres):
+                                is_hit_tmp, root_tmp, hit_point_tmp, hit_point_normal_tmp, front_face_tmp, material_tmp = self.scene.spheres[self.packet_candidates[tile, SPHERE, c]].hit(ray, 0.001, closest_t)
+                                if is_hit_tmp:
+                                    is_hit, closest_t, hit_point, hit_point_normal, front_face, material = is_hit_tmp, root_tmp, hit_point_tmp, hit_point_normal_tmp, front_face_tmp, material_tmp
+                            for c in range(num_planes):
+                                is_hit_tmp, root_tmp, hit_point_tmp, hit_point_normal_tmp, front_face_tmp, material_tmp = self.scene.planes[self.packet_candidates[tile, PLANE, c]].hit(ray, 0.001, closest_t)
+                                if is_hit_tmp:
+                                    is_hit, closest_t, hit_point, hit_point_normal, front_face, material = is_hit_tmp, root_tmp, hit_point_tmp, hit_point_normal_tmp, front_face_tmp, material_tmp
+                            for c in range(num_cubes):
+                                is_hit_tmp, root_tmp, hit_point_tmp, hit_point_normal_tmp, front_face_tmp, material_tmp = self.scene.cubes[self.packet_candidates[tile, CUBE, c]].hit(ray, 0.001, closest_t)
+                                if is_hit_tmp:
+                                    is_hit, closest_t, hit_point, hit_point_normal, front_face, material = is_hit_tmp, root_tmp, hit_point_tmp, hit_point_normal_tmp, front_face_tmp, material_tmp
+                            for c in range(num_instances):
+                                is_hit_tmp, root_tmp, hit_point_tmp, hit_point_normal_tmp, front_face_tmp, material_tmp = self.scene.hit_instance(self.packet_candidates[tile, INSTANCE, c], ray, 0.001, closest_t)
+                                if is_hit_tmp:
+                                    is_hit, closest_t, hit_point, hit_point_normal, front_face, material = is_hit_tmp, root_tmp, hit_point_tmp, hit_point_normal_tmp, front_face_tmp, material_tmp
+                        if is_hit:
+                            self.hit_point[k] = hit_point
+                            self.hit_normal[k] = hit_point_normal
+                            self.hit_front_face[k] = front_face
+                            self.hit_material[k] = material
+                            key = self.scene.materials[material].type
+                        else:
+                            self.add_environment_light(k)
+                    self.hit_bin[k] = key
+                    ti.atomic_add(self.bin_count[key], 1)
+
+    @ti.func
+    def add_environment_light(self, k):
+        pixel = self.path_pixel[k]
+        self.canvas[pixel[0], pixel[1]] += self.path_throughput[k] * self.environment_light(self.path_direction[k], self.path_bsdf_pdf[k])
+
+    @ti.func
+    def add_packet_candidate(self, tile, kind, count, index):
+        if count < MAX_PACKET_CANDIDATES:
+            self.packet_candidates[tile, kind, count] = index
+        return count + 1
+
+    @ti.kernel
+    def sort_by_material(self):
+        # exclusive prefix sum over the handful of bins, then every slot takes the next place of its bin
+        for _ in range(1):
+            total = 0
+            for b in range(NUM_BINS):
+                self.bin_offset[b] = total
+                total += self.bin_count[b]
+        for s in range(self.num_active[None]):
+            self.order[ti.atomic_add(self.bin_offset[self.hit_bin[s]], 1)] = s
+
+    @ti.kernel
+    def identity_order(self):
+        for s in range(self.num_active[None]):
+            self.order[s] = s
+
+    @ti.kernel
+    def shade_paths(self):
+        self.num_next[None] = 0
+        for n in range(self.num_active[None]):
+            s = self.order[n]
+            if self.hit_bin[s] != TERMINATED:
+                k = self.active[s]
+                mtl = self.scene.materials[self.hit_material[s]]
+                pixel = self.path_pixel[k]
+                if mtl.type == LIGHT:
+                    self.canvas[pixel[0], pixel[1]] += self.path_throughput[k] * self.emitted(
+                        mtl, self.path_bsdf_pdf[k], self.path_origin[k], self.path_normal[k], self.hit_point[s], self.hit_normal[s],
+                        self.path_diffuse[k])
+                else:
+                    if mtl.type == DIFFUSE:
+                        self.canvas[pixel[0], pixel[1]] += self.path_throughput[k] * (
+                            self.sample_lights(mtl, self.hit_point[s], self.hit_normal[s])
+                            + self.caustic(mtl, self.hit_point[s], self.hit_normal[s], self.path_direction[k]))
+                        self.path_diffuse[k] = 1
+                    is_scattered, scattered_origin, scattered_direction, attenuation = self.scatter(
+                        mtl, self.path_direction[k], self.hit_point[s], self.hit_normal[s], self.hit_front_face[s])
+                    if is_scattered:
+                        self.path_origin[k] = scattered_origin
+                        self.path_direction[k] = scattered_direction
+                        self.path_bsdf_pdf[k] = self.bsdf_pdf(mtl, self.hit_normal[s], scattered_direction)
+                        self.path_normal[k] = self.hit_normal[s]
+                        self.path_throughput[k] *= attenuation / self.rr
+                        self.next_active[ti.atomic_add(self.num_next[None], 1)] = k
+
+    @ti.kernel
+    def swap_queues(self):
+        for n in range(self.num_next[None]):
+            self.active[n] = self.next_active[n]
+        self.num_active[None] = self.num_next[None]
+
+    def render_wavefront(self, width, height, samples_per_pixel, max_depth, sort_by_material=True, packets=False):
+        if not hasattr(self, 'active'):
+            self.allocate_paths()
+        for _ in range(samples_per_pixel):
+            self.generate_paths(width, height)
+            for depth in range(max_depth):
+                if packets and depth == 0:
+                    self.trace_primary_packets(width, height)
+                else:
+                    self.trace_paths()
+                if sort_by_material:
+                    self.sort_by_material()
+                else:
+                    self.identity_order()
+                self.shade_paths()
+                self.swap_queues()
+                if self.num_active[None] == 0:
+                    break
+
+    # Caustic photons: from lights picked by power, through metal / glass, stored on the first diffuse hit
+    @ti.kernel
+    def trace_photons(self, num_photons: ti.i32):
+        for _ in range(num_photons):
+            if self.scene.lights.num_lights[None] > 0:
+                light, prob = self.scene.lights.select_by_power()
+                origin, direction, flux = self.scene.lights.emit(light)
+                power = flux / (prob * num_photons)
+                specular = False
+                for depth in range(PHOTON_DEPTH):
+                    is_hit, hit_point, hit_point_normal, front_face, material = self.scene.hit(Ray(origin, direction))
+                    if not is_hit:
                         break
-                    else:
-                        brightness *= color
-                # Dielectric
-                elif material == 3:
-                    refraction_ratio = 1.5
-                    if front_face:
-                        refraction_ratio = 1 / refraction_ratio
-                    cos_theta = min(-scattered_direction.normalized().dot(hit_point_normal), 1.0)
-                    sin_theta = ti.sqrt(1 - cos_theta * cos_theta)
-                    # total internal reflection
-                    if refraction_ratio * sin_theta > 1.0 or reflectance(cos_theta, refraction_ratio) > ti.random():
-                        scattered_direction = reflect(scattered_direction.normalized(), hit_point_normal)
-                    else:
-                        scattered_direction = refract(scattered_direction.normalized(), hit_point_normal, refraction_ratio)
-                    scattered_origin = hit_point
-                    brightness *= color
-                brightness /= p_RR
-    return color_buffer
+                    mtl = self.scene.materials[material]
+                    if mtl.type == LIGHT:
+                        break
+                    if mtl.type == DIFFUSE:
+                        if specular:
+                            self.photons.store(hit_point, direction.normalized(), hit_point_normal, power)
+                        break
+                    is_scattered, origin, direction, attenuation = self.scatter(mtl, direction, hit_point, hit_point_normal, front_face)
+                    if not is_scattered:
+                        break
+                    power *= attenuation
+                    specular = True
+
+    def photon_pass(self, num_photons):
+        self.photons.clear()
+        self.trace_photons(num_photons)
+        self.photons.build_grid()
+
+    def image(self, width, height):
+        count = np.maximum(self.sample_count.to_numpy()[:width, :height], 1)
+        return np.sqrt(self.canvas.to_numpy()[:width, :height] / count[:, :, None])  # correction
+
+    def encoded_image(self, width, height, encoding='rgb9e5'):
+        # the averaged (linear) radiance, one u32 per pixel in a shared exponent format of compact.py
+        encoded = np.zeros((width, height), dtype=np.uint32)
+        self.encode_canvas(encoded, width, height, encoding == 'rgbe')
+        return encoded
+
+    @ti.kernel
+    def encode_canvas(self, encoded: ti.types.ndarray(), width: ti.i32, height: ti.i32, rgbe: ti.template()):
+        for i, j in ti.ndrange(width, height):
+            radiance = self.canvas[i, j] / ti.max(self.sample_count[i, j], 1)
+            if ti.static(rgbe):
+                encoded[i, j] = encode_rgbe(radiance)
+            else:
+                encoded[i, j] = encode_rgb9e5(radiance)
+
+    def state(self, width, height):
+        return self.canvas.to_numpy()[:width, :height], self.sample_count.to_numpy()[:width, :height]
+
+    def restore(self, canvas, sample_count):
+        full_canvas = np.zeros(self.canvas.shape + (3,), dtype=np.float32)
+        full_count = np.zeros(self.sample_count.shape, dtype=np.int32)
+        full_canvas[:canvas.shape[0], :canvas.shape[1]] = canvas
+        full_count[:canvas.shape[0], :canvas.shape[1]] = sample_count
+        self.canvas.from_numpy(full_canvas)
+        self.sample_count.from_numpy(full_count)
 
 
 if __name__ == "__main__":
@@ -106,87 +733,318 @@ if __name__ == "__main__":
         '--samples_per_pixel', type=int, default=4, help='samples_per_pixel  (default: 4)')
     parser.add_argument(
         '--samples_in_unit_sphere', action='store_true', help='whether sample in a unit sphere')
+    parser.add_argument(
+        '--scene', type=str, default=os.path.join(SCENE_DIR, 'cornell_box.json'), help='scene file, .json or .toml (default: scenes/cornell_box.json)')
+    parser.add_argument(
+        '--no_watch', action='store_true', help='do not hot reload the scene file when it changes')
+    parser.add_argument(
+        '--checkpoint', type=str, default=None, help='write the progressive render to this file periodically and on exit')
+    parser.add_argument(
+        '--checkpoint_interval', type=float, default=60.0, help='seconds between two checkpoints (default: 60)')
+    parser.add_argument(
+        '--resume', action='store_true', help='continue the render stored in --checkpoint')
+    parser.add_argument(
+        '--sort_by_material', action='store_true', help='wavefront rendering, hits are shaded grouped by material')
+    parser.add_argument(
+        '--packets', action='store_true', help='wavefront rendering, camera rays are traced in 8x8 frustum culled packets (CPU backend, pays off in scenes with many objects)')
+    parser.add_argument(
+        '--lbvh', action='store_true', help='build a BVH over the world objects on the device (many objects)')
+    parser.add_argument(
+        '--light_sampling', type=str, default='tree', choices=['uniform', 'power', 'tree'],
+        help='how next event estimation picks one of the lights (default: tree, a light BVH)')
+    parser.add_argument(
+        '--caustics', action='store_true', help='add a progressive caustic photon map (glass and metal in front of the lights)')
+    parser.add_argument(
+        '--photons', type=int, default=200000, help='caustic photons traced per frame (default: 200000)')
+    parser.add_argument(
+        '--photon_radius', type=float, default=0.05, help='initial gather radius of the caustic photons (default: 0.05)')
+    parser.add_argument(
+        '--guiding', action='store_true', help='learn where the light comes from and guide the diffuse bounces (not with the wavefront options)')
+    parser.add_argument(
+        '--integrator', type=str, default='path', choices=['path', 'bdpt'],
+        help='path tracing or bidirectional path tracing (small / hidden lights; not with the other rendering options)')
+    parser.add_argument(
+        '--gbuffer', action='store_true', help='cache the first hits of a few fixed subpixel offsets while the camera is still (default renderer)')
+    parser.add_argument(
+        '--jitters', type=int, default=NUM_JITTERS, help=f'subpixel offsets of --gbuffer (default: {NUM_JITTERS})')
+    parser.add_argument(
+        '--compact_gbuffer', action='store_true', help='with --gbuffer, store hit distances and octahedral normals (see gbuffer.py)')
+    parser.add_argument(
+        '--aovs', type=str, default=None, help='with --gbuffer, write the position (or depth) / normal / material / primitive AOVs to this .npz on exit')
+    parser.add_argument(
+        '--compact_aovs', type=str, default=None, choices=['rgb9e5', 'rgbe'],
+        help='with --aovs, store the float AOVs in f16 and add the averaged radiance in this shared exponent format (see compact.py)')
+    parser.add_argument(
+        '--film_layout', type=str, default='dense', choices=LAYOUTS, help='memory layout of the canvas (default: dense, see film.py)')
+    parser.add_argument(
+        '--film_storage', type=str, default='aos', choices=CHANNELS, help='canvas channels side by side or one array each (default: aos)')
+    parser.add_argument(
+        '--views', type=int, default=0, help='render a turntable of this many views around the scene camera in one launch, write them as PNGs and exit')
+    parser.add_argument(
+        '--view_resolution', type=int, default=200, help='width and height of each --views image (default: 200)')
+    parser.add_argument(
+        '--frames', type=int, default=64, help='frames accumulated by --views (default: 64)')
+    parser.add_argument(
+        '--out', type=str, default='.', help='directory of the --views images (default: .)')
+    parser.add_argument(
+        '--rr', type=float, default=p_RR, help=f'russian roulette survival probability per bounce, 1 turns it off (default: {p_RR})')
+    parser.add_argument(
+        '--adaptive', type=float, default=0.0,
+        help='adaptive sampling: a pixel stops once the relative standard error of its luminance is below this (default: 0, off)')
+    parser.add_argument(
+        '--frame_budget', type=float, default=0.0,
+        help='target frame time in ms: adapt the samples per frame and preview at a reduced resolution while the camera moves (default: 0, off)')
+    parser.add_argument(
+        '--max_spp', type=int, default=64, help='with --frame_budget, the most samples per pixel of one frame (default: 64)')
+    parser.add_argument(
+        '--profile', type=str, default=None, help='time every stage of every frame, write a Chrome trace JSON here and print a summary on exit')
+    parser.add_argument(
+        '--profile_frames', type=int, default=0, help='with --profile, stop after this many frames (default: 0, run until closed)')
+    parser.add_argument(
+        '--seed', type=int, default=0, help='random seed (default: 0)')
     args = parser.parse_args()
+    if args.resume and args.checkpoint is None:
+        parser.error('--resume needs --checkpoint')
+    if args.guiding and (args.sort_by_material or args.packets):
+        parser.error('--guiding only works with the default (megakernel) renderer')
+    if args.gbuffer and (args.sort_by_material or args.packets or args.integrator == 'bdpt'):
+        parser.error('--gbuffer only works with the default (megakernel) renderer')
+    if (args.aovs is not None or args.compact_gbuffer) and not args.gbuffer:
+        parser.error('--aovs and --compact_gbuffer need --gbuffer')
+    if args.compact_aovs is not None and args.aovs is None:
+        parser.error('--compact_aovs needs --aovs')
+    if args.views > 0 and (args.sort_by_material or args.packets or args.gbuffer or args.integrator == 'bdpt' or args.checkpoint):
+        parser.error('--views only works with the default (megakernel) renderer and without checkpoints')
+    if args.adaptive > 0 and (args.sort_by_material or args.packets or args.views > 0 or args.integrator == 'bdpt' or args.resume):
+        parser.error('--adaptive only works with the default (megakernel) renderer and not with --resume')
+    if args.adaptive > 0 and args.gbuffer:
+        parser.error('--adaptive does not combine with --gbuffer (the pixels it skips would never fill the cache)')
+    if args.frame_budget > 0 and args.gbuffer:
+        parser.error('--frame_budget does not combine with --gbuffer (the cache holds one resolution)')
+    if args.integrator == 'bdpt' and (args.sort_by_material or args.packets or args.caustics or args.guiding):
+        parser.error('--integrator bdpt does not combine with the wavefront, caustics and guiding options')
 
     max_depth = args.max_depth
     samples_per_pixel = args.samples_per_pixel
     sample_on_unit_sphere_surface = not args.samples_in_unit_sphere
-    scene = Hittable_list()
-
-    """
-        Build the World
-    """
-    # Light source
-    scene.add(Sphere(center=ti.Vector([0, 5.4, -0.2]), radius=3.0, material=0, color=ti.Vector([10.0, 10.0, 10.0])))
-    # scene.add(Plane(center=ti.Vector([0, 2.5, -1]), normal=ti.Vector([0.0, 1.0, 0.0]), color=ti.Vector([50.0, 50.0, 50.0]), material=0, width=0.8))
-
-    # Ground
-    # scene.add(Sphere(center=ti.Vector([0, -100.5, -1]), radius=100.0, material=1, color=ti.Vector([0.8, 0.8, 0.8])))
-    scene.add(Plane(center=ti.Vector([0, -0.5, -1]), normal=ti.Vector([0.0, 1.0, 0.0]), color=ti.Vector([0.8, 0.8, 0.8]), material=2))
-
-    # ceiling
-    # scene.add(Sphere(center=ti.Vector([0, 102.5, -1]), radius=100.0, material=1, color=ti.Vector([0.8, 0.8, 0.8])))
-    scene.add(Plane(center=ti.Vector([0, 2.5, -1]), normal=ti.Vector([0.0, -1.0, 0.0]), color=ti.Vector([0.8, 0.8, 0.8])))
-
-    # back wall
-    # scene.add(Sphere(center=ti.Vector([0, 1, 101]), radius=100.0, material=1, color=ti.Vector([0.8, 0.8, 0.8])))
-    scene.add(Plane(center=ti.Vector([0, 1, 1]), normal=ti.Vector([0.0, 0.0, -1.0]), color=ti.Vector([0.8, 0.8, 0.8])))
-
-    # right wall
-    # scene.add(Sphere(center=ti.Vector([-101.5, 0, -1]), radius=100.0, material=1, color=ti.Vector([0.6, 0.0, 0.0])))
-    scene.add(Plane(center=ti.Vector([-1.5, 0, -1]), normal=ti.Vector([1.0, 0.0, 0.0]), color=ti.Vector([0.6, 0.0, 0.0])))
-
-    # left wall
-    # scene.add(Sphere(center=ti.Vector([101.5, 0, -1]), radius=100.0, material=1, color=ti.Vector([0.0, 0.6, 0.0])))
-    scene.add(Plane(center=ti.Vector([1.5, 0, -1]), normal=ti.Vector([-1.0, 0.0, 0.0]), color=ti.Vector([0.0, 0.6, 0.0])))
-
-    # Diffuse ball
-    scene.add(Sphere(center=ti.Vector([0, -0.2, -1.5]), radius=0.3, material=1, color=ti.Vector([0.8, 0.3, 0.3])))
-    # Metal ball
-    scene.add(Sphere(center=ti.Vector([-0.8, 0.2, -1]), radius=0.7, material=2, color=ti.Vector([0.6, 0.8, 0.8])))
-    # Glass ball
-    # scene.add(Sphere(center=ti.Vector([0.7, 0.0, -0.5]), radius=0.5, material=3, color=ti.Vector([1.0, 1.0, 1.0])))
-    scene.add(Cube(center=ti.Vector([0.7, 0.0, -0.5]), material=1, color=ti.Vector([1.0, 1.0, 1.0]), width=1))
-    # Metal ball-2
-    scene.add(Sphere(center=ti.Vector([0.6, -0.3, -2.0]), radius=0.2, material=4, color=ti.Vector([0.8, 0.6, 0.2])))
-
-    camera = Camera()  # look at [0.0, 1.0, -1.0]  look from [0.0, 1.0, -4.0]
+
+    ckpt = load_checkpoint(args.checkpoint) if args.resume else None
+    seed = args.seed if ckpt is None else ckpt.seed
+    # the kernel profiler only exists on the CPU and CUDA backends
+    kernel_profiler = args.profile is not None
+    ti.init(arch=ti.cuda, random_seed=seed_for(seed, 0 if ckpt is None else ckpt.frame), kernel_profiler=kernel_profiler)
+    profiler = FrameProfiler(enabled=args.profile is not None, kernel_profiler=kernel_profiler)
+    scene_data = load_scene(args.scene)
+    # the wavefront queues and bdpt do not carry the primitive id and ray cone Scene.albedo needs
+    untextured = args.sort_by_material or args.packets or args.integrator == 'bdpt'
+    if untextured and scene_data.textures is not None:
+        parser.error('scenes with textures only render with the default (megakernel) renderer')
+    scene = Scene(lbvh=args.lbvh)
+    scene.load(scene_data)
+    scene.lights.set_strategy(args.light_sampling)
+    camera = Camera(num_views=max(args.views, 1))
+    photons = PhotonMap(args.photon_radius) if args.caustics else None
+    guide = PathGuide() if args.guiding else None
+    if guide is not None:
+        guide.reset(*scene_data.bounds())
+    gbuffer = GBuffer(image_width, image_height, args.jitters, args.compact_gbuffer) if args.gbuffer else None
+    if args.integrator == 'bdpt':
+        from bdpt import BidirectionalPathTracer
+        path_tracer = BidirectionalPathTracer(scene, camera, sample_on_unit_sphere_surface=sample_on_unit_sphere_surface,
+                                              film_layout=args.film_layout, film_storage=args.film_storage)
+    elif args.views > 0:
+        # the films only have to hold the small views
+        path_tracer = PathTracer(scene, camera, args.view_resolution, args.view_resolution,
+                                 sample_on_unit_sphere_surface=sample_on_unit_sphere_surface, photons=photons, guide=guide,
+                                 film_layout=args.film_layout, film_storage=args.film_storage, rr=args.rr)
+    else:
+        path_tracer = PathTracer(scene, camera, sample_on_unit_sphere_surface=sample_on_unit_sphere_surface, photons=photons,
+                                 guide=guide, gbuffer=gbuffer, film_layout=args.film_layout, film_storage=args.film_storage,
+                                 rr=args.rr, adaptive=args.adaptive)
+
+    if args.views > 0:
+        camera.turntable(scene_data.camera["lookfrom"], scene_data.camera["lookat"], scene_data.camera["fov"])
+        path_tracer.clear_views()
+        if photons is not None:
+            photons.reset()
+        start = time.time()
+        for _ in range(args.frames):
+            if photons is not None:
+                path_tracer.photon_pass(args.photons)
+            path_tracer.render_views(args.view_resolution, args.view_resolution, samples_per_pixel, max_depth)
+            if photons is not None:
+                photons.advance()
+            if guide is not None:
+                guide.advance()
+        ti.sync()
+        print(f"{args.views} views x {args.frames} frames in {time.time() - start:.2f} s")
+        os.makedirs(args.out, exist_ok=True)
+        for k, img in enumerate(path_tracer.view_images(args.view_resolution, args.view_resolution)):
+            ti.tools.imwrite(np.clip(img, 0.0, 1.0), os.path.join(args.out, f'view_{k:03d}.png'))
+        raise SystemExit
+
+    profiler.track(path_tracer, scene, camera, gbuffer, photons, guide)
     gui = ti.GUI("Ray Tracing", res=(image_width, image_height))
-    canvas.fill(0)
+    path_tracer.canvas.fill(0)
     cnt = 0
+    budget = None
+    if args.frame_budget > 0:
+        budget = FrameBudget(image_width, image_height, args.frame_budget, args.max_spp)
     # look from
-    lf_x = 0.0
-    lf_y = 1.0
-    lf_z = -5.0
-
-    while gui.running:
-        for e in gui.get_events(gui.PRESS):
-            if e.key == gui.ESCAPE:
-                gui.running = False
-                exit()
-            elif e.key == 'w':
-                clear()
-                cnt = 0
-                lf_z += 0.5
-                # print("w, lf_z is ", lf_z)
-            elif e.key == 's':
-                clear()
-                cnt = 0
-                lf_z -= 0.5
-                # print("s, lf_z is ", lf_z)
-            elif e.key == 'a':
-                clear()
-                cnt = 0
-                lf_x += 0.5
-                # print("a, lf_x is ", lf_x)
-            elif e.key == 'd':
-                clear()
-                cnt = 0
-                lf_x -= 0.5
-                # print("d, lf_x is ", lf_x)         
-        # camera motion                                  
-        camera.reset(ti.math.vec3(lf_x, lf_y, lf_z))
-        render()
-        cnt += 1
-        gui.set_image(np.sqrt(canvas.to_numpy() / cnt))  # correction
-        gui.show()
+    lf_x, lf_y, lf_z = scene_data.camera["lookfrom"]
+
+    if ckpt is not None:
+        if (ckpt.width, ckpt.height) != (image_width, image_height):
+            raise SystemExit(f"checkpoint is {ckpt.width}x{ckpt.height}, the canvas is {image_width}x{image_height}")
+        if ckpt.scene_key != scene_data.geometry_key():
+            print(f"warning: {args.scene} changed since the checkpoint was written")
+        path_tracer.restore(ckpt.canvas, ckpt.sample_count)
+        cnt = ckpt.frame
+        lf_x, lf_y, lf_z = ckpt.lookfrom
+        if photons is not None:
+            for _ in range(cnt):
+                photons.advance()
+        if budget is not None:
+            budget.settle()
+        print(f"resumed from {args.checkpoint} at frame {cnt}")
+
+    writer = None
+    if args.checkpoint is not None:
+        writer = CheckpointWriter(args.checkpoint)
+        writer.start()
+    last_checkpoint = time.time()
+
+    def snapshot():
+        canvas, sample_count = path_tracer.state(image_width, image_height)
+        return Checkpoint(canvas, sample_count, cnt, seed, (lf_x, lf_y, lf_z), scene_data.geometry_key())
+
+    watcher = None
+    if not args.no_watch:
+        watcher = SceneWatcher(args.scene)
+        watcher.start()
+
+    def restart(moved=True):
+        with profiler.stage('clear'):
+            path_tracer.clear()
+        if moved and budget is not None:
+            budget.moved()
+
+    try:
+        while gui.running:
+            profiler.begin_frame()
+            frame_start = time.perf_counter()
+            with profiler.stage('input'):
+                # hot reload: only the field contents change, the kernels stay compiled
+                if watcher is not None and watcher.poll():
+                    # a file that does not parse or does not fit the fields (Scene.load checks before it writes)
+                    # keeps the scene that is on screen
+                    try:
+                        new_data = load_scene(args.scene)
+                        if untextured and new_data.textures is not None:
+                            raise ValueError("scenes with textures only render with the default (megakernel) renderer")
+                        reloaded = new_data.geometry_key() != scene_data.geometry_key()
+                        if reloaded:
+                            scene.load(new_data)
+                    except (ValueError, KeyError, TypeError, IndexError, OSError) as e:
+                        print(f"failed to reload {args.scene}: {e}")
+                        new_data = scene_data
+                        reloaded = False
+                    if reloaded:
+                        restart()
+                        cnt = 0
+                        if guide is not None:
+                            guide.reset(*new_data.bounds())
+                    if new_data.camera != scene_data.camera:
+                        # the file moved the camera, otherwise keep the one the user is flying around
+                        lf_x, lf_y, lf_z = new_data.camera["lookfrom"]
+                        restart()
+                        cnt = 0
+                    scene_data = new_data
+                for e in gui.get_events(gui.PRESS):
+                    if e.key == gui.ESCAPE:
+                        gui.running = False
+                        exit()
+                    elif e.key == 'w':
+                        restart()
+                        cnt = 0
+                        lf_z += 0.5
+                        # print("w, lf_z is ", lf_z)
+                    elif e.key == 's':
+                        restart()
+                        cnt = 0
+                        lf_z -= 0.5
+                        # print("s, lf_z is ", lf_z)
+                    elif e.key == 'a':
+                        restart()
+                        cnt = 0
+                        lf_x += 0.5
+                        # print("a, lf_x is ", lf_x)
+                    elif e.key == 'd':
+                        restart()
+                        cnt = 0
+                        lf_x -= 0.5
+                        # print("d, lf_x is ", lf_x)
+            if budget is not None:
+                width, height, spp = budget.plan()
+                if budget.changed_scale():
+                    restart(moved=False)
+                    cnt = 0
+            else:
+                width, height, spp = image_width, image_height, samples_per_pixel
+            # camera motion
+            with profiler.stage('camera'):
+                camera.look_at(ti.math.vec3(lf_x, lf_y, lf_z), ti.math.vec3(scene_data.camera["lookat"]), scene_data.camera["fov"])
+            if photons is not None:
+                with profiler.stage('photons'):
+                    # the radius schedule restarts with the accumulation
+                    if cnt == 0:
+                        photons.reset()
+                    path_tracer.photon_pass(args.photons)
+            with profiler.stage('render'):
+                if args.sort_by_material or args.packets:
+                    path_tracer.render_wavefront(width, height, spp, max_depth,
+                                                 sort_by_material=args.sort_by_material, packets=args.packets)
+                else:
+                    path_tracer.render(width, height, spp, max_depth)
+            if photons is not None:
+                photons.advance()
+            if guide is not None:
+                with profiler.stage('guide'):
+                    guide.advance()
+            cnt += 1
+            with profiler.stage('image'):
+                # to_numpy + sqrt on the host
+                img = path_tracer.image(width, height)
+                if budget is not None:
+                    img = budget.upscale(img)
+            with profiler.stage('present'):
+                gui.set_image(img)
+                gui.show()
+            if budget is not None:
+                budget.update((time.perf_counter() - frame_start) * 1000)
+            # only the device -> host copy happens here, the file is written on the writer thread
+            # (a preview at a reduced resolution is not worth keeping)
+            full_resolution = budget is None or budget.scale == 1
+            if writer is not None and full_resolution and time.time() - last_checkpoint > args.checkpoint_interval:
+                with profiler.stage('checkpoint'):
+                    writer.submit(snapshot())
+                last_checkpoint = time.time()
+            profiler.end_frame()
+            if args.profile_frames > 0 and profiler.frame >= args.profile_frames:
+                break
+    finally:
+        # Esc, closing the window or Ctrl-C: keep what has been rendered so far
+        if writer is not None and cnt > 0 and (budget is None or budget.scale == 1):
+            writer.submit(snapshot())
+        if writer is not None:
+            writer.flush()
+        if args.aovs is not None and cnt > 0:
+            aovs = gbuffer.aovs(image_width, image_height, half=args.compact_aovs is not None)
+            if args.compact_aovs is not None:
+                aovs[f"radiance_{args.compact_aovs}"] = path_tracer.encoded_image(image_width, image_height, args.compact_aovs)
+            np.savez(args.aovs, **aovs)
+        if args.profile is not None:
+            profiler.export(args.profile)
+            print(profiler.summary())
+            if kernel_profiler:
+                ti.profiler.print_kernel_profiler_info()
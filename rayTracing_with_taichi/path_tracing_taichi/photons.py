@@ -0,0 +1,107 @@
+import taichi as ti
+import taichi.math as tm
+from ray_tracing_tools import PI
+
+'''
+    Caustic photon map: photons leave the lights, bounce off metal / glass and are stored where they land on
+    a diffuse surface (paths light -> specular+ -> diffuse), see PathTracer.trace_photons. They go into a
+    hashed grid: cells of 2 * radius, a cell is hashed into hash_size buckets and the photons are sorted by
+    bucket (count, prefix sum, scatter), so a lookup visits at most 2 x 2 x 2 cells.
+
+    Progressive photon mapping: every frame traces a new photon map and the radius shrinks as
+        r(i + 1)^2 = r(i)^2 * (i + ALPHA) / (i + 1)
+    so the average of the frames converges to the caustic (Knaus & Zwicker, the SPPM radius schedule with a
+    global radius).
+'''
+
+MAX_PHOTONS = 1 << 20
+HASH_SIZE = 1 << 18
+ALPHA = 2 / 3
+
+
+@ti.dataclass
+class Photon:
+    position: tm.vec3
+    direction: tm.vec3  # incoming
+    normal: tm.vec3     # of the surface, as returned by Scene.hit
+    power: tm.vec3
+
+
+@ti.data_oriented
+class PhotonMap:
+    def __init__(self, radius=0.05, max_photons=MAX_PHOTONS, hash_size=HASH_SIZE):
+        self.photons = Photon.field(shape=max_photons)
+        self.num_photons = ti.field(dtype=ti.i32, shape=())
+        self.hash_size = hash_size  # a power of 2
+        self.photon_bucket = ti.field(dtype=ti.i32, shape=max_photons)
+        self.sorted = ti.field(dtype=ti.i32, shape=max_photons)
+        self.bucket_count = ti.field(dtype=ti.i32, shape=hash_size)
+        self.bucket_start = ti.field(dtype=ti.i32, shape=hash_size)
+        self.bucket_fill = ti.field(dtype=ti.i32, shape=hash_size)
+        self.radius = ti.field(dtype=ti.f32, shape=())
+        self.initial_radius = radius
+        self.reset()
+
+    def reset(self):
+        self.iteration = 1
+        self.radius[None] = self.initial_radius
+
+    def advance(self):
+        self.radius[None] *= ((self.iteration + ALPHA) / (self.iteration + 1)) ** 0.5
+        self.iteration += 1
+
+    @ti.kernel
+    def clear(self):
+        self.num_photons[None] = 0
+
+    @ti.func
+    def store(self, position, direction, normal, power):
+        i = ti.atomic_add(self.num_photons[None], 1)
+        if i < self.photons.shape[0]:
+            self.photons[i] = Photon(position, direction, normal, power)
+
+    @ti.func
+    def cell(self, p):
+        return ti.floor(p / (2 * self.radius[None]), ti.i32)
+
+    @ti.func
+    def bucket(self, cell):
+        return (cell.x * 73856093 ^ cell.y * 19349663 ^ cell.z * 83492791) & (self.hash_size - 1)
+
+    @ti.kernel
+    def build_grid(self):
+        for h in range(self.hash_size):
+            self.bucket_count[h] = 0
+        num_photons = ti.min(self.num_photons[None], self.photons.shape[0])
+        for i in range(num_photons):
+            h = self.bucket(self.cell(self.photons[i].position))
+            self.photon_bucket[i] = h
+            ti.atomic_add(self.bucket_count[h], 1)
+        for _ in range(1):
+            total = 0
+            for h in range(self.hash_size):
+                self.bucket_start[h] = total
+                self.bucket_fill[h] = total
+                total += self.bucket_count[h]
+        for i in range(num_photons):
+            self.sorted[ti.atomic_add(self.bucket_fill[self.photon_bucket[i]], 1)] = i
+
+    # power of the photons within the radius that arrived on the same side of the surface as direction,
+    # divided by the area of the disc
+    @ti.func
+    def gather(self, p, normal, direction):
+        r = self.radius[None]
+        side = normal.dot(direction)
+        power = ti.Vector([0.0, 0.0, 0.0])
+        low = self.cell(p - r)
+        high = self.cell(p + r)
+        for x, y, z in ti.ndrange((low.x, high.x + 1), (low.y, high.y + 1), (low.z, high.z + 1)):
+            cell = ti.Vector([x, y, z])
+            h = self.bucket(cell)
+            for k in range(self.bucket_start[h], self.bucket_start[h] + self.bucket_count[h]):
+                photon = self.photons[self.sorted[k]]
+                # several cells can share a bucket, each photon is only counted with its own cell
+                if (self.cell(photon.position) == cell).all() and (photon.position - p).norm_sqr() < r * r:
+                    if photon.normal.dot(normal) > 0.9 and photon.direction.dot(photon.normal) * side > 0:
+                        power += photon.power
+        return power / (PI * r * r)
@@ -0,0 +1,132 @@
+import json
+import time
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+import taichi as ti
+
+'''
+    Frame profiler of the interactive loop: every stage (a kernel launch or a host step) runs inside
+        with profiler.stage('render'):
+            ...
+    and is timed with ti.sync() before and after it, so the asynchronous kernels are charged to their own stage
+    (the sync costs a little, which is why profiling is opt-in). Stages nest, every frame is a stage as well.
+
+    export() writes the timeline as Chrome trace JSON (chrome://tracing or https://ui.perfetto.dev), with the
+    field memory footprints as counters; summary() is the same as a table. With ti.init(kernel_profiler=True)
+    (CPU and CUDA backends) the summary also has the device time of each kernel.
+'''
+
+DTYPE_BYTES = {ti.f16: 2, ti.f32: 4, ti.f64: 8, ti.i8: 1, ti.i16: 2, ti.i32: 4, ti.i64: 8,
+               ti.u8: 1, ti.u16: 2, ti.u32: 4, ti.u64: 8}
+
+
+def field_bytes(field):
+    # the dense footprint of a scalar, vector / matrix or struct field
+    members = getattr(field, 'field_dict', None)
+    if members is not None:
+        return sum(field_bytes(member) for member in members.values())
+    count = int(np.prod(field.shape)) if field.shape else 1
+    n = getattr(field, 'n', 1) * getattr(field, 'm', 1)
+    return count * n * DTYPE_BYTES.get(field.dtype, 4)
+
+
+def is_field(value):
+    return hasattr(value, 'snode') and hasattr(value, 'shape')
+
+
+class FrameProfiler:
+    def __init__(self, enabled=True, kernel_profiler=False):
+        self.enabled = enabled
+        self.kernel_profiler = kernel_profiler
+        self.events = []     # (name, frame, depth, start, duration) in seconds since the profiler was created
+        self.memory = {}     # 'Owner.attribute' -> bytes
+        self.frame = 0
+        self.depth = 0
+        self.origin = time.perf_counter()
+        self.frame_start = None
+
+    @contextmanager
+    def _stage(self, name):
+        ti.sync()
+        start = time.perf_counter()
+        self.depth += 1
+        try:
+            yield
+        finally:
+            ti.sync()
+            self.depth -= 1
+            self.events.append((name, self.frame, self.depth, start - self.origin, time.perf_counter() - start))
+
+    def stage(self, name):
+        return self._stage(name) if self.enabled else nullcontext()
+
+    def begin_frame(self):
+        if self.enabled:
+            ti.sync()
+            self.frame_start = time.perf_counter()
+
+    def end_frame(self):
+        if self.enabled and self.frame_start is not None:
+            ti.sync()
+            self.events.append(('frame', self.frame, 0, self.frame_start - self.origin, time.perf_counter() - self.frame_start))
+            self.frame += 1
+            self.frame_start = None
+
+    def track(self, *objects):
+        # the fields held by these objects and by the data oriented objects they hold, each object once
+        seen = set()
+
+        def visit(obj):
+            if obj is None or id(obj) in seen:
+                return
+            seen.add(id(obj))
+            for attr, value in vars(obj).items():
+                if is_field(value):
+                    self.memory[f'{type(obj).__name__}.{attr}'] = field_bytes(value)
+                elif getattr(type(value), '_data_oriented', False):
+                    visit(value)
+
+        for obj in objects:
+            visit(obj)
+
+    def stage_stats(self):
+        # name -> (calls, total ms, mean ms, max ms), in the order the stages first appeared
+        stats = {}
+        for name, _, _, _, duration in self.events:
+            stats.setdefault(name, []).append(duration * 1000)
+        return {name: (len(d), sum(d), sum(d) / len(d), max(d)) for name, d in stats.items()}
+
+    def summary(self):
+        lines = []
+        stats = self.stage_stats()
+        frame_total = stats.get('frame', (0, 0.0))[1]
+        lines.append(f'{self.frame} frames')
+        lines.append(f'{"stage":<16} {"calls":>6} {"total ms":>10} {"mean ms":>9} {"max ms":>9} {"% frame":>8}')
+        for name, (calls, total, mean, worst) in stats.items():
+            share = f'{100 * total / frame_total:>7.1f}%' if frame_total > 0 else ''
+            lines.append(f'{name:<16} {calls:>6} {total:>10.2f} {mean:>9.3f} {worst:>9.3f} {share:>8}')
+        if self.memory:
+            lines.append('')
+            lines.append(f'{"field":<36} {"MB":>9}')
+            for name, size in sorted(self.memory.items(), key=lambda item: -item[1]):
+                lines.append(f'{name:<36} {size / 2 ** 20:>9.2f}')
+            lines.append(f'{"total":<36} {sum(self.memory.values()) / 2 ** 20:>9.2f}')
+        if self.kernel_profiler:
+            lines.append('')
+            lines.append(f'kernel time on the device: {ti.profiler.get_kernel_profiler_total_time() * 1000:.2f} ms '
+                         '(per kernel: ti.profiler.print_kernel_profiler_info)')
+        return '\n'.join(lines)
+
+    def chrome_trace(self):
+        events = [{"name": "process_name", "ph": "M", "pid": 0, "args": {"name": "path_tracing"}}]
+        for name, frame, depth, start, duration in self.events:
+            events.append({"name": name, "cat": "frame" if name == 'frame' else "stage", "ph": "X", "pid": 0, "tid": 0,
+                           "ts": start * 1e6, "dur": duration * 1e6, "args": {"frame": frame, "depth": depth}})
+        if self.memory:
+            events.append({"name": "field memory (bytes)", "ph": "C", "pid": 0, "ts": 0, "args": dict(self.memory)})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def export(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
@@ -51,3 +51,10 @@ class Ray:
     @ti.func
     def at(self, t):
         return self.origin + t * self.direction
+
+# MIS weight of a sample drawn with pdf_a, the other strategy would have drawn it with pdf_b
+@ti.func
+def power_heuristic(pdf_a, pdf_b):
+    a = pdf_a * pdf_a
+    b = pdf_b * pdf_b
+    return a / (a + b)
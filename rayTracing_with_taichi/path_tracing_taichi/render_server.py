@@ -0,0 +1,266 @@
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import queue
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+import taichi as ti
+from Camera import Camera
+from hittable import Scene
+from path_tracing import PathTracer
+from scene import parse_scene, cornell_box
+
+'''
+    A long-lived local render service.
+    Python import, ti.init and the kernel JIT are paid once, every job afterwards only pays its render time.
+
+        POST /scenes    body: a scene file as json (see scene.py)        -> {"scene": "<sha256>"}
+        POST /render    body: {"scene": "<sha256>" or a scene (default: the cornell box),
+                               "lookfrom", "lookat", "fov" (default: the camera of the scene),
+                               "width": 400, "height": 400, "spp": 16, "max_depth": 10, "priority": 0}
+                        -> image/png, timings (seconds) in the X-Queue-Time / X-Render-Time / X-Scene-Load-Time headers
+        GET  /stats     -> queue length, cached scenes, finished jobs
+
+    Jobs with a higher priority are rendered first, equal priorities are served in FIFO order.
+
+        python render_server.py --port 8642
+        curl -d '{"spp": 64, "width": 320, "height": 320}' localhost:8642/render -o out.png
+'''
+
+
+def scene_hash(description):
+    return hashlib.sha256(json.dumps(description, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+def encode_png(img):
+    # img: (width, height, 3) in [0, 1], taichi layout (x to the right, y up)
+    rgb = (np.clip(img, 0.0, 1.0) * 255).astype(np.uint8).transpose(1, 0, 2)[::-1]
+    height, width = rgb.shape[:2]
+    raw = b''.join(b'\x00' + row.tobytes() for row in rgb)
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) + \
+        chunk(b'IDAT', zlib.compress(raw, 6)) + chunk(b'IEND', b'')
+
+
+class RenderWorker(threading.Thread):
+    # All taichi calls happen on this thread: ti.init, scene loading, kernel launches
+    def __init__(self, arch, max_width, max_height, max_cached_scenes):
+        super().__init__(daemon=True)
+        self.arch = arch
+        self.max_width = max_width
+        self.max_height = max_height
+        self.max_cached_scenes = max_cached_scenes
+        self.jobs = queue.PriorityQueue()
+        self.counter = itertools.count()
+        self.scenes = OrderedDict()   # hash -> scene.SceneData, LRU, shared with the server thread under scenes_lock
+        self.scenes_lock = threading.Lock()
+        self.loaded = None            # hash of the scene currently in the fields
+        self.finished = 0
+        self.ready = threading.Event()
+
+    def submit(self, job, priority, callback):
+        # smaller tuples are popped first, so negate the priority; the counter keeps FIFO order within a priority
+        self.jobs.put((-priority, next(self.counter), job, callback))
+
+    def add_scene(self, description):
+        # -> (hash, scene.SceneData); any thread, the parsing (and the files it reads) happens outside of the lock
+        key = scene_hash(description)
+        with self.scenes_lock:
+            data = self.scenes.get(key)
+        if data is None:
+            data = parse_scene(description)
+            # a scene that does not fit the fields is refused here (400), not when a job loads it
+            self.scene.check(data)
+        with self.scenes_lock:
+            self.scenes[key] = data
+            self.scenes.move_to_end(key)
+            if len(self.scenes) > self.max_cached_scenes:
+                self.scenes.popitem(last=False)
+        return key, data
+
+    def cached_scene(self, key):
+        # the default scene stays available whatever the LRU evicts
+        with self.scenes_lock:
+            return self.scenes.get(key, self.default_data if key == self.default_scene else None)
+
+    def run(self):
+        ti.init(arch=self.arch)
+        # every scene shares these fields, so the kernels are compiled exactly once
+        self.scene = Scene()
+        self.camera = Camera()
+        self.tracer = PathTracer(self.scene, self.camera, self.max_width, self.max_height)
+        self.default_scene, self.default_data = self.add_scene(cornell_box())
+        # warm up: compile the kernels before accepting jobs
+        self.render({"scene": self.default_scene, "width": 16, "height": 16, "spp": 1})
+        self.ready.set()
+
+        while True:
+            _, _, job, callback = self.jobs.get()
+            try:
+                callback(self.render(job), None)
+            except Exception as e:
+                callback(None, e)
+            self.finished += 1
+
+    def render(self, job):
+        width = int(job.get("width", 400))
+        height = int(job.get("height", 400))
+        spp = int(job.get("spp", 16))
+        max_depth = int(job.get("max_depth", 10))
+        if not (0 < width <= self.max_width and 0 < height <= self.max_height):
+            raise ValueError(f"resolution must be within {self.max_width}x{self.max_height}")
+        if spp <= 0:
+            raise ValueError("spp must be positive")
+
+        start = time.perf_counter()
+        key = job.get("scene", self.default_scene)
+        # the server attaches the parsed scene, so an LRU eviction while queued does not lose it
+        data = job["data"] if "data" in job else self.cached_scene(key)
+        if key != self.loaded:
+            # until the load went through, no scene is known to be in the fields
+            self.loaded = None
+            self.scene.load(data)
+            self.loaded = key
+        load_time = time.perf_counter() - start
+
+        self.camera.set_aspect_ratio(width / height)
+        self.camera.look_at(ti.Vector(job.get("lookfrom", data.camera["lookfrom"])),
+                            ti.Vector(job.get("lookat", data.camera["lookat"])),
+                            float(job.get("fov", data.camera["fov"])))
+        self.tracer.clear()
+        # one jittered sample per pass, the same way the GUI accumulates frames
+        for _ in range(spp):
+            self.tracer.render(width, height, 1, max_depth)
+        img = self.tracer.image(width, height)
+        render_time = time.perf_counter() - start
+        return {"image": img, "render_time": render_time, "load_time": load_time}
+
+
+class RenderServer:
+    def __init__(self, worker):
+        self.worker = worker
+
+    async def handle(self, reader, writer):
+        try:
+            try:
+                method, path, _ = (await reader.readline()).decode().split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, value = line.decode().split(':', 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                status, content_type, payload, extra = await self.route(method, path, body)
+            except (ValueError, KeyError, TypeError, json.JSONDecodeError) as e:
+                status, content_type, payload, extra = 400, 'application/json', json.dumps({"error": str(e)}).encode(), {}
+            except asyncio.IncompleteReadError:
+                return
+            except Exception as e:
+                # a missing file of a scene, an error of the render worker: the client still gets an answer
+                status, content_type, payload, extra = 500, 'application/json', json.dumps({"error": f"{type(e).__name__}: {e}"}).encode(), {}
+
+            reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}.get(status, 'Error')
+            head = [f'HTTP/1.1 {status} {reason}', f'Content-Type: {content_type}', f'Content-Length: {len(payload)}',
+                    'Connection: close'] + [f'{k}: {v}' for k, v in extra.items()]
+            writer.write(('\r\n'.join(head) + '\r\n\r\n').encode() + payload)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def route(self, method, path, body):
+        if method == 'POST' and path == '/scenes':
+            description = json.loads(body)
+            key, _ = await self.add_scene(description)
+            return 200, 'application/json', json.dumps({"scene": key}).encode(), {}
+        if method == 'POST' and path == '/render':
+            return await self.render(json.loads(body) if body else {})
+        if method == 'GET' and path == '/stats':
+            with self.worker.scenes_lock:
+                scenes = list(self.worker.scenes.keys())
+            stats = {"queued": self.worker.jobs.qsize(), "finished": self.worker.finished, "scenes": scenes,
+                     "loaded": self.worker.loaded}
+            return 200, 'application/json', json.dumps(stats).encode(), {}
+        return 404, 'application/json', b'{"error": "not found"}', {}
+
+    async def add_scene(self, description):
+        if not isinstance(description, (list, dict)):
+            raise ValueError("a scene is a json object (or a list of objects)")
+        # parsing is plain python, it does not touch the taichi runtime; in a thread of the default executor so that
+        # reading environment maps and textures does not hold up the other connections
+        return await asyncio.get_running_loop().run_in_executor(None, self.worker.add_scene, description)
+
+    async def render(self, job):
+        scene = job.get("scene", self.worker.default_scene)
+        if isinstance(scene, (list, dict)):
+            scene, data = await self.add_scene(scene)
+        else:
+            data = self.worker.cached_scene(scene)
+            if data is None:
+                raise KeyError(f"unknown scene {scene}, upload it to /scenes first")
+        job["scene"] = scene
+        job["data"] = data
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def done(result, error):
+            def resolve():
+                if future.done():
+                    return
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+            loop.call_soon_threadsafe(resolve)
+
+        queued = time.perf_counter()
+        self.worker.submit(job, int(job.get("priority", 0)), done)
+        result = await future
+        queue_time = time.perf_counter() - queued - result["render_time"]
+        extra = {'X-Queue-Time': f'{queue_time:.6f}', 'X-Render-Time': f'{result["render_time"]:.6f}',
+                 'X-Scene-Load-Time': f'{result["load_time"]:.6f}'}
+        return 200, 'image/png', encode_png(result["image"]), extra
+
+
+async def serve(args):
+    worker = RenderWorker(getattr(ti, args.arch), args.max_width, args.max_height, args.max_cached_scenes)
+    worker.start()
+    await asyncio.get_running_loop().run_in_executor(None, worker.ready.wait)
+    server = RenderServer(worker)
+    if args.unix:
+        listener = await asyncio.start_unix_server(server.handle, path=args.unix)
+        print(f'Render server listening on {args.unix}')
+    else:
+        listener = await asyncio.start_server(server.handle, args.host, args.port)
+        print(f'Render server listening on http://{args.host}:{args.port}')
+    async with listener:
+        await listener.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Path Tracing render server')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='host (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8642, help='port (default: 8642)')
+    parser.add_argument('--unix', type=str, default=None, help='listen on a unix socket instead of tcp')
+    parser.add_argument('--arch', type=str, default='gpu', help='taichi arch: gpu, cuda, vulkan, cpu (default: gpu)')
+    parser.add_argument('--max_width', type=int, default=1920, help='largest image width (default: 1920)')
+    parser.add_argument('--max_height', type=int, default=1920, help='largest image height (default: 1920)')
+    parser.add_argument(
+        '--max_cached_scenes', type=int, default=8, help='number of parsed scenes kept in memory (default: 8)')
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
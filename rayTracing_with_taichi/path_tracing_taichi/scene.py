@@ -0,0 +1,351 @@
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+from bvh import build_bvh, transform_box, SPHERE, PLANE, CUBE, INSTANCE
+from environment import read_environment, sky
+from lights import build_lights
+from textures import build_textures
+
+
+'''
+    Scene file (.json or .toml)
+        camera    : { "lookfrom": [x, y, z], "lookat": [x, y, z], "fov": 60 }
+        environment : { "file": "<.hdr or .npy>" (relative to the scene file), "intensity": s, "rotate": degrees }
+                      or { "color": [r, g, b] } or { "sky": { "sun_direction": [x, y, z], "sun_radiance": [r, g, b], ... } },
+                      what escaped rays see (black without one), see environment.py
+        textures  : { "<name>": { "type": "checker" | "noise", "colors": [[r, g, b], [r, g, b]], "scale": s (8), "octaves": n (5) }
+                      or { "type": "image", "file": "<.ppm, .hdr, .npy, others with Pillow>" (relative to the scene file), "scale": s (1) } },
+                    see textures.py
+        materials : { "<name>": { "type": "diffuse" | "metal" | "glass" | "fuzz_metal" | "light", "color": [r, g, b],
+                                  "fuzz": f (metal 0.0, fuzz_metal 0.4), "ior": n (1.5), "texture": "<name>" (times color) } }
+        lights    : emissive primitives, same keys as objects plus "emission": [r, g, b] instead of a material,
+                    they make up the light list used for next event estimation (see lights.py)
+        objects   :
+            { "type": "sphere", "center": [x, y, z], "radius": r, "material": "<name>" }
+            { "type": "plane",  "center": [x, y, z], "normal": [x, y, z], "material": "<name>", "width": w }
+            { "type": "cube",   "center": [x, y, z], "material": "<name>", "width": w }
+        geometries: { "<name>": { "objects": [ ... ] } }, shared geometry, stored once whatever the number of instances
+        instances : [ { "geometry": "<name>", "translate": [x, y, z], "rotate": [x, y, z] (degrees), "scale": s or [x, y, z],
+                        "material": "<name>" (optional, overrides the materials of the geometry) } ]
+                    "matrix": [[...], [...], [...]] (3 x 4, object to world) may replace translate / rotate / scale
+
+    "material" may also be an inline { "type": ..., "color": ... } or a raw material type (see object.py).
+    A bare list is read as the "objects" of a scene with the default camera.
+
+    Every distinct material ends up once in the material table, the primitives only keep its index.
+'''
+
+MATERIAL_TYPES = {"light": 0, "diffuse": 1, "metal": 2, "glass": 3, "fuzz_metal": 4}
+DEFAULT_FUZZ = {"fuzz_metal": 0.4}
+DEFAULT_IOR = 1.5
+DEFAULT_CAMERA = {"lookfrom": [0.0, 1.0, -5.0], "lookat": [0.0, 1.0, -1.0], "fov": 60.0}
+SCENE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scenes")
+
+
+class SceneData:
+    # the scene flattened into numpy arrays, ready to be copied into hittable.Scene
+    #   materials                : the material table, indexed by the "material" of primitives and instances
+    #   spheres / planes / cubes : every primitive, the first counts[kind] belong to the world, the rest to geometries
+    #   blas / geometries        : one BVH per geometry, geometries hold their [node_begin, node_end) in blas
+    #   tlas / instances         : the BVH over the world bounds of the instances
+    #   environment              : {"pixels": (height, width, 3), "intensity", "rotate"} or None
+    #   lights / light_nodes / light_alias : the light list, the light tree over it and its power alias table
+    #   textures                 : textures.build_textures() or None
+    def __init__(self, materials, spheres, planes, cubes, camera, counts=None, geometries=None, instances=None, blas=None, tlas=None,
+                 environment=None, lights=None, textures=None):
+        self.materials = materials
+        self.spheres = spheres
+        self.planes = planes
+        self.cubes = cubes
+        self.camera = camera
+        self.counts = counts if counts is not None else {
+            "spheres": len(spheres["center"]), "planes": len(planes["center"]), "cubes": len(cubes["center"])}
+        self.geometries = geometries if geometries is not None else to_numpy({"node_begin": [], "node_end": []})
+        self.instances = instances if instances is not None else to_numpy(
+            {"world_to_object": [], "offset": [], "normal_matrix": [], "geometry": [], "material": []})
+        self.blas = blas if blas is not None else build_bvh([], [], [], [])
+        self.tlas = tlas if tlas is not None else build_bvh([], [], [], [])
+        self.environment = environment
+        self.lights, self.light_nodes, self.light_alias = lights if lights is not None else build_lights([], [], [], [], [])
+        self.textures = textures
+
+    def bounds(self):
+        # box of the world primitives and the instances
+        boxes = []
+        for (box_min, box_max, _, _), count in zip(primitive_bounds(self.spheres, self.planes, self.cubes),
+                                                   (self.counts["spheres"], self.counts["planes"], self.counts["cubes"])):
+            boxes += [(box_min[:count], box_max[:count])]
+        if len(self.tlas["box_min"]) > 0:
+            boxes.append((self.tlas["box_min"][:1], self.tlas["box_max"][:1]))
+        box_min = np.concatenate([b[0] for b in boxes])
+        box_max = np.concatenate([b[1] for b in boxes])
+        if len(box_min) == 0:
+            return np.zeros(3), np.ones(3)
+        return box_min.min(axis=0), box_max.max(axis=0)
+
+    def geometry_key(self):
+        h = hashlib.sha256()
+        h.update(json.dumps(self.counts, sort_keys=True).encode())
+        for arrays in (self.materials, self.spheres, self.planes, self.cubes, self.geometries, self.instances, self.blas, self.tlas,
+                       self.lights, self.light_nodes, self.light_alias):
+            for key in sorted(arrays):
+                h.update(key.encode())
+                h.update(arrays[key].tobytes())
+        if self.environment is not None:
+            h.update(json.dumps([self.environment["intensity"], self.environment["rotate"]]).encode())
+            h.update(self.environment["pixels"].tobytes())
+        if self.textures is not None:
+            for key in sorted(self.textures["records"]):
+                h.update(key.encode())
+                h.update(self.textures["records"][key].tobytes())
+            h.update(self.textures["level_rect"].tobytes())
+            h.update(self.textures["pixels"].tobytes())
+        return h.hexdigest()
+
+
+def read_scene_file(path):
+    if path.endswith(".toml"):
+        import tomllib
+        with open(path, "rb") as f:
+            return tomllib.load(f)
+    with open(path) as f:
+        return json.load(f)
+
+
+class MaterialTable:
+    # the distinct materials of a scene, identical ones share an entry
+    # textures: name -> index in the texture table
+    def __init__(self, materials, textures=None):
+        self.named = materials
+        self.textures = textures or {}
+        self.records = {"type": [], "color": [], "fuzz": [], "ior": [], "light": [], "texture": []}
+        self.index = {}
+
+    def add(self, type, color, fuzz=0.0, ior=DEFAULT_IOR, light=-1, texture=-1):
+        key = (int(type), tuple(float(c) for c in color), float(fuzz), float(ior), int(light), int(texture))
+        if key not in self.index:
+            self.index[key] = len(self.records["type"])
+            for name, value in zip(("type", "color", "fuzz", "ior", "light", "texture"), key):
+                self.records[name].append(value)
+        return self.index[key]
+
+    def resolve(self, material, color=None):
+        # material: a name, an inline description or a raw type; color overrides the color of the material
+        if isinstance(material, str):
+            material = self.named[material]
+        if isinstance(material, dict):
+            texture = self.textures[material["texture"]] if "texture" in material else -1
+            return self.add(MATERIAL_TYPES[material["type"]], color or material.get("color", [1.0, 1.0, 1.0]),
+                            material.get("fuzz", DEFAULT_FUZZ.get(material["type"], 0.0)), material.get("ior", DEFAULT_IOR),
+                            texture=texture)
+        material = int(material)
+        return self.add(material, color or [1.0, 1.0, 1.0], 0.4 if material == MATERIAL_TYPES["fuzz_metal"] else 0.0)
+
+    def light(self, emission, light):
+        # every entry of the light list gets its own material, it tells which light a ray has hit
+        return self.add(MATERIAL_TYPES["light"], emission, light=light)
+
+
+def to_numpy(records):
+    arrays = {}
+    for key, value in records.items():
+        if key in ("material", "geometry", "node_begin", "node_end", "type", "light", "texture"):
+            arrays[key] = np.array(value, dtype=np.int32).reshape(-1)
+        elif key in ("center", "normal", "color", "offset"):
+            arrays[key] = np.array(value, dtype=np.float32).reshape(-1, 3)
+        elif key in ("world_to_object", "normal_matrix"):
+            arrays[key] = np.array(value, dtype=np.float32).reshape(-1, 3, 3)
+        else:
+            arrays[key] = np.array(value, dtype=np.float32).reshape(-1)
+    return arrays
+
+
+def add_primitives(primitives, spheres, planes, cubes):
+    for obj, material in primitives:
+        if obj["type"] == "sphere":
+            records = spheres
+            records["radius"].append(obj["radius"])
+        elif obj["type"] == "plane":
+            records = planes
+            records["normal"].append(obj["normal"])
+            records["width"].append(obj.get("width", 5))
+            records["height"].append(obj.get("height", 5))
+        elif obj["type"] == "cube":
+            records = cubes
+            records["width"].append(obj.get("width", 1))
+        else:
+            raise ValueError(f"unknown object type: {obj['type']}")
+        records["center"].append(obj["center"])
+        records["material"].append(material)
+
+
+def object_primitives(objects, materials):
+    # a color on the object itself overrides the material color
+    return [(obj, materials.resolve(obj.get("material", 1), obj.get("color"))) for obj in objects]
+
+
+def primitive_bounds(spheres, planes, cubes):
+    # (box_min, box_max, kind, index) of every primitive; a plane is a square, its box is as wide as is_inside_plane
+    bounds = []
+    for kind, arrays, half in ((SPHERE, spheres, np.abs(spheres["radius"])),
+                               (PLANE, planes, planes["width"] / 2),
+                               (CUBE, cubes, cubes["width"] / 2)):
+        center = arrays["center"]
+        bounds.append((center - half[:, None], center + half[:, None], np.full(len(center), kind), np.arange(len(center))))
+    return bounds
+
+
+def light_list(lights, bounds):
+    # lights: the "lights" of the scene, they are the first primitives of their kind. The power of a light is
+    # the luminance of its emission times its area
+    kind, index, box_min, box_max, power = [], [], [], [], []
+    counters = {SPHERE: 0, PLANE: 0, CUBE: 0}
+    for obj in lights:
+        k = {"sphere": SPHERE, "plane": PLANE, "cube": CUBE}[obj["type"]]
+        i = counters[k]
+        counters[k] += 1
+        width = obj.get("width", 5 if k == PLANE else 1)
+        area = {SPHERE: 4 * np.pi * obj.get("radius", 0.0) ** 2, PLANE: width ** 2, CUBE: 6 * width ** 2}[k]
+        kind.append(k)
+        index.append(i)
+        box_min.append(bounds[k][0][i])
+        box_max.append(bounds[k][1][i])
+        power.append(max(float(np.dot(obj["emission"], [0.2126, 0.7152, 0.0722])), 0.0) * area)
+    return build_lights(kind, index, box_min, box_max, power)
+
+
+def instance_transform(instance):
+    if "matrix" in instance:
+        m = np.array(instance["matrix"], dtype=np.float64)
+        return m[:, :3], m[:, 3]
+    rx, ry, rz = np.radians(instance.get("rotate", [0.0, 0.0, 0.0]))
+    rot_x = np.array([[1, 0, 0], [0, np.cos(rx), -np.sin(rx)], [0, np.sin(rx), np.cos(rx)]])
+    rot_y = np.array([[np.cos(ry), 0, np.sin(ry)], [0, 1, 0], [-np.sin(ry), 0, np.cos(ry)]])
+    rot_z = np.array([[np.cos(rz), -np.sin(rz), 0], [np.sin(rz), np.cos(rz), 0], [0, 0, 1]])
+    scale = np.diag(np.broadcast_to(np.asarray(instance.get("scale", 1.0), dtype=np.float64), (3,)))
+    return rot_z @ rot_y @ rot_x @ scale, np.array(instance.get("translate", [0.0, 0.0, 0.0]), dtype=np.float64)
+
+
+def parse_environment(environment, base_dir):
+    if environment is None:
+        return None
+    if "file" in environment:
+        pixels = read_environment(os.path.join(base_dir, environment["file"]))
+    elif "sky" in environment:
+        pixels = sky(**environment["sky"])
+    else:
+        pixels = np.array(environment["color"], dtype=np.float32).reshape(1, 1, 3)
+    return {"pixels": pixels, "intensity": float(environment.get("intensity", 1.0)),
+            "rotate": float(environment.get("rotate", 0.0))}
+
+
+def parse_scene(description, base_dir=SCENE_DIR):
+    if isinstance(description, list):
+        description = {"objects": description}
+    textures = description.get("textures", {})
+    materials = MaterialTable(description.get("materials", {}), {name: k for k, name in enumerate(textures)})
+    camera = dict(DEFAULT_CAMERA, **description.get("camera", {}))
+
+    spheres = {"center": [], "radius": [], "material": []}
+    planes = {"center": [], "normal": [], "material": [], "width": [], "height": []}
+    cubes = {"center": [], "material": [], "width": []}
+
+    primitives = [(obj, materials.light(obj["emission"], i)) for i, obj in enumerate(description.get("lights", []))]
+    primitives += object_primitives(description.get("objects", []), materials)
+    add_primitives(primitives, spheres, planes, cubes)
+    counts = {"spheres": len(spheres["center"]), "planes": len(planes["center"]), "cubes": len(cubes["center"])}
+
+    # the primitives of the geometries follow the world primitives in the same arrays
+    geometry_names = list(description.get("geometries", {}))
+    ranges = []
+    for name in geometry_names:
+        begin = [len(spheres["center"]), len(planes["center"]), len(cubes["center"])]
+        add_primitives(object_primitives(description["geometries"][name]["objects"], materials), spheres, planes, cubes)
+        ranges.append((begin, [len(spheres["center"]), len(planes["center"]), len(cubes["center"])]))
+    spheres, planes, cubes = to_numpy(spheres), to_numpy(planes), to_numpy(cubes)
+
+    # BLAS: one BVH per geometry, all of them in one node array
+    bounds = primitive_bounds(spheres, planes, cubes)
+    blas_parts = []
+    geometries = {"node_begin": [], "node_end": []}
+    geometry_boxes = []
+    node_count = 0
+    for begin, end in ranges:
+        leaves = [np.concatenate([b[k][begin[kind]:end[kind]] for kind, b in enumerate(bounds)]) for k in range(4)]
+        nodes = build_bvh(*leaves, offset=node_count)
+        if len(nodes["kind"]) == 0:
+            raise ValueError("a geometry needs at least one object")
+        geometries["node_begin"].append(node_count)
+        node_count += len(nodes["kind"])
+        geometries["node_end"].append(node_count)
+        geometry_boxes.append((nodes["box_min"][0], nodes["box_max"][0]))
+        blas_parts.append(nodes)
+    blas = {key: np.concatenate([part[key] for part in blas_parts]) if blas_parts else empty
+            for key, empty in build_bvh([], [], [], []).items()}
+
+    # TLAS over the world bounds of the instances
+    instances = {"world_to_object": [], "offset": [], "normal_matrix": [], "geometry": [], "material": []}
+    instance_min, instance_max = [], []
+    for instance in description.get("instances", []):
+        geometry = geometry_names.index(instance["geometry"])
+        matrix, translate = instance_transform(instance)
+        inverse = np.linalg.inv(matrix)
+        instances["world_to_object"].append(inverse)
+        instances["offset"].append(-inverse @ translate)
+        instances["normal_matrix"].append(inverse.T)
+        instances["geometry"].append(geometry)
+        if "material" in instance:
+            instances["material"].append(materials.resolve(instance["material"], instance.get("color")))
+        else:
+            instances["material"].append(-1)
+        box_min, box_max = transform_box(*geometry_boxes[geometry], matrix, translate)
+        instance_min.append(box_min)
+        instance_max.append(box_max)
+    instances = to_numpy(instances)
+    num_instances = len(instances["geometry"])
+    tlas = build_bvh(instance_min, instance_max, np.full(num_instances, INSTANCE), np.arange(num_instances))
+
+    return SceneData(to_numpy(materials.records), spheres, planes, cubes, camera, counts, to_numpy(geometries), instances, blas, tlas,
+                     parse_environment(description.get("environment"), base_dir), light_list(description.get("lights", []), bounds),
+                     build_textures(list(textures.values()), base_dir) if textures else None)
+
+
+def load_scene(path):
+    return parse_scene(read_scene_file(path), os.path.dirname(os.path.abspath(path)))
+
+
+def cornell_box():
+    return read_scene_file(os.path.join(SCENE_DIR, "cornell_box.json"))
+
+
+class SceneWatcher(threading.Thread):
+    # polls the modification time of a scene file, the render loop picks the change up with poll()
+    def __init__(self, path, interval=0.5):
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.mtime = os.stat(path).st_mtime
+        self.changed = threading.Event()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except FileNotFoundError:
+                continue  # editors often replace the file, it will be back in a moment
+            if mtime != self.mtime:
+                self.mtime = mtime
+                self.changed.set()
+
+    def poll(self):
+        if self.changed.is_set():
+            self.changed.clear()
+            return True
+        return False
+
+    def stop(self):
+        self.stopped.set()
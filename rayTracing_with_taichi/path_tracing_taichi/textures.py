@@ -0,0 +1,292 @@
+import os
+
+import taichi as ti
+import taichi.math as tm
+import numpy as np
+from environment import read_environment, fit
+
+'''
+    Textures of the materials, all of them in one table and every image texel in one atlas field:
+        image   : an image and its mip chain (2 x 2 box filter down to 1 x 1), every level is a rectangle of the
+                  atlas, packed in shelves (tallest first) when the scene is parsed. Images are box filtered down
+                  to at most half the atlas size, a chain takes about 1.5 times the width of its first level
+        checker : two colors, scale squares across [0, 1] in u and v
+        noise   : value noise fbm between two colors, octaves octaves, the first one has scale cells across [0, 1]
+    The lookups repeat the texture outside of [0, 1] (scale repeats an image) and wrap inside its rectangle, so
+    neighbouring textures of the atlas never bleed into each other.
+
+    sample() takes the width of the footprint of the ray on the surface in uv units (see PathTracer.ray_color,
+    ray cones) and filters over it:
+        image   : trilinear, level log2(footprint * texels) between the two nearest levels of the mip chain
+        checker : box filtered in closed form, it fades to the average of the colors once a square is smaller than the footprint
+        noise   : the octaves finer than the footprint fade out, far away only the average is left
+    A footprint of 0 samples the full resolution.
+'''
+
+IMAGE = 0
+CHECKER = 1
+NOISE = 2
+TEXTURE_TYPES = {"image": IMAGE, "checker": CHECKER, "noise": NOISE}
+
+ATLAS_SIZE = 1024
+MAX_TEXTURES = 64
+MAX_LEVELS = 11  # 1024 x 1024 down to 1 x 1
+MAX_OCTAVES = 8
+
+
+@ti.dataclass
+class Texture:
+    kind: ti.i32       # IMAGE / CHECKER / NOISE
+    levels: ti.i32     # of the mip chain of an image, its rectangles are TextureAtlas.level_rect[texture, :levels]
+    scale: ti.f32      # repeats of an image, squares of a checker, cells of the first noise octave
+    octaves: ti.i32
+    color0: tm.vec3
+    color1: tm.vec3
+
+
+def read_image(path):
+    # float32 (height, width, 3), row 0 at the top, linear: 8 bit images are gamma 2 like the output of PathTracer.image
+    if path.endswith('.npy') or path.endswith('.hdr'):
+        return read_environment(path)
+    if path.endswith('.ppm'):
+        with open(path, 'rb') as f:
+            data = f.read()
+        # P6 header: magic, width, height, maxval, whitespace separated
+        fields, pos = [], 0
+        while len(fields) < 4:
+            while data[pos:pos + 1].isspace():
+                pos += 1
+            if data[pos:pos + 1] == b'#':
+                pos = data.index(b'\n', pos)
+                continue
+            end = pos
+            while not data[end:end + 1].isspace():
+                end += 1
+            fields.append(data[pos:end])
+            pos = end
+        if fields[0] != b'P6' or int(fields[3]) > 255:
+            raise ValueError(f"{path}: only 8 bit binary PPM (P6) is supported")
+        width, height = int(fields[1]), int(fields[2])
+        pixels = np.frombuffer(data, np.uint8, width * height * 3, pos + 1).reshape(height, width, 3)
+    else:
+        try:
+            from PIL import Image
+        except ImportError:
+            raise ValueError(f"{path}: reading {os.path.splitext(path)[1]} images needs Pillow, .ppm, .hdr and .npy work without it")
+        pixels = np.asarray(Image.open(path).convert('RGB'))
+    return ((pixels / 255.0) ** 2).astype(np.float32)
+
+
+def mip_chain(pixels):
+    # every level half the size of the one before (rounded up, odd sizes repeat the first row / column), down to 1 x 1
+    levels = [pixels]
+    while max(pixels.shape[:2]) > 1:
+        height, width = pixels.shape[:2]
+        pixels = np.pad(pixels, ((0, height % 2), (0, width % 2), (0, 0)), mode='wrap')
+        pixels = pixels.reshape(pixels.shape[0] // 2, 2, pixels.shape[1] // 2, 2, 3).mean(axis=(1, 3))
+        levels.append(pixels)
+    return levels
+
+
+def pack(sizes, atlas_size):
+    # shelf packing of (height, width) rectangles, the tallest first; returns their (x, y) and the height used
+    origins = [None] * len(sizes)
+    x, y, shelf_height = 0, 0, 0
+    for k in sorted(range(len(sizes)), key=lambda k: -sizes[k][0]):
+        height, width = sizes[k]
+        if x + width > atlas_size:
+            x, y, shelf_height = 0, y + shelf_height, 0
+        if y + height > atlas_size:
+            raise ValueError(f"the textures do not fit a {atlas_size} x {atlas_size} atlas")
+        origins[k] = (x, y)
+        x += width
+        shelf_height = max(shelf_height, height)
+    return origins, y + shelf_height
+
+
+def build_textures(textures, base_dir, atlas_size=ATLAS_SIZE):
+    # textures: the parsed "textures" of a scene file in order -> {"records", "level_rect", "pixels"} for TextureAtlas.load
+    if len(textures) > MAX_TEXTURES:
+        raise ValueError(f"scene needs {len(textures)} textures, the table only holds {MAX_TEXTURES}")
+    records = {"kind": [], "levels": [], "scale": [], "octaves": [], "color0": [], "color1": []}
+    chains = []
+    for texture in textures:
+        kind = TEXTURE_TYPES[texture["type"]]
+        colors = texture.get("colors", [[0.0, 0.0, 0.0], [1.0, 1.0, 1.0]])
+        chain = []
+        if kind == IMAGE:
+            # the first level at most half the atlas: the others (half as wide in total) fit on the shelves beside it
+            chain = mip_chain(fit(read_image(os.path.join(base_dir, texture["file"])), atlas_size // 2, atlas_size // 2))
+        records["kind"].append(kind)
+        records["levels"].append(len(chain))
+        records["scale"].append(float(texture.get("scale", 1.0 if kind == IMAGE else 8.0)))
+        records["octaves"].append(min(int(texture.get("octaves", 5)), MAX_OCTAVES))
+        records["color0"].append(colors[0])
+        records["color1"].append(colors[1])
+        chains.append(chain)
+
+    sizes = [level.shape[:2] for chain in chains for level in chain]
+    origins, used = pack(sizes, atlas_size)
+    pixels = np.zeros((max(used, 1), atlas_size, 3), dtype=np.float32)
+    level_rect = np.zeros((len(textures), MAX_LEVELS, 4), dtype=np.int32)
+    k = 0
+    for t, chain in enumerate(chains):
+        for level, image in enumerate(chain):
+            (x, y), (height, width) = origins[k], sizes[k]
+            pixels[y:y + height, x:x + width] = image
+            level_rect[t, level] = (x, y, width, height)
+            k += 1
+    records = {key: np.array(value, dtype=np.int32 if key in ("kind", "levels", "octaves") else np.float32)
+               for key, value in records.items()}
+    records["color0"] = records["color0"].reshape(-1, 3)
+    records["color1"] = records["color1"].reshape(-1, 3)
+    return {"records": records, "level_rect": level_rect, "pixels": pixels}
+
+
+# value noise lattice, in [-1, 1]
+@ti.func
+def lattice(texture, x, y):
+    h = ti.cast(x, ti.u32) * ti.u32(0x8da6b343) ^ ti.cast(y, ti.u32) * ti.u32(0xd8163841) ^ ti.cast(texture, ti.u32) * ti.u32(0xcb1ab31f)
+    h = (h ^ (h >> 16)) * ti.u32(0x7feb352d)
+    h = (h ^ (h >> 15)) * ti.u32(0x846ca68b)
+    h ^= h >> 16
+    return ti.cast(h & ti.u32(0xffffff), ti.f32) / 0xffffff * 2 - 1
+
+
+# box filtered checker (the integral of a square wave of period 2 over [p - w / 2, p + w / 2]), 0 or 1 without filtering
+@ti.func
+def filtered_checker(p, w):
+    i = 2 * (ti.abs(tm.fract((p - 0.5 * w) * 0.5) - 0.5) - ti.abs(tm.fract((p + 0.5 * w) * 0.5) - 0.5)) / w
+    return 0.5 - 0.5 * i.x * i.y
+
+
+@ti.data_oriented
+class TextureAtlas:
+    def __init__(self, atlas_size=ATLAS_SIZE, max_textures=MAX_TEXTURES):
+        self.atlas_size = atlas_size
+        self.atlas = ti.Vector.field(3, dtype=ti.f32, shape=(atlas_size, atlas_size))  # [y, x], row 0 at the top
+        self.textures = Texture.field(shape=max_textures)
+        self.level_rect = ti.Vector.field(4, dtype=ti.i32, shape=(max_textures, MAX_LEVELS))  # x, y, width, height
+
+    def check(self, textures):
+        if textures is None:
+            return
+        pixels = textures["pixels"]
+        if pixels.shape[1] > self.atlas_size or pixels.shape[0] > self.atlas_size:
+            raise ValueError(f"the textures need a {pixels.shape[1]} x {pixels.shape[0]} atlas, the field is {self.atlas_size} x {self.atlas_size}")
+        if len(textures["records"]["kind"]) > self.textures.shape[0]:
+            raise ValueError(f"scene needs {len(textures['records']['kind'])} textures, the field only holds {self.textures.shape[0]}")
+
+    def load(self, textures):
+        # textures: build_textures() or None
+        if textures is None:
+            return
+        self.check(textures)
+        pixels = textures["pixels"]
+        padded = np.zeros((self.atlas_size, self.atlas_size, 3), dtype=np.float32)
+        padded[:pixels.shape[0], :pixels.shape[1]] = pixels
+        self.atlas.from_numpy(padded)
+        n = len(textures["records"]["kind"])
+        padded = {}
+        for key, value in textures["records"].items():
+            padded[key] = np.zeros((self.textures.shape[0],) + value.shape[1:], dtype=value.dtype)
+            padded[key][:n] = value
+        self.textures.from_numpy(padded)
+        level_rect = np.zeros(self.level_rect.shape + (4,), dtype=np.int32)
+        level_rect[:n] = textures["level_rect"]
+        self.level_rect.from_numpy(level_rect)
+
+    # bilinear, repeating inside the rectangle of the level
+    @ti.func
+    def bilinear(self, texture, level, uv):
+        rect = self.level_rect[texture, level]
+        x = uv.x * rect[2] - 0.5
+        y = (1 - uv.y) * rect[3] - 0.5
+        x0 = ti.cast(ti.floor(x), ti.i32)
+        y0 = ti.cast(ti.floor(y), ti.i32)
+        fx = x - x0
+        fy = y - y0
+        color = ti.Vector([0.0, 0.0, 0.0])
+        for dy in ti.static(range(2)):
+            for dx in ti.static(range(2)):
+                weight = (fx if dx else 1 - fx) * (fy if dy else 1 - fy)
+                color += weight * self.atlas[rect[1] + (y0 + dy) % rect[3], rect[0] + (x0 + dx) % rect[2]]
+        return color
+
+    @ti.func
+    def noise(self, texture, p, period):
+        x0 = ti.cast(ti.floor(p.x), ti.i32)
+        y0 = ti.cast(ti.floor(p.y), ti.i32)
+        f = p - ti.floor(p)
+        f = f * f * (3 - 2 * f)
+        a = lattice(texture, x0 % period, y0 % period)
+        b = lattice(texture, (x0 + 1) % period, y0 % period)
+        c = lattice(texture, x0 % period, (y0 + 1) % period)
+        d = lattice(texture, (x0 + 1) % period, (y0 + 1) % period)
+        return tm.mix(tm.mix(a, b, f.x), tm.mix(c, d, f.x), f.y)
+
+    # the color of texture at uv, filtered over a footprint that many uv units wide
+    @ti.func
+    def sample(self, texture, uv, footprint):
+        t = self.textures[texture]
+        p = uv * t.scale
+        w = footprint * t.scale  # in repeats / squares / cells of the first octave
+        color = ti.Vector([0.0, 0.0, 0.0])
+        if t.kind == IMAGE:
+            rect = self.level_rect[texture, 0]
+            lod = tm.clamp(tm.log2(ti.max(w * ti.max(rect[2], rect[3]), 1e-8)), 0.0, t.levels - 1.0)
+            level = ti.min(ti.cast(lod, ti.i32), t.levels - 1)
+            fine = self.bilinear(texture, level, p)
+            coarse = self.bilinear(texture, ti.min(level + 1, t.levels - 1), p)
+            color = tm.mix(fine, coarse, lod - level)
+        elif t.kind == CHECKER:
+            color = tm.mix(t.color0, t.color1, filtered_checker(p, ti.max(w, 1e-3)))
+        else:
+            # the lattice repeats every period cells of an octave, the noise tiles [0, 1] like the other textures
+            period = ti.max(ti.cast(ti.round(t.scale), ti.i32), 1)
+            value = 0.0
+            amplitude = 1.0
+            total = 0.0
+            frequency = 1.0
+            for octave in range(t.octaves):
+                # full up to half a cell per footprint, gone at one
+                keep = tm.clamp(2.0 - 2.0 * w * frequency, 0.0, 1.0)
+                if keep > 0:
+                    value += keep * amplitude * self.noise(texture, p * frequency, period)
+                total += amplitude
+                amplitude *= 0.5
+                frequency *= 2.0
+                period *= 2
+            color = tm.mix(t.color0, t.color1, tm.clamp(0.5 + 0.5 * value / ti.max(total, 1e-6), 0.0, 1.0))
+        return color
+
+
+if __name__ == "__main__":
+    # large images load: they are shrunk so that the whole mip chain fits, the levels average the image
+    import argparse
+    import tempfile
+    parser = argparse.ArgumentParser(description='texture atlas check')
+    parser.add_argument(
+        '--sizes', type=str, default='512x512,700x700,1024x1024,2048x2048,2048x512',
+        help='comma separated WxH of the test images (default: 512x512,700x700,1024x1024,2048x2048,2048x512)')
+    parser.add_argument(
+        '--arch', type=str, default='cpu', help='taichi arch: cpu, gpu, cuda, vulkan (default: cpu)')
+    args = parser.parse_args()
+
+    ti.init(arch=getattr(ti, args.arch))
+    atlas = TextureAtlas()
+    rng = np.random.default_rng(0)
+    print(f'{"image":>10} {"level 0":>10} {"levels":>6} {"atlas rows":>10} {"mean error":>10}')
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes.split(','):
+            width, height = (int(x) for x in size.split('x'))
+            pixels = rng.random((height, width, 3), dtype=np.float32)
+            np.save(os.path.join(directory, 'image.npy'), pixels)
+            textures = build_textures([{"type": "image", "file": "image.npy"}], directory)
+            atlas.load(textures)
+            rect = textures["level_rect"][0]
+            levels = int(textures["records"]["levels"][0])
+            coarsest = atlas.atlas.to_numpy()[rect[levels - 1, 1], rect[levels - 1, 0]]
+            # the 1 x 1 level against the image mean, odd sizes weigh the repeated rows a little more
+            error = float(np.abs(coarsest - pixels.mean(axis=(0, 1))).max())
+            print(f'{size:>10} {f"{rect[0, 2]}x{rect[0, 3]}":>10} {levels:>6} {textures["pixels"].shape[0]:>10} {error:>10.2e}')